@@ -30,6 +30,74 @@ class BaseConf(object):
     CELERYBEAT_MAX_LOOP_INTERVAL = 15
     DEFAULT_UPDATE_INTERVAL = 15
 
+    # incremental refresh: only pull the tasks changed since the last refresh
+    # and run a full reconciliation with the store every FULL_UPDATE_INTERVAL
+    # seconds (also the only way deleted tasks are dropped from the schedule)
+    INCREMENTAL_UPDATE = False
+    # seconds subtracted from the change marker, covers the clock drift
+    # between the scheduler host and the store nodes
+    INCREMENTAL_UPDATE_OVERLAP = 5
+    FULL_UPDATE_INTERVAL = 300
+
+    # size in seconds of the first level slots of the WheelScheduler
+    TIMING_WHEEL_RESOLUTION = 1
+
+    # run the endpoints in a local thread pool of the endpoint consumer,
+    # instead of sending them back to the broker as celery tasks
+    ENDPOINT_INLINE_EXECUTION = False
+    ENDPOINT_INLINE_THREADS = 10
+    # seconds between the acks of the messages processed inline
+    ENDPOINT_ACK_INTERVAL = 0.1
+
+    # default and maximum number of tasks in a page of all or search
+    ENDPOINT_PAGE_SIZE = 100
+    ENDPOINT_MAX_PAGE_SIZE = 1000
+
+    # serializer of the messages sent to the workers
+    DISPATCH_SERIALIZER = 'json'
+    # wait for the broker publisher confirms when sending due tasks,
+    # a group of tasks is failed after DISPATCH_CONFIRM_TIMEOUT seconds
+    DISPATCH_CONFIRM = False
+    DISPATCH_CONFIRM_TIMEOUT = 10
+    # keep DISPATCH_POOL_SIZE long lived producers per worker connection,
+    # instead of using the kombu global producer pools
+    DISPATCH_POOLED = False
+    DISPATCH_POOL_SIZE = 10
+    # seconds to wait for a free producer before giving up
+    DISPATCH_ACQUIRE_TIMEOUT = 5
+
+    # records kept in the EventStore cache, 0 to disable it,
+    # and seconds before a cached record is read again from the store
+    STORE_CACHE_SIZE = 0
+    STORE_CACHE_TTL = 30
+    # serve the reads from a local snapshot and queue the writes, up to
+    # STORE_FAILOVER_QUEUE_SIZE of them, while the store is unavailable
+    STORE_FAILOVER = False
+    STORE_FAILOVER_QUEUE_SIZE = 10000
+
+    # PartitionedScheduler: the tasks are spread over SCHEDULER_SHARDS
+    # shards by a hash of their name, each scheduler only runs the shards
+    # it holds a lease on. Leases last SCHEDULER_LEASE_TTL seconds and are
+    # renewed on every schedule update, so the TTL must be well over
+    # DEFAULT_UPDATE_INTERVAL; shards stop being run SCHEDULER_LEASE_MARGIN
+    # seconds before the end of their lease
+    SCHEDULER_SHARDS = 64
+    SCHEDULER_LEASE_TTL = 45
+    SCHEDULER_LEASE_MARGIN = 5
+    # virtual nodes of each scheduler on the shard hash ring
+    SCHEDULER_RING_REPLICAS = 64
+    # name of the scheduler in the leases, hostname:pid by default
+    SCHEDULER_MEMBER = None
+
+    # worker types the dispatcher sends tasks to
+    WORKER_TYPES = ('kraken', 'nautilus')
+    # broker urls of the worker types, by default the {TYPE}_URL one;
+    # tasks are spread across the brokers of their type by consistent
+    # hashing on the task name, so the runs of a task keep their order
+    WORKER_BROKERS = {}
+    # virtual nodes of each broker on the hash ring
+    WORKER_BROKER_REPLICAS = 64
+
     # Kraken connection data
     KRAKEN_USER = 'guest'
     KRAKEN_PASSWORD = 'guest'
@@ -108,8 +176,26 @@ class ProdConf(BaseConf):
     # general aerospike settings
     AEROSPIKE_NAMESPACE = 'test'
     AEROSPIKE_SETNAME = 'tasks'
+    # set of the PartitionedScheduler leases
+    AEROSPIKE_LEASE_SETNAME = 'leases'
     AEROSPIKE_USERNAME = None
     AEROSPIKE_PASSWORD = None
     # The lifetime of a database connection, in seconds. Use 0 to close database connections at the end of each task
     # and None for unlimited persistent connections
     AEROSPIKE_CONN_MAX_AGE = None
+    # milliseconds before a key or batch operation times out, the
+    # policies timeout of AEROSPIKE_CONFIG applies to the scans
+    AEROSPIKE_KEY_TIMEOUT = 1000
+    # refuse the calls for AEROSPIKE_BREAKER_RESET seconds after
+    # AEROSPIKE_BREAKER_THRESHOLD cluster errors in a row
+    AEROSPIKE_BREAKER_THRESHOLD = 3
+    AEROSPIKE_BREAKER_RESET = 10
+    # records buffered between a streaming scan and its reader
+    AEROSPIKE_SCAN_QUEUE_SIZE = 1000
+    # layout of the written records: 1 for the compact records of
+    # recordcodec, 0 for the legacy one bin per field records; records of
+    # both layouts are read, keep 0 until every reader is upgraded
+    AEROSPIKE_RECORD_FORMAT = 0
+    # compress the payload bin of compact records over this size in bytes,
+    # 0 to never compress
+    AEROSPIKE_COMPRESSION_THRESHOLD = 512
@@ -0,0 +1,138 @@
+"""Vectorized next run computation for crontab schedules."""
+
+import calendar
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from taskmodel import CRONTAB_FIELDS
+
+# how many days ahead to look for a run, covers leap day crontabs
+MAX_DAYS = 5 * 366
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def crontab_masks(crontab):
+    """Return the bitmasks of the fields of a Crontab, in CRONTAB_FIELDS order.
+
+    Bit N of a mask is set when value N matches the field, with Sunday
+    as day 0 of the week like in celery.
+    """
+    schedule = crontab.schedule
+    return tuple(sum(1 << value for value in getattr(schedule, field))
+                 for field in CRONTAB_FIELDS)
+
+
+def to_timestamp(value):
+    """Convert a datetime to epoch seconds, naive values being UTC."""
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class CrontabEngine(object):
+    """Next run times for a whole set of crontab schedules at once.
+
+    Every crontab is compiled to bitmasks of its fields, the next runs
+    are then searched day by day for all the schedules together, using
+    numpy arrays. Times are in UTC.
+    """
+
+    def __init__(self, items=()):
+        """Compile the (name, Crontab) items."""
+        if numpy is None:
+            raise ImportError('numpy is required by the crontab engine.')
+
+        self.names = []
+        masks = []
+        for name, crontab in items:
+            self.names.append(name)
+            masks.append(crontab_masks(crontab))
+        masks = numpy.array(masks, dtype=numpy.int64).reshape(-1, 5)
+        (self.minutes, self.hours, self.weekdays,
+         self.monthdays, self.months) = masks.T
+
+    def __len__(self):
+        """Return the number of compiled schedules."""
+        return len(self.names)
+
+    def next_runs(self, after):
+        """Return the epoch time of the first run after each given time.
+
+        after holds one epoch time per schedule, like the last run times.
+        Runs happen on whole minutes, strictly after the minute of the
+        given time. Schedules without a run in MAX_DAYS get inf.
+        """
+        start = numpy.floor(numpy.asarray(after, dtype=numpy.float64) / 60)
+        start = start.astype(numpy.int64) + 1
+        day, minute = numpy.divmod(start, MINUTES_PER_DAY)
+        hour, minute = numpy.divmod(minute, 60)
+
+        result = numpy.full(len(self), -1, dtype=numpy.int64)
+        pending = numpy.arange(len(self))
+
+        # first day: the rest of the current hour, then the later hours
+        matches = self._matches_date(pending, day)
+        same_hour = (self._has_bit(self.hours, hour) &
+                     (self._from_bit(self.minutes, minute) != 0))
+        found = matches & same_hour
+        result[found] = (day[found] * MINUTES_PER_DAY + hour[found] * 60 +
+                         self._lowest_bit(
+                             self._from_bit(self.minutes[found],
+                                            minute[found])))
+        later_hours = self._from_bit(self.hours, hour + 1)
+        found = matches & ~same_hour & (later_hours != 0)
+        result[found] = (day[found] * MINUTES_PER_DAY +
+                         self._lowest_bit(later_hours[found]) * 60 +
+                         self._lowest_bit(self.minutes[found]))
+
+        # next days: the first matching hour and minute
+        pending = numpy.flatnonzero(result < 0)
+        for offset in range(1, MAX_DAYS + 1):
+            if not len(pending):
+                break
+            days = day[pending] + offset
+            found = self._matches_date(pending, days)
+            index = pending[found]
+            result[index] = (days[found] * MINUTES_PER_DAY +
+                             self._lowest_bit(self.hours[index]) * 60 +
+                             self._lowest_bit(self.minutes[index]))
+            pending = pending[~found]
+
+        runs = result.astype(numpy.float64) * 60
+        runs[result < 0] = numpy.inf
+        return runs
+
+    def due(self, now, after):
+        """Return the names of the schedules with a run due at now."""
+        runs = self.next_runs(after)
+        return [self.names[index]
+                for index in numpy.flatnonzero(runs <= now)]
+
+    def _matches_date(self, index, days):
+        """Check which schedules run on the given days since the epoch."""
+        dates = days.astype('datetime64[D]')
+        months = dates.astype('datetime64[M]')
+        month = months.astype(numpy.int64) % 12 + 1
+        monthday = (dates - months).astype(numpy.int64) + 1
+        # 1970-01-01 was a Thursday, day 4 when Sunday is day 0
+        weekday = (days + 4) % 7
+        return (self._has_bit(self.months[index], month) &
+                self._has_bit(self.monthdays[index], monthday) &
+                self._has_bit(self.weekdays[index], weekday))
+
+    @staticmethod
+    def _has_bit(masks, bits):
+        """Check if the bits are set in the masks."""
+        return (numpy.right_shift(masks, bits) & 1) != 0
+
+    @staticmethod
+    def _from_bit(masks, bits):
+        """Clear the bits of the masks below the given ones."""
+        return numpy.left_shift(numpy.right_shift(masks, bits), bits)
+
+    @staticmethod
+    def _lowest_bit(masks):
+        """Return the position of the lowest set bit of non zero masks."""
+        return numpy.log2(masks & -masks).round().astype(numpy.int64)
@@ -1,20 +1,104 @@
 """Event dispatcher."""
+import bisect
+import hashlib
+import socket
+import time
+from collections import namedtuple
+
 from kombu import Exchange, Connection
-from kombu.pools import producers
+from kombu.exceptions import LimitExceeded
+from kombu.pools import producers, ProducerPool
+from kombu.serialization import dumps
 
 from . import Config, get_logger
 
 
 logger = get_logger('tentacle')
 
+# AMQP methods sent back by the broker for publisher confirms
+CONFIRM_METHODS = [(60, 80), (60, 120)]  # Basic.Ack, Basic.Nack
+
+# a routed and serialized task, ready to be published as is;
+# destination is the (worker type, connection, exchange, routing key)
+PreparedMessage = namedtuple('PreparedMessage', [
+    'destination', 'body', 'content_type', 'content_encoding'])
+
+
+class HashRing(object):
+    """Consistent hashing of keys over a list of nodes."""
+
+    def __init__(self, nodes, replicas=None, names=None):
+        """Place replicas virtual points of every node on the ring.
+
+        The points are placed by the names of the nodes, their positions
+        by default, so nodes with names keep their keys when other nodes
+        are added or removed.
+        """
+        self.nodes = list(nodes)
+        replicas = replicas or Config.WORKER_BROKER_REPLICAS
+        if names is None:
+            names = range(len(self.nodes))
+        points = sorted((self.hash('{}-{}'.format(name, replica)), index)
+                        for index, name in enumerate(names)
+                        for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    @staticmethod
+    def hash(key):
+        """Return the position of a key on the ring."""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get(self, key):
+        """Return the node owning a key."""
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        position = bisect.bisect(self._hashes, self.hash(key))
+        if position == len(self._hashes):
+            position = 0
+        return self.nodes[self._indexes[position]]
+
 
 class EventDispatcher(object):
     """Dispatches tasks to workers."""
 
     def __init__(self):
         """Initialize the publisher."""
-        self.nautilus_conn = Connection(Config.NAUTILUS_URL)
-        self.kraken_conn = Connection(Config.KRAKEN_URL)
+        # worker type -> hash ring of its broker connections
+        self.brokers = {}
+        for worker_type in Config.WORKER_TYPES:
+            urls = Config.WORKER_BROKERS.get(worker_type) or \
+                [getattr(Config, '{}_URL'.format(worker_type.upper()))]
+            self.brokers[worker_type] = HashRing(
+                Connection(url) for url in urls)
+
+        self._exchanges = {}
+        # dedicated producer pools, per connection, when DISPATCH_POOLED
+        self._pools = {}
+        self.stats = {
+            'pool_waits': 0,
+            'pool_timeouts': 0,
+        }
+
+    @property
+    def kraken_conn(self):
+        """Return the first Kraken broker connection."""
+        return self.brokers['kraken'].nodes[0]
+
+    @kraken_conn.setter
+    def kraken_conn(self, connection):
+        self.brokers['kraken'] = HashRing([connection])
+
+    @property
+    def nautilus_conn(self):
+        """Return the first Nautilus broker connection."""
+        return self.brokers['nautilus'].nodes[0]
+
+    @nautilus_conn.setter
+    def nautilus_conn(self, connection):
+        self.brokers['nautilus'] = HashRing([connection])
 
     def format_payload(self, worker_type, payload):
         """Format the payload to match worker expectations."""
@@ -33,8 +117,11 @@ class EventDispatcher(object):
 
         return fixed_payload
 
-    def dispatch(self, task):
-        """Used to dispatch a task to the appropriate worker."""
+    def route(self, task):
+        """Return the worker type, connection, exchange name and routing key.
+
+        The routing attributes are removed from the task.
+        """
         if task is None:
             raise ValueError('Task cannot be None.')
 
@@ -42,30 +129,187 @@ class EventDispatcher(object):
         if worker_type is None:
             raise ValueError('Need to set an appropriate worker type.')
 
-        worker_connection = getattr(self, '{}_conn'.format(worker_type), None)
-        if worker_connection is None:
+        connection = self.get_connection(worker_type,
+                                         task.get('name') or task.get('id'))
+        if connection is None:
             raise ValueError('No connection for invalid worker type.')
 
         exchange_name = task.pop('exchange')
         if not exchange_name:
             exchange_name = worker_type
-        exchange = Exchange(exchange_name)
         routing_key = task.pop('routing_key')
         if not routing_key:
-            routing_key = getattr(Config, '{}_ROUTING_KEY'.format(worker_type.upper()))
+            routing_key = getattr(
+                Config, '{}_ROUTING_KEY'.format(worker_type.upper()),
+                worker_type)
+
+        return worker_type, connection, exchange_name, routing_key
+
+    def get_connection(self, worker_type, key=None):
+        """Return the broker connection of a worker type for a task key."""
+        ring = self.brokers.get(worker_type)
+        if ring is None:
+            return None
+        return ring.get(key if isinstance(key, basestring) else str(key))
+
+    def get_exchange(self, name):
+        """Return the exchange with the given name, built only once."""
+        exchange = self._exchanges.get(name)
+        if exchange is None:
+            exchange = self._exchanges[name] = Exchange(name)
+        return exchange
+
+    def acquire_producer(self, connection):
+        """Acquire a producer for a connection.
 
-        logger.debug('Dispatcher: connection: %s, exchange: %s, routing_key: %s',
+        With DISPATCH_POOLED set, producers come from a pool dedicated to
+        the connection, holding up to DISPATCH_POOL_SIZE long lived
+        channels. Acquiring waits at most DISPATCH_ACQUIRE_TIMEOUT
+        seconds, waits and timeouts are counted in stats.
+        """
+        if not Config.DISPATCH_POOLED:
+            return producers[connection].acquire(block=True)
+
+        pool = self._pools.get(connection)
+        if pool is None:
+            pool = self._pools[connection] = ProducerPool(
+                connection.Pool(limit=Config.DISPATCH_POOL_SIZE),
+                limit=Config.DISPATCH_POOL_SIZE)
+        try:
+            return pool.acquire(block=False)
+        except LimitExceeded:
+            self.stats['pool_waits'] += 1
+        try:
+            return pool.acquire(block=True,
+                                timeout=Config.DISPATCH_ACQUIRE_TIMEOUT)
+        except LimitExceeded:
+            self.stats['pool_timeouts'] += 1
+            raise
+
+    def prepare(self, task):
+        """Route, format and serialize a task, once for all its runs.
+
+        The message does not change as long as the task is not updated,
+        so the scheduler keeps it and publishes the encoded body as is.
+        """
+        destination = self.route(task)
+        payload = self.format_payload(destination[0], task)
+        content_type, content_encoding, body = dumps(
+            payload, serializer=Config.DISPATCH_SERIALIZER)
+        return PreparedMessage(destination, body,
+                               content_type, content_encoding)
+
+    def dispatch(self, task):
+        """Used to dispatch a task to the appropriate worker.
+
+        The task is either a dict or a message returned by prepare.
+        """
+        if not isinstance(task, PreparedMessage):
+            task = self.prepare(task)
+        worker_type, worker_connection, exchange_name, routing_key = \
+            task.destination
+        exchange = self.get_exchange(exchange_name)
+
+        logger.debug('Dispatcher: connection: %s, exchange: %s, '
+                     'routing_key: %s',
                      worker_connection.__class__, exchange, routing_key)
 
-        with producers[worker_connection].acquire(block=True) as producer:
-            logger.debug('Dispatcher: Sending task %s:%s to %s',
-                    task.get('task'),
-                    task.get('kwargs', {}).get('method', ''),
-                    worker_type)
-            producer.publish(
-                self.format_payload(worker_type, task),
-                exchange=exchange,
-                routing_key=routing_key
-            )
+        with self.acquire_producer(worker_connection) as producer:
+            logger.debug('Dispatcher: Sending task to %s', worker_type)
+            self.publish(producer, task, exchange, routing_key)
+
+    def dispatch_many(self, tasks):
+        """Dispatch several tasks, grouped by destination.
+
+        Tasks are dicts or messages returned by prepare. Each group of
+        tasks going to the same worker type, broker, exchange and
+        routing key is published on one producer. With DISPATCH_CONFIRM
+        set, the broker confirms are waited for once per group, after
+        all its messages are sent. Tasks that cannot be routed or
+        formatted are logged and skipped.
+        Return the number of sent tasks.
+        """
+        groups = {}
+        for task in tasks:
+            if not isinstance(task, PreparedMessage):
+                try:
+                    task = self.prepare(task)
+                except (ValueError, TypeError, KeyError) as exc:
+                    logger.error('Dispatcher: cannot send task %s: %s',
+                                 task and task.get('name'), exc)
+                    continue
+            groups.setdefault(task.destination, []).append(task)
+
+        sent = 0
+        for destination, messages in groups.items():
+            _, connection, exchange_name, routing_key = destination
+            try:
+                self.publish_group(connection,
+                                   self.get_exchange(exchange_name),
+                                   routing_key, messages)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Dispatcher: cannot send %s tasks to %s: %s',
+                             len(messages), destination, exc, exc_info=True)
+            else:
+                sent += len(messages)
+        logger.debug('Dispatcher: sent %s tasks in %s groups',
+                     sent, len(groups))
+        return sent
+
+    def publish_group(self, connection, exchange, routing_key, messages):
+        """Publish a group of prepared messages on one producer."""
+        with self.acquire_producer(connection) as producer:
+            channel = producer.channel
+            confirm = Config.DISPATCH_CONFIRM and \
+                hasattr(channel, 'confirm_select')
+            if confirm:
+                self.enable_confirms(channel)
+            for message in messages:
+                self.publish(producer, message, exchange, routing_key)
+            if confirm:
+                self.wait_confirms(channel)
+
+    def publish(self, producer, message, exchange, routing_key):
+        """Publish one encoded message.
+
+        The message is counted on the channels with publisher confirms.
+        """
+        producer.publish(message.body, exchange=exchange,
+                         routing_key=routing_key,
+                         content_type=message.content_type,
+                         content_encoding=message.content_encoding)
+        if getattr(producer.channel, 'tentacle_sent', None) is not None:
+            producer.channel.tentacle_sent += 1
+
+    def enable_confirms(self, channel):
+        """Put a channel in confirm mode, keeping track of the acked tags."""
+        if getattr(channel, 'tentacle_sent', None) is not None:
+            return
+
+        def on_ack(delivery_tag, multiple):
+            channel.tentacle_acked = max(channel.tentacle_acked, delivery_tag)
+
+        channel.tentacle_acked = 0
+        channel.events['basic_ack'].add(on_ack)
+        channel.confirm_select()
+        channel.tentacle_sent = 0
+
+    def wait_confirms(self, channel):
+        """Wait until the broker confirmed all the messages of a channel.
+
+        A nack raises amqp.exceptions.NotConfirmed, and confirms still
+        missing after DISPATCH_CONFIRM_TIMEOUT seconds raise
+        socket.timeout.
+        """
+        deadline = time.time() + Config.DISPATCH_CONFIRM_TIMEOUT
+        while channel.tentacle_acked < channel.tentacle_sent:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout(
+                    '{} messages not confirmed after {}s'.format(
+                        channel.tentacle_sent - channel.tentacle_acked,
+                        Config.DISPATCH_CONFIRM_TIMEOUT))
+            channel.wait(CONFIRM_METHODS, timeout=remaining)
+
 
 event_dispatcher = EventDispatcher()
@@ -2,7 +2,7 @@
 from celery import current_app
 
 from taskmodel import TaskModel
-from . import get_logger
+from . import Config, get_logger
 
 logger = get_logger('tentacle')
 
@@ -68,42 +68,190 @@ def delete(msg):
     return u'ok'
 
 
+def bulk_write(tasks, results):
+    """Write the valid tasks of a bulk request with one put_many call.
+
+    results holds the result of each task, the ones of the tasks that
+    could not be written are changed to nok.
+    """
+    items = dict((task.name, task.to_dict())
+                 for task in tasks if task is not None)
+    try:
+        failed = set(app.event_store.put_many(items))
+    except Exception:  # pylint: disable=broad-except
+        logger.error('Bulk write failed.', exc_info=True)
+        failed = set(items)
+
+    for index, task in enumerate(tasks):
+        if task is not None and task.name in failed:
+            results[index] = u'nok'
+    return results
+
+
+@app.task
+def bulk_put(msg):
+    """Endpoint used to register a list of events at once.
+
+    Return the ok or nok result of each event, in order.
+    """
+    if not isinstance(msg, list):
+        return u'nok'
+
+    tasks = []
+    results = []
+    for item in msg:
+        try:
+            tasks.append(TaskModel(**item))
+            results.append(u'ok')
+        except (ValueError, TypeError):
+            logger.error('Bad task received: %s', item)
+            tasks.append(None)
+            results.append(u'nok')
+
+    return bulk_write(tasks, results)
+
+
+@app.task
+def bulk_update(msg):
+    """Endpoint used to update a list of registered events at once.
+
+    Return the ok or nok result of each event, in order.
+    """
+    if not isinstance(msg, list):
+        return u'nok'
+
+    names = [item.get('name') for item in msg if isinstance(item, dict)]
+    existing = app.event_store.get_many(name for name in names
+                                        if name is not None)
+
+    tasks = []
+    results = []
+    for item in msg:
+        name = item.get('name') if isinstance(item, dict) else None
+        if name is None or name not in existing:
+            logger.error('Cannot find task with id %s to update.', name)
+            tasks.append(None)
+            results.append(u'nok')
+            continue
+        try:
+            tasks.append(TaskModel(**item))
+            results.append(u'ok')
+        except (ValueError, TypeError):
+            logger.error('Cannot update. Bad task received: %s', item)
+            tasks.append(None)
+            results.append(u'nok')
+
+    return bulk_write(tasks, results)
+
+
+@app.task
+def bulk_delete(msg):
+    """Endpoint used to delete a list of registered events at once.
+
+    Return the ok or nok result of each event, in order.
+    """
+    if not isinstance(msg, list):
+        return u'nok'
+
+    names = [item.get('name') if isinstance(item, dict) else None
+             for item in msg]
+    try:
+        failed = set(app.event_store.delete_many(
+            [name for name in names if name is not None]))
+    except Exception:  # pylint: disable=broad-except
+        logger.error('Bulk delete failed.', exc_info=True)
+        failed = set(names)
+
+    return [u'nok' if name is None or name in failed else u'ok'
+            for name in names]
+
+
+def paginated(msg):
+    """Check if a list request asks for a page of the results."""
+    return isinstance(msg, dict) and ('limit' in msg or 'cursor' in msg)
+
+
+def page_limit(msg):
+    """Return the page size asked by a list request, None if invalid."""
+    limit = msg.get('limit')
+    if limit is None:
+        return Config.ENDPOINT_PAGE_SIZE
+    if isinstance(limit, bool) or not isinstance(limit, (int, long)) or \
+            limit < 1:
+        return None
+    return min(limit, Config.ENDPOINT_MAX_PAGE_SIZE)
+
+
+def get_page(msg, field=None, value=None, limit=None):
+    """Return the page of events asked by a list request.
+
+    The page holds at most limit events, by default the limit of the
+    request, and the cursor of the next page, None after the last one.
+    An empty cursor asks for the first page.
+    """
+    limit = limit or page_limit(msg)
+    events, cursor = app.event_store.scan_page(msg.get('cursor') or None,
+                                               limit, field, value)
+    return {'items': [item.to_dict() for item in events], 'cursor': cursor}
+
+
 @app.task
 def search(msg):
     """Endpoint used to retrieve a filtered list of registered events.
 
     The query options are: task name, worker type.
+    With a limit or a cursor, returns a page of the results.
     """
     if 'task_name' not in msg and 'worker_type' not in msg:
         return u'nok'
+    if paginated(msg) and page_limit(msg) is None:
+        return u'nok'
 
     task_name = msg.get('task_name', None)
     worker_type = msg.get('worker_type', None)
-    events = app.event_store.all()
 
-    results = []
-    for item in events:
-        appendable = False
-        if task_name is not None and item.name == task_name:
-            appendable = True
-        if worker_type is not None and item.worker_type == worker_type:
-            appendable = True
+    # the task name is the store key, the worker type is indexed
+    events = []
+    if task_name is not None and msg.get('cursor') is None:
+        item = app.event_store.get(task_name)
+        if item is not None:
+            events.append(item.to_dict())
 
-        if appendable:
-            results.append(item.to_dict())
+    if paginated(msg):
+        if worker_type is None:
+            return {'items': events, 'cursor': None}
+        # the task found by name comes in the pages of its worker type,
+        # or first on the first page, in place of one of these tasks
+        events = [item for item in events
+                  if item['worker_type'] != worker_type]
+        limit = page_limit(msg) - len(events)
+        if not limit:
+            # the empty cursor starts the worker type tasks
+            return {'items': events, 'cursor': u''}
+        page = get_page(msg, 'worker_type', worker_type, limit)
+        page['items'] = events + page['items']
+        return page
 
-    return results
+    if worker_type is not None:
+        events.extend(item.to_dict() for item in
+                      app.event_store.find('worker_type', worker_type)
+                      if item.name != task_name)
+    return events
 
 
 @app.task
 def all(msg):
     """Endpoint used to retrieve a list with all the registered events.
 
+    With a limit or a cursor, returns a page of the events.
     """
-    events = app.event_store.all()
+    if paginated(msg):
+        if page_limit(msg) is None:
+            return u'nok'
+        return get_page(msg)
 
     results = []
-    for item in events:
+    for item in app.event_store.iter_all():
         results.append(item.to_dict())
 
     return results
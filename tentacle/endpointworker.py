@@ -1,7 +1,12 @@
 """Worker used to handle changes in the event repository."""
+import threading
+import traceback
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from celery import Celery
 from celery import bootsteps
+from celery.app.task import Context
 from siren.serializers import (json_loads, msgpack_loads, json_dumps,
                                msgpack_dumps)
 from kombu.serialization import register
@@ -9,7 +14,8 @@ from kombu import Consumer, Queue
 
 from . import Config, get_logger
 from store import get_event_store
-from endpointtasks import put, get, update, delete, search
+from endpointtasks import (put, get, update, delete, search,
+                           bulk_put, bulk_update, bulk_delete)
 
 logger = get_logger('tentacle')
 
@@ -28,6 +34,48 @@ class EndpointConsumer(bootsteps.ConsumerStep):
     http://celery.readthedocs.org/en/latest/userguide/extending.html
     """
 
+    # inline execution thread pool and the messages it processed
+    pool = None
+    acks = ()
+    # event loop of the consumer, None for the pools without one
+    hub = None
+    _ack_lock = threading.Lock()
+
+    def start(self, c):
+        """Overriding class method.
+
+        With ENDPOINT_INLINE_EXECUTION set, the endpoints run in a local
+        thread pool instead of being sent back to the broker as tasks.
+        The processed messages are acked from the event loop of the
+        consumer, as channels cannot be shared between threads. Without
+        an event loop, they are acked as soon as they are processed,
+        one flush at a time.
+        """
+        if Config.ENDPOINT_INLINE_EXECUTION and self.pool is None:
+            # the current app is thread local, the endpoints need this one
+            self.pool = ThreadPool(Config.ENDPOINT_INLINE_THREADS,
+                                   initializer=app.set_current)
+            self.acks = deque()
+            self.hub = c.hub
+            if self.hub is not None:
+                self.hub.call_repeatedly(Config.ENDPOINT_ACK_INTERVAL,
+                                         self.flush_acks)
+        bootsteps.ConsumerStep.start(self, c)
+
+    def stop(self, c):
+        """Overriding class method."""
+        self.flush_acks()
+        bootsteps.ConsumerStep.stop(self, c)
+
+    def shutdown(self, c):
+        """Overriding class method."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.flush_acks()
+        bootsteps.ConsumerStep.shutdown(self, c)
+
     def get_consumers(self, channel):
         """Overriding class method."""
         return [Consumer(channel,
@@ -46,6 +94,11 @@ class EndpointConsumer(bootsteps.ConsumerStep):
             # message does not have an action, reject it
             logger.info('Received msg with no action. Rejecting it.')
             message.reject()
+        elif 'tentacle.endpointtasks.{}'.format(payload['action']) \
+                not in app.tasks:
+            logger.info('Received msg with unknown action <%s>. Rejecting it.',
+                        payload['action'])
+            message.reject()
         else:
             action = payload.get('action')
             task_payload = payload.get('task')
@@ -54,12 +107,60 @@ class EndpointConsumer(bootsteps.ConsumerStep):
             logger.debug('Active tasks: %s',
                          ','.join(item for item in app.tasks))
 
-            app.tasks['tentacle.endpointtasks.' + action].apply_async(
+            task = app.tasks['tentacle.endpointtasks.' + action]
+            if self.pool is not None:
+                # without a hub, the acks are flushed once processed
+                self.pool.apply_async(self.run_inline,
+                                      (message, task, task_payload,
+                                       payload.get('id')),
+                                      callback=self.on_processed)
+                return
+
+            task.apply_async(
                 args=(task_payload,),
                 task_id=payload.get('id'),
                 reply_to=payload.get('id'))
             message.ack()
 
+    def run_inline(self, message, task, task_payload, task_id):
+        """Run an endpoint in the thread pool and send its rpc reply.
+
+        The message is queued for ack once the reply is sent.
+        """
+        request = Context(id=task_id, reply_to=task_id,
+                          correlation_id=task_id, children=[])
+        try:
+            try:
+                result = task(task_payload)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error('Endpoint %s failed: %s', task.name, exc,
+                             exc_info=True)
+                app.backend.mark_as_failure(task_id, exc,
+                                            traceback.format_exc(),
+                                            request=request)
+            else:
+                app.backend.mark_as_done(task_id, result, request=request)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error('Cannot reply to <%s>: %s', task_id, exc,
+                         exc_info=True)
+        finally:
+            self.acks.append(message)
+
+    def on_processed(self, result):
+        """Ack the processed messages, for the workers without a hub."""
+        if self.hub is None:
+            self.flush_acks()
+
+    def flush_acks(self):
+        """Ack the messages processed by the thread pool."""
+        with self._ack_lock:
+            while self.acks:
+                message = self.acks.popleft()
+                try:
+                    message.ack()
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error('Cannot ack message: %s', exc)
+
 
 app = Celery('tentacle')
 app.steps['consumer'].add(EndpointConsumer)
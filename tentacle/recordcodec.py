@@ -0,0 +1,168 @@
+"""Compact encoding of the task records kept in Aerospike bins.
+
+Version 1 records keep the fields read on every schedule update in
+their own bins, under the same names as the legacy records, and pack
+all the other fields in one msgpack payload bin, compressed with zlib
+above a size threshold. The version bin tells the formats apart,
+records without it use the legacy layout of one bin per field.
+"""
+
+import calendar
+import datetime
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from pytz import utc
+
+from taskmodel import TaskModel
+
+# version of the legacy records, without a version bin
+LEGACY_FORMAT = 0
+COMPACT_FORMAT = 1
+
+VERSION_BIN = 'v'
+PAYLOAD_BIN = 'payload'
+
+# record keys stored in their own bins
+HOT_BINS = ('name', 'task', 'worker_type', 'enabled', 'exchange',
+            'routing_key', 'last_run_at', 'totalruncount')
+# hot bins holding booleans, stored as integers for the secondary indexes
+BOOL_BINS = ('enabled',)
+# values Aerospike stores natively, others are packed in a bytes bin
+NATIVE_TYPES = (str, unicode, int, long, float)
+
+# first byte of the payload
+RAW = b'\x00'
+COMPRESSED = b'\x01'
+
+# msgpack extension type of the datetimes
+DATETIME_EXT = 1
+# epoch microseconds and timezone awareness
+DATETIME_STRUCT = struct.Struct('>q?')
+
+
+def pack_default(value):
+    """Pack the values msgpack does not support, only datetimes.
+
+    Aware datetimes are converted to UTC.
+    """
+    if isinstance(value, datetime.datetime):
+        micros = (calendar.timegm(value.utctimetuple()) * 10 ** 6 +
+                  value.microsecond)
+        return msgpack.ExtType(DATETIME_EXT, DATETIME_STRUCT.pack(
+            micros, value.tzinfo is not None))
+    raise TypeError('Cannot pack {!r} in a record.'.format(value))
+
+
+def unpack_ext(code, data):
+    """Unpack the values packed by pack_default."""
+    if code != DATETIME_EXT:
+        return msgpack.ExtType(code, data)
+    micros, aware = DATETIME_STRUCT.unpack(data)
+    value = datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(microseconds=micros)
+    if aware:
+        value = value.replace(tzinfo=utc)
+    return value
+
+
+def pack(value):
+    """Serialize a value with msgpack."""
+    return msgpack.packb(value, default=pack_default, use_bin_type=True)
+
+
+def unpack(data):
+    """Deserialize a value packed with pack."""
+    return msgpack.unpackb(bytes(data), ext_hook=unpack_ext,
+                           encoding='utf-8')
+
+
+def encode_bin(key, value):
+    """Return the bin value of a hot record key."""
+    if key in BOOL_BINS and isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, NATIVE_TYPES):
+        return value
+    return bytearray(pack(value))
+
+
+def decode_bin(key, value):
+    """Return the record value of a hot bin."""
+    if isinstance(value, bytearray):
+        return unpack(value)
+    if key in BOOL_BINS and value is not None:
+        return bool(value)
+    return value
+
+
+def encode(record, version=COMPACT_FORMAT, threshold=0):
+    """Return the bins of a task record.
+
+    The payload is compressed when its size is over threshold bytes,
+    0 disables the compression. Writes merge the bins into the stored
+    record, so the bins the format does not use are set to None, to be
+    removed: the unset hot bins and the legacy bins of compact records,
+    the version and payload bins of legacy records.
+    """
+    if not isinstance(record, dict):
+        return record
+    if version == LEGACY_FORMAT:
+        bins = dict(record)
+        bins.update({VERSION_BIN: None, PAYLOAD_BIN: None})
+        return bins
+    if msgpack is None:
+        raise ImportError('msgpack is required by the compact records.')
+
+    bins = dict.fromkeys(set(TaskModel.record_keys) | set(HOT_BINS))
+    bins[VERSION_BIN] = version
+    cold = {}
+    for key, value in record.items():
+        # missing fields are decoded as None
+        if value is None:
+            continue
+        if key in HOT_BINS:
+            bins[key] = encode_bin(key, value)
+        else:
+            cold[key] = value
+
+    payload = pack(cold)
+    if threshold and len(payload) > threshold:
+        payload = COMPRESSED + zlib.compress(payload)
+    else:
+        payload = RAW + payload
+    bins[PAYLOAD_BIN] = bytearray(payload)
+    return bins
+
+
+def decode(bins):
+    """Return the task record held by the bins of any record version."""
+    if not isinstance(bins, dict):
+        return bins
+    if bins.get(VERSION_BIN) is None:
+        # legacy records get packed bins from partial updates of
+        # compact writers
+        packed = [key for key in HOT_BINS
+                  if isinstance(bins.get(key), bytearray)]
+        if packed:
+            bins = dict(bins)
+            for key in packed:
+                bins[key] = decode_bin(key, bins[key])
+        return bins
+    if msgpack is None:
+        raise ImportError('msgpack is required by the compact records.')
+
+    record = dict.fromkeys(TaskModel.record_keys)
+    for key in HOT_BINS:
+        record[key] = decode_bin(key, bins.get(key))
+    payload = bins.get(PAYLOAD_BIN)
+    if payload:
+        payload = bytes(payload)
+        if payload[:1] == COMPRESSED:
+            record.update(unpack(zlib.decompress(payload[1:])))
+        else:
+            record.update(unpack(payload[1:]))
+    return record
@@ -1,13 +1,23 @@
 """Event scheduler."""
 
 import datetime
+import heapq
+import math
+import os
+import socket
+import time
 import traceback
 
 from celery.beat import Scheduler, ScheduleEntry
 from celery import current_app
+from pytz import utc
 
 from store import get_event_store
-from dispatcher import event_dispatcher
+from storebackend import StoreUnavailable
+from dispatcher import HashRing, event_dispatcher
+from crontabengine import CrontabEngine, numpy, to_timestamp
+from scheduletable import ScheduleTable
+from taskmodel import Crontab, Interval, TaskModel
 from . import Config, get_logger
 
 
@@ -16,6 +26,214 @@ logger = get_logger('tentacle')
 event_store = get_event_store()
 
 
+def task_changed(old, new):
+    """Check if a task was changed, ignoring the run bookkeeping."""
+    ignored = ('last_run_at', 'totalruncount')
+    old_data, new_data = old.to_dict(), new.to_dict()
+    for item in ignored:
+        old_data.pop(item)
+        new_data.pop(item)
+    return old_data != new_data
+
+
+class ScheduleQueue(object):
+    """Keyed min-heap holding the next run time of each entry.
+
+    Rescheduling or removing an entry leaves its old item in the heap,
+    stale items are skipped once they reach the top.
+    """
+
+    def __init__(self):
+        """Initialize the queue."""
+        self._heap = []
+        # name: run time of the live heap item
+        self._due = {}
+
+    def __len__(self):
+        """Return the number of queued entries."""
+        return len(self._due)
+
+    def __contains__(self, name):
+        """Check if an entry is queued."""
+        return name in self._due
+
+    def push(self, name, when):
+        """Add an entry or change its run time."""
+        self._due[name] = when
+        heapq.heappush(self._heap, (when, name))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._compact()
+
+    def remove(self, name):
+        """Remove an entry from the queue."""
+        self._due.pop(name, None)
+
+    def next_time(self):
+        """Return the earliest run time, or None if the queue is empty."""
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def pop_due(self, now):
+        """Remove and return the names of the entries due at now."""
+        due = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            when, name = heapq.heappop(heap)
+            if self._due.get(name) == when:
+                del self._due[name]
+                due.append(name)
+        return due
+
+    def _compact(self):
+        """Drop the stale items from the heap."""
+        self._heap = [(when, name) for name, when in self._due.items()]
+        heapq.heapify(self._heap)
+
+
+class TimingWheel(object):
+    """Hierarchical timing wheel holding the next run time of each entry.
+
+    Level 0 has one slot per resolution tick, each next level has slots
+    that are SLOTS times wider. Entries are kept by name in the slot of
+    their run tick and cascade down one level when the wheel reaches
+    their slot. Same interface as ScheduleQueue: the exact run times are
+    kept, the slots only narrow down the entries to check, so the
+    entries are popped at their run time and not at their tick.
+    """
+
+    SLOT_BITS = 6
+    SLOTS = 1 << SLOT_BITS
+    LEVELS = 4
+
+    def __init__(self, resolution=None, start=None):
+        """Initialize the wheel, at start or at the current time."""
+        self.resolution = float(resolution or Config.TIMING_WHEEL_RESOLUTION)
+        self._wheels = [[[] for _ in range(self.SLOTS)]
+                        for _ in range(self.LEVELS)]
+        # entries with a run tick already reached, and beyond the last level
+        self._ready = set()
+        self._overflow = []
+        # name: run time of the live entry
+        self._due = {}
+        # all the ticks up to this one have been processed
+        self._current = self._tick(time.time() if start is None else start)
+
+    def __len__(self):
+        """Return the number of queued entries."""
+        return len(self._due)
+
+    def __contains__(self, name):
+        """Check if an entry is queued."""
+        return name in self._due
+
+    def push(self, name, when):
+        """Add an entry or change its run time."""
+        self._due[name] = when
+        self._place(name, self._tick(when))
+
+    def remove(self, name):
+        """Remove an entry from the wheel."""
+        self._due.pop(name, None)
+
+    def next_time(self):
+        """Return the earliest run time, or None if the wheel is empty.
+
+        Only the first level slots up to the next cascade are searched,
+        past them the time of the cascade is returned as a lower bound.
+        """
+        if not self._due:
+            return None
+        ready = [self._due[name] for name in self._ready
+                 if name in self._due and
+                 self._tick(self._due[name]) <= self._current]
+        if ready:
+            return min(ready)
+        level = self._wheels[0]
+        cascade = (self._current | (self.SLOTS - 1)) + 1
+        for tick in range(self._current + 1, cascade):
+            runs = [self._due[name] for name in level[tick & (self.SLOTS - 1)]
+                    if self._tick(self._due.get(name)) == tick]
+            if runs:
+                return min(runs)
+        return cascade * self.resolution
+
+    def pop_due(self, now):
+        """Remove and return the names of the entries due at now.
+
+        The names are returned in run time order.
+        """
+        target = int(math.floor(now / self.resolution))
+        if not self._due:
+            self._current = max(self._current, target)
+        while self._current < target:
+            self._current += 1
+            self._cascade(self._current)
+            slot = self._wheels[0][self._current & (self.SLOTS - 1)]
+            for name in slot:
+                if self._tick(self._due.get(name)) == self._current:
+                    self._ready.add(name)
+            del slot[:]
+
+        due = []
+        for name in list(self._ready):
+            when = self._due.get(name)
+            if when is None or self._tick(when) > self._current:
+                # removed, or pushed back to a later slot
+                self._ready.discard(name)
+            elif when <= now:
+                self._ready.discard(name)
+                del self._due[name]
+                due.append((when, name))
+        due.sort()
+        return [name for _, name in due]
+
+    def _tick(self, when):
+        """Return the tick of a run time, None for no run time."""
+        if when is None:
+            return None
+        return int(math.floor(when / self.resolution))
+
+    def _place(self, name, tick):
+        """Put the entry in the slot matching its run tick."""
+        delta = tick - self._current
+        if delta <= 0:
+            self._ready.add(name)
+            return
+        for level in range(self.LEVELS):
+            shift = self.SLOT_BITS * level
+            if delta < 1 << (shift + self.SLOT_BITS):
+                self._wheels[level][(tick >> shift) & (self.SLOTS - 1)] \
+                    .append(name)
+                return
+        self._overflow.append(name)
+
+    def _cascade(self, tick):
+        """Move the entries of the higher level slots starting at tick."""
+        top_shift = self.SLOT_BITS * (self.LEVELS - 1)
+        if tick & ((1 << top_shift) - 1) == 0:
+            overflow, self._overflow = self._overflow, []
+            for name in overflow:
+                if name in self._due:
+                    self._place(name, self._tick(self._due[name]))
+
+        for level in range(self.LEVELS - 1, 0, -1):
+            shift = self.SLOT_BITS * level
+            if tick & ((1 << shift) - 1):
+                continue
+            slot = self._wheels[level][(tick >> shift) & (self.SLOTS - 1)]
+            self._wheels[level][(tick >> shift) & (self.SLOTS - 1)] = []
+            self._replace(slot, tick, tick + (1 << shift))
+
+    def _replace(self, names, start, end):
+        """Place again the live entries with a run tick in [start, end)."""
+        for name in names:
+            tick = self._tick(self._due.get(name))
+            if tick is not None and start <= tick < end:
+                self._place(name, tick)
+
+
 class EventEntry(ScheduleEntry):
     """An entry model for the Celery Beat scheduler."""
 
@@ -47,6 +265,9 @@ class EventEntry(ScheduleEntry):
             self._task.last_run_at = self._default_now()
         self.last_run_at = self._task.last_run_at
 
+        # dispatcher message, built on the first run of the task
+        self._message = None
+
     def _default_now(self):
         return self.app.now()
 
@@ -55,10 +276,25 @@ class EventEntry(ScheduleEntry):
         self._task.last_run_at = self.app.now()
         self._task.total_run_count += 1
         self._task.run_immediately = False
-        return self.__class__(self._task)
+        entry = self.__class__(self._task)
+        entry._message = self._message
+        return entry
 
     __next__ = next
 
+    def next_run_time(self):
+        """Return the estimated epoch time of the next run.
+
+        Disabled tasks have no next run, they get a new entry when
+        they are re-enabled through the store.
+        """
+        if not self._task.enabled:
+            return None
+        if self._task.run_immediately:
+            return time.time()
+        remaining = self.schedule.remaining_estimate(self.last_run_at)
+        return time.time() + max(remaining.total_seconds(), 0)
+
     def is_due(self):
         """Check if the task is due."""
         if not self._task.enabled:
@@ -90,19 +326,29 @@ class EventEntry(ScheduleEntry):
                 self.last_run_at > self._task.last_run_at):
             self._task.last_run_at = self.last_run_at
         self._task.run_immediately = False
-        event_store.put(self.name, self._task.to_dict())
+        event_store.update(self.name, values={
+            'last_run_at': self._task.last_run_at,
+            'totalruncount': self._task.total_run_count,
+        })
 
 
 class EventScheduler(Scheduler):
     """A scheduler for Celery Beat."""
 
     Entry = EventEntry
+    Queue = ScheduleQueue
     dispatcher = event_dispatcher
 
     def __init__(self, *args, **kwargs):
         """Initialize the scheduler."""
         self._schedule = {}
         self._last_updated = None
+        self._last_full_update = None
+        self._change_token = None
+        # name: number of runs of the entries not yet in the store
+        self._dirty = {}
+        # next run times, kept across schedule updates
+        self._queue = self.Queue()
         Scheduler.__init__(self, *args, **kwargs)
         self.max_interval = (kwargs.get('max_interval') or
                              self.app.conf.CELERYBEAT_MAX_LOOP_INTERVAL)
@@ -115,15 +361,114 @@ class EventScheduler(Scheduler):
             datetime.timedelta(seconds=Config.DEFAULT_UPDATE_INTERVAL) \
             < datetime.datetime.now()
 
+    def requires_full_update(self):
+        """Check if the whole schedule should be reconciled with the store."""
+        if not Config.INCREMENTAL_UPDATE or not self._last_full_update:
+            return True
+        return self._last_full_update + \
+            datetime.timedelta(seconds=Config.FULL_UPDATE_INTERVAL) \
+            < datetime.datetime.now()
+
     def get_from_eventstore(self):
-        """Load all the events in the store."""
+        """Load the events in the store, patching the current schedule.
+
+        A full update loads every task and drops the ones no longer in the
+        store. An incremental update only loads the tasks changed since
+        the previous update.
+        """
         logger.debug('Updating schedule.')
         self.sync()
-        d = {}
-        for doc in event_store.all():
-            d[doc.name] = EventEntry(doc)
-        logger.debug('There are %s tasks on the schedule', len(d))
-        return d
+        token = event_store.change_token()
+        if self.requires_full_update():
+            changed = self.merge_entries(self.load_all(), prune=True)
+            self._last_full_update = datetime.datetime.now()
+        else:
+            changed = self.merge_entries(
+                self.load_changed(self._change_token))
+        self._change_token = token
+        logger.debug('There are %s tasks on the schedule, %s changed',
+                     len(self._schedule), changed)
+        return self._schedule
+
+    def load_all(self):
+        """Iterate over all the tasks in the store."""
+        return event_store.iter_all()
+
+    def load_changed(self, token):
+        """Return the tasks changed in the store after the token."""
+        return event_store.changed_since(token)
+
+    def merge_entries(self, docs, prune=False):
+        """Patch the schedule in place with the tasks loaded from the store.
+
+        Entries are only rebuilt for the tasks that actually changed,
+        keeping the run bookkeeping already held in memory.
+        Return the number of added or changed entries.
+        """
+        seen = set()
+        changed = []
+        for doc in docs:
+            seen.add(doc.name)
+            entry = self._schedule.get(doc.name)
+            if entry is not None:
+                if not task_changed(entry._task, doc):
+                    continue
+                if not doc.last_run_at or \
+                        doc.last_run_at < entry._task.last_run_at:
+                    doc.last_run_at = entry._task.last_run_at
+                    doc.total_run_count = entry._task.total_run_count
+            self._schedule[doc.name] = entry = self.Entry(doc)
+            changed.append(entry)
+        self.queue_entries(changed)
+
+        if prune:
+            for name in set(self._schedule) - seen:
+                del self._schedule[name]
+                self._queue.remove(name)
+        return len(changed)
+
+    def queue_entry(self, entry):
+        """Put the entry in the queue at its next run time."""
+        next_time = entry.next_run_time()
+        if next_time is None:
+            self._queue.remove(entry.name)
+        else:
+            self._queue.push(entry.name, next_time)
+
+    def queue_entries(self, entries):
+        """Put the entries in the queue at their next run times.
+
+        When numpy is available and the schedules run in UTC, the next
+        runs of all the crontab entries are computed at once by the
+        crontab engine.
+        """
+        use_engine = self.use_crontab_engine()
+        crontabs = []
+        for entry in entries:
+            if use_engine and \
+                    entry._task.crontab is not None and \
+                    entry._task.enabled and \
+                    not entry._task.run_immediately:
+                crontabs.append(entry)
+            else:
+                self.queue_entry(entry)
+        if not crontabs:
+            return
+
+        engine = CrontabEngine((entry.name, entry._task.crontab)
+                               for entry in crontabs)
+        runs = engine.next_runs([to_timestamp(entry.last_run_at)
+                                 for entry in crontabs])
+        for entry, next_time in zip(crontabs, runs):
+            if next_time == float('inf'):
+                self._queue.remove(entry.name)
+            else:
+                self._queue.push(entry.name, float(next_time))
+
+    def use_crontab_engine(self):
+        """Check if crontab run times can be computed by the engine."""
+        return (numpy is not None and self.app.conf.CELERY_ENABLE_UTC and
+                self.app.conf.CELERY_TIMEZONE in (None, 'UTC'))
 
     @property
     def schedule(self):
@@ -134,23 +479,475 @@ class EventScheduler(Scheduler):
         return self._schedule
 
     def sync(self):
-        """Dump the current schedule status to the event store."""
-        for entry in self._schedule.values():
-            entry.save()
+        """Write the run bookkeeping of the fired entries to the store.
+
+        Only the run count and last run time of the entries that ran
+        since the last sync are updated, all of them in one update_many
+        call, a batch write on the stores supporting them. The other
+        fields are left alone, so updates done meanwhile through the
+        endpoints are kept, and deleted tasks are not written back.
+        """
+        if not self._dirty:
+            return
+
+        start = time.time()
+        items = {}
+        for name, runs in self._dirty.items():
+            entry = self._schedule.get(name)
+            if entry is not None:
+                items[name] = ({'totalruncount': runs},
+                               {'last_run_at': entry._task.last_run_at})
+        failed = event_store.update_many(items)
+        self._dirty.clear()
+        if failed:
+            logger.debug('Scheduler: tasks %s not updated, deleted from '
+                         'the store?', ', '.join(failed))
+        logger.info('Scheduler: flushed %s records in %.3f seconds.',
+                    len(items), time.time() - start)
+
+    def reserve(self, entry):
+        """Advance the entry to its next run and mark it for sync."""
+        new_entry = self._schedule[entry.name] = next(entry)
+        self._dirty[entry.name] = self._dirty.get(entry.name, 0) + 1
+        return new_entry
+
+    def tick(self):
+        """Run one iteration of the scheduler.
+
+        Only the entries at the top of the queue are checked, the
+        cost is proportional to the number of due tasks. The due tasks
+        are sent together, at the end of the tick.
+        """
+        schedule = self.schedule
+        now = time.time()
+        due = []
+        for name in self._queue.pop_due(now):
+            entry = schedule.get(name)
+            if entry is None:
+                continue
+            is_due, next_time_to_run = entry.is_due()
+            if is_due:
+                entry = self.reserve(entry)
+                due.append(entry)
+            if next_time_to_run and entry._task.enabled:
+                self._queue.push(name, now + next_time_to_run)
+        if due:
+            self.dispatch_entries(due)
+
+        next_time = self._queue.next_time()
+        if next_time is None:
+            return self.max_interval
+        return min(max(next_time - time.time(), 0), self.max_interval)
+
+    def prepare(self, entry):
+        """Return the dispatcher message of an entry, built only once.
+
+        Updated tasks get new entries, so the message is rebuilt then.
+        """
+        if entry._message is None:
+            entry._message = self.dispatcher.prepare(entry._task.to_dict())
+        return entry._message
+
+    def dispatch_entries(self, entries):
+        """Send a batch of reserved entries to their workers."""
+        messages = []
+        for entry in entries:
+            logger.info('Scheduler: Sending task %s (%s)', entry.name, entry.task)
+            try:
+                messages.append(self.prepare(entry))
+            except (ValueError, TypeError, KeyError) as exc:
+                logger.error('Scheduler: cannot send task %s: %s',
+                             entry.name, exc)
+
+        try:
+            sent = self.dispatcher.dispatch_many(messages)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error('Message Error: %s\n%s',
+                         exc, traceback.format_stack(), exc_info=True)
+        else:
+            logger.debug('%s of %s due tasks sent', sent, len(entries))
 
     def maybe_due(self, entry, publisher=None):
-        """Dispatch a task for execution."""
+        """Dispatch a task for execution if it is due.
+
+        This is the celery Scheduler hook, tick goes through the queue
+        instead. Its callers pass any entry, not only the ones popped
+        from the queue, so the entry itself tells if it is due. Due
+        entries are sent through dispatch_entries, like the ones of
+        tick, and their next run is queued, so tick does not wake up
+        for them too early.
+        """
         is_due, next_time_to_run = entry.is_due()
 
         if is_due:
-            logger.info('Scheduler: Sending task %s (%s)', entry.name, entry.task)
+            # update the run bookkeeping before sending, so a failing
+            # task does not get sent on every tick
+            entry = self.reserve(entry)
+            self.dispatch_entries([entry])
+            if next_time_to_run and entry._task.enabled:
+                self._queue.push(entry.name, time.time() + next_time_to_run)
 
-            try:
-                self.dispatcher.dispatch(entry._task.to_dict())
-            except Exception as exc:  # pylint: disable=broad-except
-                logger.error('Message Error: %s\n%s',
-                             exc, traceback.format_stack(), exc_info=True)
+        return next_time_to_run
+
+
+class WheelScheduler(EventScheduler):
+    """A scheduler for Celery Beat that keeps run times in a timing wheel.
+
+    Meant for very large schedules of short interval tasks, where
+    pushing to and popping from a heap gets too expensive.
+    """
+
+    Queue = TimingWheel
+
+
+def shard_of(name):
+    """Return the shard of a task name."""
+    return HashRing.hash(name) % Config.SCHEDULER_SHARDS
+
+
+class PartitionedScheduler(EventScheduler):
+    """A scheduler for Celery Beat sharing the tasks with its peers.
+
+    The task names are hashed to SCHEDULER_SHARDS shards, and the shards
+    to the live schedulers by consistent hashing of their names, so the
+    shards move as little as possible when a scheduler joins or dies.
+    A scheduler only runs the shards it holds a lease on in the store;
+    on every schedule update it renews its membership and its leases,
+    releases the shards now meant for others and takes the free ones
+    meant for it.
+
+    A shard stops being run SCHEDULER_LEASE_MARGIN seconds before its
+    lease expires, and the runs are written to the store before the
+    tasks are sent, so the next owner of a shard starts from the last
+    run of every task. Tasks are not sent while the store is unavailable.
+    """
+
+    member_prefix = 'member:'
+    shard_prefix = 'shard:'
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the scheduler."""
+        self.member = Config.SCHEDULER_MEMBER or \
+            '{}:{}'.format(socket.gethostname(), os.getpid())
+        # shard: time until which it can be run
+        self._shards = {}
+        EventScheduler.__init__(self, *args, **kwargs)
+
+    def owns(self, name, now=None):
+        """Check if the task of a name can be run by this scheduler."""
+        deadline = self._shards.get(shard_of(name))
+        return deadline is not None and deadline > (now or time.time())
+
+    def rebalance(self):
+        """Renew the membership and leases of this scheduler.
+
+        Return the shards newly acquired.
+        """
+        ttl = Config.SCHEDULER_LEASE_TTL
+        start = time.time()
+        deadline = start + ttl - Config.SCHEDULER_LEASE_MARGIN
+        event_store.acquire_lease(self.member_prefix + self.member,
+                                  self.member, ttl)
+        members = sorted(set(
+            owner for name, owner in event_store.leases().items()
+            if name.startswith(self.member_prefix)) | set([self.member]))
+        ring = HashRing(members, replicas=Config.SCHEDULER_RING_REPLICAS,
+                        names=members)
+
+        acquired = []
+        for shard in range(Config.SCHEDULER_SHARDS):
+            name = '{}{}'.format(self.shard_prefix, shard)
+            if ring.get(str(shard)) != self.member:
+                if self._shards.pop(shard, None) is not None:
+                    event_store.release_lease(name, self.member)
+            elif event_store.acquire_lease(name, self.member, ttl):
+                if shard not in self._shards:
+                    acquired.append(shard)
+                self._shards[shard] = deadline
             else:
-                logger.debug('%s sent', entry.task)
+                self._shards.pop(shard, None)
+        logger.debug('Scheduler: %s of %s members, running %s shards.',
+                     self.member, len(members), len(self._shards))
+        return acquired
 
-        return next_time_to_run
+    def get_from_eventstore(self):
+        """Rebalance the shards, then load the tasks of the owned ones.
+
+        Newly acquired shards need a full update, to load their tasks.
+        A failed rebalance keeps the current leases until they expire.
+        """
+        self.sync()
+        try:
+            if self.rebalance():
+                self._last_full_update = None
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error('Scheduler: cannot renew the shard leases: %s', exc)
+
+        schedule = EventScheduler.get_from_eventstore(self)
+        for name in [name for name in schedule if not self.owns(name)]:
+            del schedule[name]
+            self._queue.remove(name)
+        return schedule
+
+    def load_all(self):
+        """Iterate over the tasks of the owned shards."""
+        return (doc for doc in EventScheduler.load_all(self)
+                if self.owns(doc.name))
+
+    def load_changed(self, token):
+        """Return the changed tasks of the owned shards."""
+        return [doc for doc in EventScheduler.load_changed(self, token)
+                if self.owns(doc.name)]
+
+    def maybe_due(self, entry, publisher=None):
+        """Dispatch the task of an owned entry if it is due."""
+        if not self.owns(entry.name):
+            return entry.is_due()[1]
+        return EventScheduler.maybe_due(self, entry, publisher)
+
+    def dispatch_entries(self, entries):
+        """Record the runs of the owned entries, then send them.
+
+        The ownership is checked again once the runs are recorded, as a
+        slow sync can outlast the lease margin and let a peer take the
+        shards and send the same tasks.
+        """
+        now = time.time()
+        owned = []
+        for entry in entries:
+            if self.owns(entry.name, now):
+                owned.append(entry)
+            else:
+                logger.warning('Scheduler: lease of task %s lost, not '
+                               'sending it.', entry.name)
+                self._dirty.pop(entry.name, None)
+        try:
+            self.sync()
+        except StoreUnavailable as exc:
+            logger.error('Scheduler: cannot record the runs, not sending '
+                         '%s tasks: %s', len(owned), exc)
+            return
+        if not event_store.available():
+            logger.error('Scheduler: store unavailable, not sending %s '
+                         'tasks.', len(owned))
+            return
+        now = time.time()
+        sending = [entry for entry in owned if self.owns(entry.name, now)]
+        if len(sending) < len(owned):
+            logger.warning('Scheduler: leases lost while recording the '
+                           'runs, not sending %s tasks.',
+                           len(owned) - len(sending))
+        EventScheduler.dispatch_entries(self, sending)
+
+    def close(self):
+        """Sync and give up the leases, so peers take over at once."""
+        EventScheduler.close(self)
+        try:
+            for shard in list(self._shards):
+                event_store.release_lease(
+                    '{}{}'.format(self.shard_prefix, shard), self.member)
+            event_store.release_lease(self.member_prefix + self.member,
+                                      self.member)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error('Scheduler: cannot release the leases: %s', exc)
+        self._shards.clear()
+
+
+def record_changed(old, new):
+    """Check if a store record was changed, ignoring the run bookkeeping."""
+    ignored = ('last_run_at', 'totalruncount')
+    return (set(old) - set(ignored) != set(new) - set(ignored) or
+            any(old[key] != new[key] for key in old if key not in ignored))
+
+
+class TableScheduler(EventScheduler):
+    """A scheduler for Celery Beat that keeps its schedule in arrays.
+
+    The tasks are rows of a ScheduleTable, holding their store record
+    and the columns needed to find the due ones. Due tasks and their
+    next runs are found with array operations, TaskModel objects are
+    only built to prepare the messages of the tasks that fire.
+    The schedule maps the task names to their store records.
+    Requires numpy.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the scheduler."""
+        self._table = ScheduleTable()
+        EventScheduler.__init__(self, *args, **kwargs)
+        self._schedule = self._table
+
+    def load_all(self):
+        """Iterate over the records of all the tasks in the store."""
+        return event_store.iter_all_raw()
+
+    def load_changed(self, token):
+        """Return the records of the tasks changed after the token."""
+        return event_store.changed_since_raw(token)
+
+    def update_from_dict(self, dict_):
+        """Ignore the entries not coming from the store."""
+        if dict_:
+            logger.warning('Scheduler: ignoring entries %s, only the '
+                           'store tasks are scheduled.', ', '.join(dict_))
+
+    def merge_entries(self, docs, prune=False):
+        """Patch the table in place with the records loaded from the store.
+
+        Rows are only replaced for the tasks that actually changed,
+        keeping the run bookkeeping already held in memory.
+        Return the number of added or changed rows.
+        """
+        table = self._table
+        seen = set()
+        changed = []
+        for record in docs:
+            name = record['name']
+            seen.add(name)
+            row = table.rows.get(name)
+            last_run_at = self.to_epoch(record.get('last_run_at'))
+            run_count = record.get('totalruncount') or 0
+            if row is not None:
+                if not record_changed(table.records[row], record):
+                    continue
+                if not last_run_at or last_run_at < table.last_run_at[row]:
+                    last_run_at = table.last_run_at[row]
+                    run_count = table.run_count[row]
+            if not last_run_at:
+                last_run_at = time.time()
+
+            period = float('nan')
+            if record.get('interval'):
+                period = Interval.from_record(record['interval']) \
+                    .schedule.run_every.total_seconds()
+            elif not record.get('crontab'):
+                logger.error('Scheduler: task %s has no schedule', name)
+                continue
+            table.set(name, record, last_run_at=last_run_at, period=period,
+                      run_count=run_count, enabled=bool(record.get('enabled')),
+                      worker_type=record.get('worker_type'))
+            changed.append(name)
+
+        if prune:
+            for name in set(table.rows) - seen:
+                table.remove(name)
+        self.update_next_runs(numpy.array(
+            [table.rows[name] for name in changed], dtype=numpy.int64))
+        return len(changed)
+
+    def update_next_runs(self, rows):
+        """Compute the next runs of the given rows from their last runs."""
+        table = self._table
+        period = table.period[rows]
+        intervals = ~numpy.isnan(period)
+        table.next_run[rows[intervals]] = \
+            table.last_run_at[rows[intervals]] + period[intervals]
+
+        crontabs = rows[~intervals]
+        if not len(crontabs):
+            return
+        items = [(table.names[row],
+                  Crontab.from_record(table.records[row]['crontab']))
+                 for row in crontabs]
+        if self.use_crontab_engine():
+            table.next_run[crontabs] = CrontabEngine(items).next_runs(
+                table.last_run_at[crontabs])
+            return
+        for row, (_, crontab) in zip(crontabs, items):
+            last_run_at = self.from_epoch(table.last_run_at[row])
+            remaining = crontab.schedule.remaining_estimate(last_run_at)
+            table.next_run[row] = time.time() + \
+                max(remaining.total_seconds(), 0)
+
+    def to_epoch(self, value):
+        """Convert a run time to epoch seconds.
+
+        Naive run times are in UTC, or in local time when the app does
+        not use UTC.
+        """
+        if not value:
+            return None
+        if value.tzinfo is not None or self.app.conf.CELERY_ENABLE_UTC:
+            return to_timestamp(value)
+        return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+    def from_epoch(self, value):
+        """Convert epoch seconds to an aware UTC run time."""
+        return datetime.datetime.fromtimestamp(value, utc)
+
+    def sync(self):
+        """Update the run bookkeeping of the fired tasks in the store."""
+        table = self._table
+        rows = numpy.flatnonzero(table.dirty[:len(table)])
+        if not len(rows):
+            return
+
+        start = time.time()
+        items = {}
+        for row in rows:
+            last_run_at = self.from_epoch(table.last_run_at[row])
+            table.records[row] = dict(table.records[row],
+                                      last_run_at=last_run_at,
+                                      totalruncount=int(table.run_count[row]))
+            runs = int(table.dirty[row])
+            items[table.names[row]] = ({'totalruncount': runs},
+                                       {'last_run_at': last_run_at})
+        failed = event_store.update_many(items)
+        table.dirty[rows] = 0
+        if failed:
+            logger.debug('Scheduler: tasks %s not updated, deleted from '
+                         'the store?', ', '.join(failed))
+        logger.info('Scheduler: flushed %s records in %.3f seconds.',
+                    len(items), time.time() - start)
+
+    def tick(self):
+        """Run one iteration of the scheduler.
+
+        The due rows are found, advanced and sent together.
+        """
+        table = self.schedule
+        now = time.time()
+        rows = table.due(now)
+        if len(rows):
+            table.last_run_at[rows] = now
+            table.run_count[rows] += 1
+            table.dirty[rows] += 1
+            self.update_next_runs(rows)
+            self.dispatch_rows(rows)
+
+        next_time = table.next_time()
+        if next_time is None:
+            return self.max_interval
+        return min(max(next_time - time.time(), 0), self.max_interval)
+
+    def dispatch_rows(self, rows):
+        """Send the tasks of the given rows to their workers.
+
+        The dispatcher message of a row is prepared on its first run,
+        from a TaskModel built for the occasion.
+        """
+        table = self._table
+        messages = []
+        for row in rows:
+            name, record = table.names[row], table.records[row]
+            logger.info('Scheduler: Sending task %s (%s)',
+                        name, record.get('task'))
+            message = table.messages[row]
+            if message is None:
+                try:
+                    message = self.dispatcher.prepare(
+                        TaskModel.from_record(record).to_dict())
+                except (ValueError, TypeError, KeyError) as exc:
+                    logger.error('Scheduler: cannot send task %s: %s',
+                                 name, exc)
+                    continue
+                table.messages[row] = message
+            messages.append(message)
+
+        try:
+            sent = self.dispatcher.dispatch_many(messages)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error('Message Error: %s\n%s',
+                         exc, traceback.format_stack(), exc_info=True)
+        else:
+            logger.debug('%s of %s due tasks sent', sent, len(rows))
@@ -0,0 +1,144 @@
+"""Column oriented in-memory schedule."""
+
+from crontabengine import numpy
+
+# initial number of rows of a table
+DEFAULT_CAPACITY = 1024
+
+
+class ScheduleTable(object):
+    """Working set of a schedule, held as parallel arrays.
+
+    Every task is a row: its name, store record and dispatcher message
+    are kept in lists, the values used to find the due tasks in numpy
+    arrays. Times are epoch seconds, period is the interval of interval
+    tasks in seconds and nan for crontab tasks.
+    """
+
+    COLUMNS = (
+        ('next_run', 'float64', float('inf')),
+        ('last_run_at', 'float64', 0),
+        ('period', 'float64', float('nan')),
+        ('run_count', 'int64', 0),
+        ('enabled', 'bool', False),
+        ('worker_type', 'int16', 0),
+        # runs not yet in the store
+        ('dirty', 'int64', 0),
+    )
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        """Allocate an empty table."""
+        if numpy is None:
+            raise ImportError('numpy is required by the schedule table.')
+
+        self.names = []
+        self.records = []
+        self.messages = []
+        self.rows = {}
+        # worker type codes
+        self.worker_types = []
+        self._codes = {}
+        self._capacity = 0
+        self._resize(capacity)
+
+    def __len__(self):
+        """Return the number of rows."""
+        return len(self.names)
+
+    def __contains__(self, name):
+        """Check if a task is in the table."""
+        return name in self.rows
+
+    def __iter__(self):
+        """Iterate over the task names."""
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        """Return the store record of a task."""
+        return self.records[self.rows[name]]
+
+    def get(self, name, default=None):
+        """Return the store record of a task, or default."""
+        row = self.rows.get(name)
+        if row is None:
+            return default
+        return self.records[row]
+
+    def code(self, worker_type):
+        """Return the code of a worker type."""
+        code = self._codes.get(worker_type)
+        if code is None:
+            code = self._codes[worker_type] = len(self.worker_types)
+            self.worker_types.append(worker_type)
+        return code
+
+    def set(self, name, record, **values):
+        """Add or replace the row of a task, return its row.
+
+        values are the columns of the row, the missing ones get their
+        default value. The dispatcher message of the task is dropped.
+        """
+        row = self.rows.get(name)
+        if row is None:
+            row = len(self.names)
+            if row == self._capacity:
+                self._resize(max(2 * self._capacity, 1))
+            self.rows[name] = row
+            self.names.append(name)
+            self.records.append(record)
+            self.messages.append(None)
+        else:
+            self.records[row] = record
+            self.messages[row] = None
+
+        if 'worker_type' in values:
+            values['worker_type'] = self.code(values['worker_type'])
+        for column, _, default in self.COLUMNS:
+            getattr(self, column)[row] = values.get(column, default)
+        return row
+
+    def remove(self, name):
+        """Remove the row of a task, moving the last row in its place."""
+        row = self.rows.pop(name, None)
+        if row is None:
+            return
+
+        last = len(self.names) - 1
+        if row != last:
+            moved = self.names[last]
+            self.rows[moved] = row
+            self.names[row] = moved
+            self.records[row] = self.records[last]
+            self.messages[row] = self.messages[last]
+            for column, _, _ in self.COLUMNS:
+                array = getattr(self, column)
+                array[row] = array[last]
+        self.names.pop()
+        self.records.pop()
+        self.messages.pop()
+
+    def due(self, now):
+        """Return the rows of the enabled tasks due at now."""
+        size = len(self.names)
+        return numpy.flatnonzero(self.enabled[:size] &
+                                 (self.next_run[:size] <= now))
+
+    def next_time(self):
+        """Return the earliest next run of the enabled tasks, or None."""
+        size = len(self.names)
+        runs = self.next_run[:size][self.enabled[:size]]
+        if not len(runs):
+            return None
+        next_time = runs.min()
+        if numpy.isinf(next_time):
+            return None
+        return float(next_time)
+
+    def _resize(self, capacity):
+        """Grow the columns to the given number of rows."""
+        for column, dtype, default in self.COLUMNS:
+            array = numpy.full(capacity, default, dtype=dtype)
+            if self._capacity:
+                array[:self._capacity] = getattr(self, column)
+            setattr(self, column, array)
+        self._capacity = capacity
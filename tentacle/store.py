@@ -1,63 +1,293 @@
 """Event store and event model definition."""
 
-import inspect
-from functools import wraps
+import threading
+import time
+from collections import OrderedDict
 
 from celery import current_app
 
-from storebackend import get_backend
-from taskmodel import TaskModel
+from storebackend import DummyBackend, FailoverBackend, get_backend
+from taskmodel import LazyTaskModel
 from . import Config
 
 
+def hydrate(record):
+    """Wrap a store record in a TaskModel, other values are kept as is.
+
+    The fields of the task are only decoded when they are read.
+    """
+    if isinstance(record, dict):
+        return LazyTaskModel(record)
+    return record
+
+
+class StoreCache(object):
+    """Size bounded LRU cache of store records, expiring after a TTL."""
+
+    def __init__(self, size, ttl):
+        """Initialize an empty cache."""
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # bumped by every invalidation
+        self.generation = 0
+        # key -> (expiry time, record), least recently used first
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of cached records."""
+        return len(self._records)
+
+    def get(self, key):
+        """Return the cached record of a key, or None."""
+        with self._lock:
+            cached = self._records.pop(key, None)
+            if cached is None or cached[0] < time.time():
+                self.misses += 1
+                return None
+            self._records[key] = cached
+            self.hits += 1
+            return cached[1]
+
+    def set(self, key, record, generation=None):
+        """Cache the record of a key, evicting the least recently used.
+
+        With the generation read before loading the record, the record
+        is not cached when an invalidation happened since, it may have
+        been loaded before a write.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._records.pop(key, None)
+            if len(self._records) >= self.size:
+                self._records.popitem(last=False)
+            self._records[key] = (time.time() + self.ttl, record)
+
+    def invalidate(self, key):
+        """Drop the cached record of a key."""
+        with self._lock:
+            self.generation += 1
+            self._records.pop(key, None)
+
+
 class EventStore(object):
-    """Used as an event repository."""
+    """Used as an event repository.
+
+    With a cache_size, or STORE_CACHE_SIZE, the records read by key are
+    kept in a StoreCache for cache_ttl, or STORE_CACHE_TTL, seconds.
+    Writes through this store invalidate them once the backend returns,
+    records loaded while a write is running do not stay cached. The TTL
+    bounds how long the writes of other processes go unnoticed.
+
+    With failover, or STORE_FAILOVER, a backend given by name is wrapped
+    in a FailoverBackend, which keeps serving the schedule from a local
+    snapshot while the store is unavailable.
+    """
 
     backend = None
+    cache = None
 
     def __init__(self, *args, **kwargs):
         """Initialize the store."""
+        cache_size = kwargs.pop('cache_size', Config.STORE_CACHE_SIZE)
+        cache_ttl = kwargs.pop('cache_ttl', Config.STORE_CACHE_TTL)
+        failover = kwargs.pop('failover', Config.STORE_FAILOVER)
+        if cache_size:
+            self.cache = StoreCache(cache_size, cache_ttl)
+
         if 'backend' in kwargs:
             self.backend = kwargs.pop('backend')
         if len(kwargs) == 0 and len(args) == 1:
             self.backend = args[0]
 
-        # TODO: check if the backend can reach it's external provider,
-        # if not fall back to the DummyBackend store.
         if self.backend is None:
             raise ValueError('Must specify a backend to use.')
         if isinstance(self.backend, str):
             self.backend = get_backend(self.backend)
+            if failover and not isinstance(self.backend, DummyBackend):
+                self.backend = FailoverBackend(self.backend)
+
+    def get_raw(self, key):
+        """Return the record stored under a key, or None."""
+        record = generation = None
+        if self.cache is not None:
+            generation = self.cache.generation
+            record = self.cache.get(key)
+        if record is None:
+            record = self.backend.get(key)
+            if record is not None and self.cache is not None:
+                self.cache.set(key, record, generation)
+        return record
+
+    def get(self, key):
+        """Return the task stored under a key, or None."""
+        return hydrate(self.get_raw(key))
+
+    def get_many_raw(self, keys):
+        """Return a dict of name: record for the given names.
+
+        Missing records are left out.
+        """
+        records = {}
+        missing = list(keys)
+        generation = None
+        if self.cache is not None:
+            generation = self.cache.generation
+            keys, missing = missing, []
+            for key in keys:
+                record = self.cache.get(key)
+                if record is None:
+                    missing.append(key)
+                else:
+                    records[key] = record
+        if missing:
+            found = self.backend.get_many(missing)
+            if self.cache is not None:
+                for key, record in found.items():
+                    self.cache.set(key, record, generation)
+            records.update(found)
+        return records
+
+    def get_many(self, keys):
+        """Return a dict of name: task for the given names.
+
+        Missing tasks are left out.
+        """
+        return dict((key, hydrate(item))
+                    for key, item in self.get_many_raw(keys).items())
+
+    def _invalidate(self, keys):
+        """Drop the cached records of the given keys."""
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(key)
+
+    def put(self, key, value):
+        """Store a task record under a key."""
+        try:
+            self.backend.put(key, value)
+        finally:
+            self._invalidate([key])
+
+    def put_many(self, items):
+        """Put several task records at once, from a dict of key: value.
+
+        Return the keys that could not be written.
+        """
+        try:
+            return self.backend.put_many(items)
+        finally:
+            self._invalidate(items)
+
+    def update(self, key, increments=None, values=None):
+        """Add increments to some fields and set others, of an existing task.
+
+        Return False when the task does not exist.
+        """
+        try:
+            return self.backend.update(key, increments, values)
+        finally:
+            self._invalidate([key])
+
+    def update_many(self, items):
+        """Update several tasks, from a dict of key: (increments, values).
+
+        Return the keys that could not be updated.
+        """
+        try:
+            return self.backend.update_many(items)
+        finally:
+            self._invalidate(items)
+
+    def delete(self, key):
+        """Delete the task stored under a key."""
+        try:
+            self.backend.delete(key)
+        finally:
+            self._invalidate([key])
+
+    def delete_many(self, keys):
+        """Delete several tasks at once.
+
+        Return the keys that could not be deleted.
+        """
+        keys = list(keys)
+        try:
+            return self.backend.delete_many(keys)
+        finally:
+            self._invalidate(keys)
+
+    def all_raw(self):
+        """Return the records of all the tasks."""
+        return self.backend.all()
+
+    def all(self):
+        """Return all the tasks."""
+        return [hydrate(item) for item in self.backend.all()]
+
+    def iter_all_raw(self):
+        """Iterate over the records of all the tasks."""
+        return self.backend.iter_all()
+
+    def iter_all(self):
+        """Iterate over all the tasks, hydrating them one at a time."""
+        for item in self.backend.iter_all():
+            yield hydrate(item)
+
+    def find_raw(self, field, value):
+        """Return the records of the tasks with a field value."""
+        return self.backend.find(field, value)
+
+    def find(self, field, value):
+        """Return the tasks with a field value."""
+        return [hydrate(item) for item in self.backend.find(field, value)]
+
+    def scan_page_raw(self, cursor=None, limit=100, field=None, value=None):
+        """Return a page of records and the cursor of the next page."""
+        return self.backend.scan_page(cursor, limit, field, value)
+
+    def scan_page(self, cursor=None, limit=100, field=None, value=None):
+        """Return a page of tasks and the cursor of the next page."""
+        items, cursor = self.backend.scan_page(cursor, limit, field, value)
+        return [hydrate(item) for item in items], cursor
+
+    def acquire_lease(self, name, owner, ttl):
+        """Take or renew the lease of a name, return True if owner holds it."""
+        return self.backend.acquire_lease(name, owner, ttl)
+
+    def release_lease(self, name, owner):
+        """Give up the lease of a name, if owner holds it."""
+        self.backend.release_lease(name, owner)
+
+    def leases(self):
+        """Return a dict of name: owner of the live leases."""
+        return self.backend.leases()
+
+    def available(self):
+        """Check if the last calls reached the store.
+
+        False while a FailoverBackend serves the local snapshot.
+        """
+        return getattr(self.backend, 'available', True)
+
+    def change_token(self):
+        """Return the backend marker used to track changes."""
+        return self.backend.change_token()
+
+    def changed_since_raw(self, token):
+        """Return the records of the tasks changed after the token."""
+        return self.backend.changed_since(token)
+
+    def changed_since(self, token):
+        """Return the tasks changed after the token."""
+        return [hydrate(item) for item in self.backend.changed_since(token)]
 
-        # get a list of all the methods offered by the backend
-        backend_functions = inspect.getmembers(self.backend,
-                                               inspect.ismethod)
-        for item in backend_functions:
-            if '__' not in item[0] and '_' not in item[0]:
-                setattr(self, item[0], self._return_object_wrapper(item[1]))
-
-    def _return_object_wrapper(self, mthd):
-        """Wrap the output of the relevant methods in the TaskModel object."""
-        # FIXME: fragile approach, would be better to do it via a standardized
-        # function API
-
-        # if the wrapped method does not return anything, just use that
-        src = inspect.getsource(mthd)
-        if ' return ' not in src:
-            return mthd
-
-        # wrap the method return based on type
-        @wraps(mthd)
-        def internal_methd(*args, **kwargs):
-            result = mthd(*args, **kwargs)
-            if isinstance(result, dict):
-                return TaskModel(**result)
-            elif isinstance(result, list):
-                return [TaskModel(**item) for item in result]
-            else:
-                return result
-
-        return internal_methd
+    def close(self):
+        """Close the backend connections."""
+        self.backend.close()
 
 
 def get_event_store():
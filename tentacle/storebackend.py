@@ -1,8 +1,16 @@
 """Tools used to provide different backends for the event store."""
 
+import binascii
+import bisect
+import functools
+import heapq
 import inspect
+import itertools
 import sys
+import threading
 import time
+from collections import deque
+from Queue import Queue, Empty, Full
 try:
     import cPickle
 except:
@@ -10,12 +18,162 @@ except:
 from abc import ABCMeta, abstractmethod
 
 import aerospike
+try:
+    from aerospike_helpers import expressions
+except ImportError:
+    expressions = None
+from aerospike import predicates
+try:
+    from aerospike import predexp
+except ImportError:
+    predexp = None
+try:
+    from aerospike_helpers.operations import operations
+except ImportError:
+    operations = None
+try:
+    from aerospike_helpers.batch import records as batch_records
+except ImportError:
+    batch_records = None
 
 from . import Config, get_logger
+from recordcodec import COMPACT_FORMAT, HOT_BINS, decode, encode, encode_bin
 
 
 logger = get_logger('tentacle')
 
+# result code of the batch records for missing keys
+RECORD_NOT_FOUND = 2
+
+# task fields with an index, usable by find
+INDEXED_FIELDS = ('worker_type', 'task', 'enabled')
+
+# errors of a cluster that cannot be reached
+UNAVAILABLE_ERRORS = (
+    aerospike.exception.TimeoutError,
+    aerospike.exception.ConnectionError,
+    aerospike.exception.NoMoreConnectionsError,
+    aerospike.exception.ClusterError,
+)
+
+# number of partitions of an Aerospike namespace
+PARTITIONS = 4096
+# scans of a partition range resuming after a digest, in client 5 and up
+PARTITION_SCANS = tuple(
+    int(part) for part in aerospike.__version__.split('.')[:2]) >= (5, 0)
+
+
+class StoreUnavailable(Exception):
+    """The store cannot be reached, or its circuit breaker is open."""
+
+    pass
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing service for a while.
+
+    After threshold consecutive failures the breaker opens and calls
+    are refused at once for reset_timeout seconds. Calls are then let
+    through again: the first success closes the breaker, a failure
+    opens it for another reset_timeout.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        """Initialize a closed breaker."""
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """Return closed, open or half-open."""
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        """Check if a call can be made."""
+        return self.state != 'open'
+
+    def success(self):
+        """Record a successful call, closing the breaker."""
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info('Store circuit breaker closed.')
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """Record a failed call, opening the breaker over the threshold."""
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or \
+                    self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error('Store circuit breaker opened after %s '
+                                 'failures.', self.failures)
+                self.opened_at = time.time()
+
+
+def guarded(method):
+    """Run a backend method through the circuit breaker of the backend.
+
+    The calls refused by the breaker, and the ones failing on cluster
+    errors, raise StoreUnavailable. A cluster error also drops the
+    connection, a new one is made on the next call. Once half-open,
+    the breaker only lets the call through if the backend is healthy.
+    """
+    def check(self):
+        state = self.breaker.state
+        if state == 'half-open' and not self.is_healthy():
+            self.breaker.failure()
+            state = 'open'
+        if state == 'open':
+            raise StoreUnavailable('Aerospike circuit breaker is open.')
+
+    def failed(self, exc):
+        self.breaker.failure()
+        self.close()
+        return StoreUnavailable('Aerospike is unavailable: {}'.format(exc))
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            check(self)
+            items = method(self, *args, **kwargs)
+            try:
+                for item in items:
+                    yield item
+            except UNAVAILABLE_ERRORS as exc:
+                raise failed(self, exc)
+            finally:
+                items.close()
+            self.breaker.success()
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            check(self)
+            try:
+                result = method(self, *args, **kwargs)
+            except UNAVAILABLE_ERRORS as exc:
+                raise failed(self, exc)
+            self.breaker.success()
+            return result
+    return wrapper
+
+
+def apply_update(value, increments=None, values=None):
+    """Return a copy of a task with the increments and values applied."""
+    value = dict(value)
+    for field, amount in (increments or {}).items():
+        value[field] = (value.get(field) or 0) + amount
+    value.update(values or {})
+    return value
+
 
 def get_backend(backend_name):
     """Used to fetch and initialize a backend class for the event store."""
@@ -52,6 +210,137 @@ class BaseBackend(object):
         """Abstract all method."""
         pass
 
+    def close(self):
+        """Close the connections of the backend, if any."""
+        pass
+
+    def iter_all(self):
+        """Iterate over all the tasks.
+
+        Backends that cannot stream their tasks load them all first.
+        """
+        return iter(self.all())
+
+    def get_many(self, keys):
+        """Return a dict of key: task for the given keys.
+
+        Missing keys are left out.
+        """
+        results = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                results[key] = value
+        return results
+
+    def put_many(self, items):
+        """Put several tasks at once, from a dict of key: value.
+
+        Return the keys that could not be written.
+        """
+        for key, value in items.items():
+            self.put(key, value)
+        return []
+
+    def delete_many(self, keys):
+        """Delete several tasks at once.
+
+        Return the keys that could not be deleted.
+        """
+        failed = []
+        for key in keys:
+            try:
+                self.delete(key)
+            except KeyError:
+                failed.append(key)
+        return failed
+
+    def update(self, key, increments=None, values=None):
+        """Change some fields of an existing task.
+
+        increments is a dict of field: number added to the field, values
+        a dict of field: new value. Missing tasks are not created.
+        Return False when the task does not exist. Backends without
+        partial updates read and write back the whole task, so the
+        update is not atomic.
+        """
+        value = self.get(key)
+        if not isinstance(value, dict):
+            return False
+        value = apply_update(value, increments, values)
+        self.put(key, value)
+        return True
+
+    def update_many(self, items):
+        """Update several tasks, from a dict of key: (increments, values).
+
+        Return the keys that could not be updated, missing tasks included.
+        """
+        return [key for key, (increments, values) in items.items()
+                if not self.update(key, increments, values)]
+
+    def find(self, field, value):
+        """Return the tasks with the given value of a field.
+
+        Backends without indexes scan all the tasks.
+        """
+        return [item for item in self.all()
+                if isinstance(item, dict) and item.get(field) == value]
+
+    def scan_page(self, cursor=None, limit=100, field=None, value=None):
+        """Return a page of tasks and the cursor of the next page.
+
+        Tasks are filtered on a field value when field is given. The
+        cursor is None after the last page. Backends without a native
+        way to resume a scan stream all the tasks for every page,
+        keeping only the limit first names after the cursor, so memory
+        stays bounded but walking the pages reads the store once per
+        page: only rely on it for small backends.
+        """
+        items = (item for item in self.iter_all()
+                 if isinstance(item, dict) and
+                 item.get('name') is not None and
+                 (cursor is None or item['name'] > cursor) and
+                 (field is None or item.get(field) == value))
+        page = heapq.nsmallest(limit + 1, items,
+                               key=lambda item: item['name'])
+        if len(page) <= limit:
+            return page, None
+        return page[:limit], page[limit - 1]['name']
+
+    def acquire_lease(self, name, owner, ttl):
+        """Take or renew the lease of a name for ttl seconds.
+
+        Return True when owner holds the lease, False when another owner
+        holds it. Leases are kept apart from the tasks.
+        """
+        raise NotImplementedError(
+            '{} does not support leases.'.format(type(self).__name__))
+
+    def release_lease(self, name, owner):
+        """Give up the lease of a name, if owner holds it."""
+        raise NotImplementedError(
+            '{} does not support leases.'.format(type(self).__name__))
+
+    def leases(self):
+        """Return a dict of name: owner of the leases not expired."""
+        raise NotImplementedError(
+            '{} does not support leases.'.format(type(self).__name__))
+
+    def change_token(self):
+        """Return a marker for the current state of the store.
+
+        Pass it to changed_since to only get the tasks changed after it.
+        """
+        return None
+
+    def changed_since(self, token):
+        """Return the tasks changed after the token.
+
+        Backends that cannot track changes return all the tasks.
+        """
+        return self.all()
+
 
 class DummyBackend(BaseBackend):
     """Dummy adaptor used to simulate a store backend."""
@@ -59,44 +348,198 @@ class DummyBackend(BaseBackend):
     def __init__(self):
         """Initialize the backend."""
         self.store = {}
+        # change counter value of the last write, per key
+        self.changes = {}
+        self.change_count = 0
+        # field -> value -> keys, for the INDEXED_FIELDS
+        self.indexes = dict((field, {}) for field in INDEXED_FIELDS)
+        # name -> (owner, expiry time)
+        self.lease_store = {}
 
     def get(self, key):
         return self.store.get(key, None)
 
     def put(self, key, value):
+        self._unindex(key)
         self.store[key] = value
+        self.change_count += 1
+        self.changes[key] = self.change_count
+        self._index(key)
 
     def delete(self, key):
+        self._unindex(key)
         self.store.pop(key)
+        self.changes.pop(key, None)
+
+    def update(self, key, increments=None, values=None):
+        value = self.store.get(key)
+        if not isinstance(value, dict):
+            return False
+        self.put(key, apply_update(value, increments, values))
+        return True
+
+    def find(self, field, value):
+        if field not in self.indexes:
+            return super(DummyBackend, self).find(field, value)
+        return [self.store[key]
+                for key in self.indexes[field].get(value, ())]
+
+    def _index(self, key):
+        value = self.store[key]
+        if not isinstance(value, dict):
+            return
+        for field, index in self.indexes.items():
+            index.setdefault(value.get(field), set()).add(key)
+
+    def _unindex(self, key):
+        value = self.store.get(key)
+        if not isinstance(value, dict):
+            return
+        for field, index in self.indexes.items():
+            keys = index.get(value.get(field))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value.get(field)]
 
     def all(self):
         return [item for item in self.store.values()]
 
+    def iter_all(self):
+        for key in list(self.store):
+            item = self.store.get(key)
+            if item is not None:
+                yield item
+
+    def scan_page(self, cursor=None, limit=100, field=None, value=None):
+        if field is None:
+            keys = sorted(self.store)
+        elif field in self.indexes:
+            keys = sorted(self.indexes[field].get(value, ()))
+        else:
+            return super(DummyBackend, self).scan_page(cursor, limit,
+                                                       field, value)
+        start = 0 if cursor is None else bisect.bisect(keys, cursor)
+        keys = keys[start:start + limit + 1]
+        if len(keys) <= limit:
+            return [self.store[key] for key in keys], None
+        return [self.store[key] for key in keys[:limit]], keys[limit - 1]
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        current = self.lease_store.get(name)
+        if current is not None and current[0] != owner and current[1] > now:
+            return False
+        self.lease_store[name] = (owner, now + ttl)
+        return True
+
+    def release_lease(self, name, owner):
+        current = self.lease_store.get(name)
+        if current is not None and current[0] == owner:
+            del self.lease_store[name]
+
+    def leases(self):
+        now = time.time()
+        return dict((name, owner)
+                    for name, (owner, expiry) in self.lease_store.items()
+                    if expiry > now)
+
+    def change_token(self):
+        return self.change_count
+
+    def changed_since(self, token):
+        return [self.store[key] for key, count in self.changes.items()
+                if count > token]
+
 
 class AerospikeBackend(BaseBackend):
-    """Aerospike adaptor for the event store."""
+    """Aerospike adaptor for the event store.
+
+    Calls fail fast with StoreUnavailable while the cluster is down:
+    key operations time out after AEROSPIKE_KEY_TIMEOUT milliseconds,
+    and a CircuitBreaker refuses the calls for AEROSPIKE_BREAKER_RESET
+    seconds after AEROSPIKE_BREAKER_THRESHOLD cluster errors in a row.
+    The cluster is then pinged before letting a call through again.
+    """
 
     def __init__(self):
         """Initialize the backend."""
-        self.connection = aerospike.client(Config.AEROSPIKE_CONFIG)
+        self.connection = None
         self._client = None
-        self.close_at = (
-            None if Config.AEROSPIKE_CONN_MAX_AGE is None
-            else time.time() + Config.AEROSPIKE_CONN_MAX_AGE
-        )
+        self.close_at = None
+        # fields with a secondary index known to exist
+        self._indexes = set()
+        # changed_since fell back to a full scan
+        self._full_changes_logged = False
+        # the bulk writes fell back to single writes
+        self._single_writes_logged = False
+        self.record_format = Config.AEROSPIKE_RECORD_FORMAT
+        self.compression_threshold = Config.AEROSPIKE_COMPRESSION_THRESHOLD
+        self.breaker = CircuitBreaker(Config.AEROSPIKE_BREAKER_THRESHOLD,
+                                      Config.AEROSPIKE_BREAKER_RESET)
+        # policy of the key and batch operations
+        self.key_policy = {
+            'timeout': Config.AEROSPIKE_KEY_TIMEOUT
+        }
 
     def get_key(self, key):
         """Return Aerospike specific key."""
         return (Config.AEROSPIKE_NAMESPACE, Config.AEROSPIKE_SETNAME, key)
 
+    def encode(self, value):
+        """Return the bins of a task, in the configured record format.
+
+        The None bins are written as explicit nils, removing them from
+        the stored record.
+        """
+        bins = encode(value, self.record_format, self.compression_threshold)
+        if not isinstance(bins, dict):
+            return bins
+        return dict((name, aerospike.null() if bin_value is None
+                     else bin_value) for name, bin_value in bins.items())
+
     @property
     def client(self):
-        """Lazy connection setup."""
+        """Lazy connection setup.
+
+        Connections older than AEROSPIKE_CONN_MAX_AGE seconds, or not
+        connected to the cluster anymore, are replaced by new ones.
+        """
+        if self._client is not None:
+            if self.close_at is not None and time.time() >= self.close_at:
+                logger.debug('Recycling the Aerospike connection.')
+                self.close()
+            elif not self._client.is_connected():
+                logger.warning('Aerospike connection lost, reconnecting.')
+                self.close()
         if self._client is None:
+            self.connection = aerospike.client(Config.AEROSPIKE_CONFIG)
             self._client = self.connection.connect(Config.AEROSPIKE_USERNAME,
                                                    Config.AEROSPIKE_PASSWORD)
+            self.close_at = (
+                None if Config.AEROSPIKE_CONN_MAX_AGE is None
+                else time.time() + Config.AEROSPIKE_CONN_MAX_AGE
+            )
         return self._client
 
+    def is_healthy(self):
+        """Check if the cluster can be reached, reconnecting if needed.
+
+        The probe of the circuit breaker once half-open.
+        """
+        try:
+            self.ping()
+        except UNAVAILABLE_ERRORS as exc:
+            logger.warning('Aerospike health check failed: %s', exc)
+            self.close()
+            return False
+        return True
+
+    def ping(self):
+        """Ask the status of the cluster nodes."""
+        self.client.info_all('status', policy=self.key_policy)
+
+    @guarded
     def put(self, key, value):
         """Put a task in the event repository.
 
@@ -108,46 +551,739 @@ class AerospikeBackend(BaseBackend):
             'ttl': Config.SESSION_TTL
         }
         try:
-            self.client.put(_key, value, meta=meta)
+            self.client.put(_key, self.encode(value), meta=meta,
+                            policy=self.key_policy)
         except aerospike.exception.BinNameError:
             logger.debug('A bin name should not exceed 14 characters limit')
             logger.debug([(x, len(x)) for x in value.keys() if len(x) > 14])
             raise aerospike.exception.BinNameError
 
+    def can_batch_write(self):
+        """Check if the client has batch writes, logging once if not.
+
+        Batch writes need client 7 and up, older clients write the bulk
+        operations one task at a time.
+        """
+        if batch_records is not None and hasattr(self.client, 'batch_write'):
+            return True
+        if not self._single_writes_logged:
+            logger.warning('Aerospike batch writes are not available, the '
+                           'bulk writes are sent one task at a time.')
+            self._single_writes_logged = True
+        return False
+
+    @guarded
+    def put_many(self, items):
+        """Put several tasks in the event repository.
+
+        The tasks are written with one batch write when the client
+        supports it, with one put each otherwise.
+        """
+        if not self.can_batch_write():
+            return super(AerospikeBackend, self).put_many(items)
+
+        meta = {
+            'ttl': Config.SESSION_TTL
+        }
+        batch = batch_records.BatchRecords([
+            batch_records.Write(self.get_key(key),
+                                [operations.write(name, bin_value)
+                                 for name, bin_value
+                                 in self.encode(value).items()],
+                                meta=meta)
+            for key, value in items.items()
+        ])
+        self.client.batch_write(batch, self.key_policy)
+        failed = [record.key[2] for record in batch.batch_records
+                  if record.result != 0]
+        if failed:
+            logger.error('Batch write failed for tasks: %s', ','.join(failed))
+        return failed
+
+    @guarded
+    def delete_many(self, keys):
+        """Delete several tasks from the repository.
+
+        The tasks are removed with one batch write when the client
+        supports it, with one delete each otherwise. Missing tasks are
+        not reported as failed, like in delete.
+        """
+        if not self.can_batch_write():
+            return super(AerospikeBackend, self).delete_many(keys)
+
+        batch = batch_records.BatchRecords([
+            batch_records.Remove(self.get_key(key)) for key in keys
+        ])
+        self.client.batch_write(batch, self.key_policy)
+        failed = [record.key[2] for record in batch.batch_records
+                  if record.result not in (0, RECORD_NOT_FOUND)]
+        if failed:
+            logger.error('Batch delete failed for tasks: %s', ','.join(failed))
+        return failed
+
+    def update_operations(self, increments=None, values=None):
+        """Return the operations of an update, on bins of the record format.
+
+        Only the fields with their own bin can be updated in compact
+        records.
+        """
+        fields = set(increments or ()) | set(values or ())
+        if self.record_format == COMPACT_FORMAT and \
+                not fields.issubset(HOT_BINS):
+            raise ValueError('Cannot update the payload fields {}.'.format(
+                ', '.join(sorted(fields - set(HOT_BINS)))))
+
+        ops = [operations.increment(field, amount)
+               for field, amount in (increments or {}).items()]
+        for field, value in (values or {}).items():
+            if self.record_format == COMPACT_FORMAT:
+                value = encode_bin(field, value)
+            ops.append(operations.write(field, value))
+        return ops
+
+    @guarded
+    def update(self, key, increments=None, values=None):
+        """Change some bins of an existing task with one atomic operate.
+
+        Missing tasks are not created, return False for them.
+        Falls back to a read and a put on clients without operations.
+        """
+        if operations is None:
+            return super(AerospikeBackend, self).update(key, increments,
+                                                        values)
+
+        meta = {
+            'ttl': Config.SESSION_TTL
+        }
+        policy = dict(self.key_policy, exists=aerospike.POLICY_EXISTS_UPDATE)
+        try:
+            self.client.operate(self.get_key(key),
+                                self.update_operations(increments, values),
+                                meta=meta, policy=policy)
+        except aerospike.exception.RecordNotFound:
+            return False
+        return True
+
+    @guarded
+    def update_many(self, items):
+        """Update several tasks with operations.
+
+        The operations are sent with one batch write when the client
+        supports it, with one operate per task otherwise.
+        Return the keys that could not be updated, missing tasks included.
+        """
+        if not self.can_batch_write():
+            return super(AerospikeBackend, self).update_many(items)
+
+        meta = {
+            'ttl': Config.SESSION_TTL
+        }
+        policy = {
+            'exists': aerospike.POLICY_EXISTS_UPDATE
+        }
+        batch = batch_records.BatchRecords([
+            batch_records.Write(self.get_key(key),
+                                self.update_operations(increments, values),
+                                meta=meta, policy=policy)
+            for key, (increments, values) in items.items()
+        ])
+        self.client.batch_write(batch, self.key_policy)
+        failed = [record.key[2] for record in batch.batch_records
+                  if record.result != 0]
+        missing = [record.key[2] for record in batch.batch_records
+                   if record.result == RECORD_NOT_FOUND]
+        if len(failed) > len(missing):
+            logger.error('Batch update failed for tasks: %s',
+                         ','.join(set(failed) - set(missing)))
+        return failed
+
+    @guarded
+    def get_many(self, keys):
+        """Retrieve several tasks with one batch read.
+
+        Return a dict of key: task, missing keys are left out.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        records = self.client.get_many([self.get_key(key) for key in keys],
+                                       self.key_policy)
+        return dict((key, decode(bins))
+                    for key, (_, meta, bins) in zip(keys, records)
+                    if bins is not None)
+
+    @guarded
     def get(self, key):
         """Retrieve a task."""
         _key = self.get_key(key)
         try:
-            _key, meta, bins = self.client.get(_key)
+            _key, meta, bins = self.client.get(_key, policy=self.key_policy)
         except aerospike.exception.RecordNotFound:
             return None
         except cPickle.UnpicklingError:
             logger.debug('Unpickling error occurred. Bins:\n%s', bins)
             return None
-        return bins
+        return decode(bins)
 
+    @guarded
     def delete(self, key):
         """Delete a task from the repository."""
         try:
             _key = self.get_key(key)
-            self.client.remove(_key)
+            self.client.remove(_key, policy=self.key_policy)
         except aerospike.exception.RecordNotFound:
             pass
 
+    @guarded
     def all(self):
         """Return all tasks in the repository."""
         query = self.client.scan(Config.AEROSPIKE_NAMESPACE,
                                  Config.AEROSPIKE_SETNAME)
         query.select()
         try:
-            results = [bin for key, meta, bin in query.results()]
+            results = [decode(bin) for key, meta, bin in query.results()]
             return results
         except aerospike.exception.RecordNotFound:
             logger.info('No records found in db.')
 
         return []
 
+    @guarded
+    def find(self, field, value):
+        """Return the tasks with the given value of a field.
+
+        The INDEXED_FIELDS are looked up in a secondary index, created on
+        first use. Booleans are queried as integers, the way the client
+        stores them. Other fields, or a failing index query, fall back
+        to a full scan.
+        """
+        if field not in INDEXED_FIELDS:
+            return super(AerospikeBackend, self).find(field, value)
+
+        if isinstance(value, bool):
+            value = int(value)
+        try:
+            self._ensure_index(field, value)
+            query = self.client.query(Config.AEROSPIKE_NAMESPACE,
+                                      Config.AEROSPIKE_SETNAME)
+            query.where(predicates.equals(field, value))
+            return [decode(bins) for key, meta, bins in query.results()]
+        except aerospike.exception.RecordNotFound:
+            return []
+        except UNAVAILABLE_ERRORS:
+            raise
+        except aerospike.exception.AerospikeError as exc:
+            logger.warning('Index query on %s failed, scanning: %s',
+                           field, exc)
+        return super(AerospikeBackend, self).find(field, value)
+
+    def _ensure_index(self, field, value):
+        """Create the secondary index of a field, if it does not exist."""
+        if field in self._indexes:
+            return
+
+        if isinstance(value, (int, long)):
+            create = self.client.index_integer_create
+        else:
+            create = self.client.index_string_create
+        try:
+            create(Config.AEROSPIKE_NAMESPACE, Config.AEROSPIKE_SETNAME,
+                   field, '{}_{}_idx'.format(Config.AEROSPIKE_SETNAME, field))
+        except aerospike.exception.IndexFoundError:
+            pass
+        self._indexes.add(field)
+
+    @guarded
+    def iter_all(self):
+        """Iterate over all the tasks, without loading them all at once.
+
+        The scan runs in a thread and sends the records through a queue
+        of AEROSPIKE_SCAN_QUEUE_SIZE records, the scan waits while the
+        queue is full. Stopping the iteration aborts the scan.
+        """
+        records = Queue(maxsize=Config.AEROSPIKE_SCAN_QUEUE_SIZE)
+        stop = threading.Event()
+        done = object()
+
+        def callback(record):
+            while not stop.is_set():
+                try:
+                    records.put(record[2], timeout=0.1)
+                    return
+                except Full:
+                    pass
+            return False
+
+        def scan():
+            try:
+                query = self.client.scan(Config.AEROSPIKE_NAMESPACE,
+                                         Config.AEROSPIKE_SETNAME)
+                query.select()
+                query.foreach(callback)
+            except aerospike.exception.RecordNotFound:
+                logger.info('No records found in db.')
+            except Exception as exc:  # pylint: disable=broad-except
+                records.put(exc)
+            records.put(done)
+
+        thread = threading.Thread(target=scan, name='aerospike-scan')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                record = records.get()
+                if record is done:
+                    break
+                if isinstance(record, Exception):
+                    raise record
+                yield decode(record)
+        finally:
+            stop.set()
+            # unblock the scan thread waiting on a full queue
+            while thread.is_alive():
+                try:
+                    records.get(timeout=0.1)
+                except Empty:
+                    pass
+
+    @guarded
+    def scan_page(self, cursor=None, limit=100, field=None, value=None):
+        """Return a page of tasks and the cursor of the next page.
+
+        The partitions are walked in order, each one in the digest order
+        of the cluster, so the cursor is the partition and digest of the
+        last returned record. Each scan covers a range of partitions,
+        doubled until the page is full, and only the first limit records
+        of the range are kept. The INDEXED_FIELDS filters are index
+        queries. Clients without partition scans load all the tasks
+        instead.
+        """
+        if not PARTITION_SCANS:
+            return super(AerospikeBackend, self).scan_page(cursor, limit,
+                                                           field, value)
+
+        partition, digest = 0, None
+        if cursor is not None:
+            partition, digest = cursor.split(':')
+            partition, digest = int(partition), binascii.unhexlify(digest)
+        if isinstance(value, bool):
+            value = int(value)
+        if field is not None and field in INDEXED_FIELDS:
+            self._ensure_index(field, value)
+
+        # (partition, arrival order, digest, task) of the page, the
+        # records of a partition come from one node in digest order
+        page = []
+        arrivals = itertools.count()
+        lock = threading.Lock()
+
+        def collect(record):
+            key, meta, bins = record
+            bins = decode(bins)
+            if field is not None and field not in INDEXED_FIELDS and \
+                    bins.get(field) != value:
+                return
+            entry_digest = bytearray(key[3])
+            with lock:
+                entry = ((entry_digest[0] | entry_digest[1] << 8) %
+                         PARTITIONS, next(arrivals), key[3], bins)
+                if len(page) < limit or entry < page[-1]:
+                    bisect.insort(page, entry)
+                    del page[limit:]
+
+        count = 1
+        while partition < PARTITIONS and len(page) < limit:
+            count = min(count, PARTITIONS - partition)
+            partition_filter = {'begin': partition, 'count': count}
+            if digest is not None:
+                # the digest only resumes the first partition of the range
+                partition_filter.update(
+                    count=1, digest={'init': 1, 'value': digest})
+            if field is not None and field in INDEXED_FIELDS:
+                scan = self.client.query(Config.AEROSPIKE_NAMESPACE,
+                                         Config.AEROSPIKE_SETNAME)
+                scan.where(predicates.equals(field, value))
+            else:
+                scan = self.client.scan(Config.AEROSPIKE_NAMESPACE,
+                                        Config.AEROSPIKE_SETNAME)
+            scan.foreach(collect, {'partition_filter': partition_filter})
+            partition += partition_filter['count']
+            digest = None
+            count *= 2
+
+        items = [entry[3] for entry in page]
+        if len(items) < limit:
+            return items, None
+        last = page[-1]
+        return items, '{}:{}'.format(last[0], binascii.hexlify(last[2]))
+
+    def get_lease_key(self, name):
+        """Return the Aerospike key of a lease."""
+        return (Config.AEROSPIKE_NAMESPACE, Config.AEROSPIKE_LEASE_SETNAME,
+                name)
+
+    @guarded
+    def acquire_lease(self, name, owner, ttl):
+        """Take or renew the lease of a name for ttl seconds.
+
+        Leases are records of the AEROSPIKE_LEASE_SETNAME set expiring
+        after ttl, so the leases of dead owners go away by themselves.
+        Leases are only created when missing and only renewed when their
+        generation did not change since they were read.
+        """
+        key = self.get_lease_key(name)
+        try:
+            _, meta, bins = self.client.get(key, policy=self.key_policy)
+        except aerospike.exception.RecordNotFound:
+            meta = {
+                'ttl': ttl
+            }
+            policy = dict(self.key_policy,
+                          exists=aerospike.POLICY_EXISTS_CREATE)
+        else:
+            if bins.get('owner') != owner:
+                return False
+            meta = {
+                'ttl': ttl,
+                'gen': meta['gen']
+            }
+            policy = dict(self.key_policy, gen=aerospike.POLICY_GEN_EQ)
+        try:
+            self.client.put(key, {'name': name, 'owner': owner}, meta=meta,
+                            policy=policy)
+        except (aerospike.exception.RecordExistsError,
+                aerospike.exception.RecordGenerationError):
+            return False
+        return True
+
+    @guarded
+    def release_lease(self, name, owner):
+        """Give up the lease of a name, if owner holds it."""
+        key = self.get_lease_key(name)
+        try:
+            _, meta, bins = self.client.get(key, policy=self.key_policy)
+            if bins.get('owner') == owner:
+                self.client.remove(key, meta={'gen': meta['gen']},
+                                   policy=dict(self.key_policy,
+                                               gen=aerospike.POLICY_GEN_EQ))
+        except (aerospike.exception.RecordNotFound,
+                aerospike.exception.RecordGenerationError):
+            pass
+
+    @guarded
+    def leases(self):
+        """Return a dict of name: owner of the leases not expired."""
+        query = self.client.scan(Config.AEROSPIKE_NAMESPACE,
+                                 Config.AEROSPIKE_LEASE_SETNAME)
+        query.select('name', 'owner')
+        try:
+            return dict((bins['name'], bins['owner'])
+                        for key, meta, bins in query.results())
+        except aerospike.exception.RecordNotFound:
+            return {}
+
+    def change_token(self):
+        """Return the current time in nanoseconds, as used by record LUTs.
+
+        The marker is moved back by INCREMENTAL_UPDATE_OVERLAP seconds to
+        cover the clock drift between this host and the cluster nodes.
+        """
+        return int((time.time() - Config.INCREMENTAL_UPDATE_OVERLAP) * 10 ** 9)
+
+    @guarded
+    def changed_since(self, token):
+        """Return the tasks with a last update time after the token.
+
+        The filtering is done server side, with filter expressions on
+        recent clients and predicate expressions on the older ones, so
+        only the changed records are sent back. Falls back to a full
+        scan, logged once, on clients with neither.
+        """
+        if token is None:
+            return self.all()
+        policy = {}
+        if expressions is not None:
+            query = self.client.scan(Config.AEROSPIKE_NAMESPACE,
+                                     Config.AEROSPIKE_SETNAME)
+            query.select()
+            policy['expressions'] = expressions.GT(
+                expressions.LastUpdateTime(), token).compile()
+        elif predexp is not None:
+            query = self.client.query(Config.AEROSPIKE_NAMESPACE,
+                                      Config.AEROSPIKE_SETNAME)
+            query.predexp([predexp.rec_last_update(),
+                           predexp.integer_value(token),
+                           predexp.integer_greater()])
+        else:
+            if not self._full_changes_logged:
+                logger.warning('Aerospike expressions are not available, '
+                               'the incremental updates scan all the tasks.')
+                self._full_changes_logged = True
+            return self.all()
+
+        try:
+            return [decode(bin) for key, meta, bin in query.results(policy)]
+        except aerospike.exception.RecordNotFound:
+            logger.info('No changed records found in db.')
+
+        return []
+
+    def close(self):
+        """Close the connection, the next call opens a new one."""
+        client, self._client = self._client, None
+        if client is not None:
+            try:
+                client.close()
+            except aerospike.exception.AerospikeError as exc:
+                logger.debug('Error closing the Aerospike connection: %s',
+                             exc)
+
+
+class FailoverBackend(BaseBackend):
+    """Backend falling back to a local snapshot while its primary is down.
+
+    The tasks read from, or written to, the primary backend are kept in
+    a DummyBackend snapshot, updated as the full reads stream by.
+    While the primary raises StoreUnavailable, the reads are served from
+    the snapshot and the writes are applied to it and queued, up to
+    STORE_FAILOVER_QUEUE_SIZE writes. The queue is replayed in order,
+    before any other call, once the primary is back. A queued write
+    failing with another error is logged and dropped.
+    """
+
+    def __init__(self, primary=None):
+        """Initialize the backend, by default over an AerospikeBackend."""
+        self.primary = primary if primary is not None else AerospikeBackend()
+        self.snapshot = DummyBackend()
+        # (method name, args) of the writes waiting for the primary
+        self.pending = deque()
+        self.available = True
+        self._lock = threading.RLock()
+
+    def call(self, method, *args):
+        """Call a method of the primary, after replaying the queued writes.
+
+        Raise StoreUnavailable when the primary is down.
+        """
+        try:
+            if self.pending:
+                self.replay()
+            result = getattr(self.primary, method)(*args)
+        except StoreUnavailable as exc:
+            self.unavailable(exc)
+            raise
+        self.recovered()
+        return result
+
+    def unavailable(self, exc):
+        """Switch to the snapshot after a StoreUnavailable error."""
+        if self.available:
+            logger.error('Store unavailable, using the local snapshot: %s',
+                         exc)
+            self.available = False
+
+    def recovered(self):
+        """Switch back to the primary after a successful call."""
+        if not self.available:
+            logger.info('Store available again.')
+            self.available = True
+
+    def replay(self):
+        """Send the queued writes to the primary, in order."""
+        with self._lock:
+            count = len(self.pending)
+            while self.pending:
+                method, args = self.pending[0]
+                try:
+                    getattr(self.primary, method)(*args)
+                except KeyError:
+                    # deleted meanwhile
+                    pass
+                except StoreUnavailable:
+                    raise
+                except Exception as exc:  # pylint: disable=broad-except
+                    # dropped, it would block the writes queued after it
+                    logger.error('Dropping the queued %s write, it '
+                                 'failed: %s', method, exc, exc_info=True)
+                self.pending.popleft()
+            logger.info('Replayed %s queued writes to the store.', count)
+
+    def queue(self, method, *args):
+        """Queue a write for the primary and apply it to the snapshot.
+
+        Return the result of the snapshot.
+        """
+        with self._lock:
+            if len(self.pending) >= Config.STORE_FAILOVER_QUEUE_SIZE:
+                raise StoreUnavailable('Store write queue is full.')
+            self.pending.append((method, args))
+        return getattr(self.snapshot, method)(*args)
+
+    def write(self, method, *args):
+        """Apply a write to the primary, or queue it, and to the snapshot.
+
+        Return the result of the primary, or of the snapshot when queued.
+        """
+        try:
+            result = self.call(method, *args)
+        except StoreUnavailable:
+            return self.queue(method, *args)
+        getattr(self.snapshot, method)(*args)
+        return result
+
+    def remember(self, key, value):
+        """Keep a task read from the primary in the snapshot."""
+        if value is None:
+            if key in self.snapshot.store:
+                self.snapshot.delete(key)
+        else:
+            self.snapshot.put(key, value)
+
+    def refresh(self, items):
+        """Replace the snapshot with the tasks of a full read."""
+        snapshot = DummyBackend()
+        for item in items:
+            if isinstance(item, dict) and item.get('name') is not None:
+                snapshot.put(item['name'], item)
+        self.snapshot = snapshot
+
+    def get(self, key):
+        try:
+            value = self.call('get', key)
+        except StoreUnavailable:
+            return self.snapshot.get(key)
+        self.remember(key, value)
+        return value
+
+    def get_many(self, keys):
+        keys = list(keys)
+        try:
+            values = self.call('get_many', keys)
+        except StoreUnavailable:
+            return self.snapshot.get_many(keys)
+        for key in keys:
+            self.remember(key, values.get(key))
+        return values
+
+    def put(self, key, value):
+        self.write('put', key, value)
+
+    def put_many(self, items):
+        try:
+            failed = self.call('put_many', items)
+        except StoreUnavailable:
+            for key, value in items.items():
+                self.queue('put', key, value)
+            return []
+        for key, value in items.items():
+            if key not in failed:
+                self.snapshot.put(key, value)
+        return failed
+
+    def delete(self, key):
+        try:
+            self.write('delete', key)
+        except KeyError:
+            pass
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        try:
+            failed = self.call('delete_many', keys)
+        except StoreUnavailable:
+            for key in keys:
+                try:
+                    self.queue('delete', key)
+                except KeyError:
+                    pass
+            return []
+        for key in keys:
+            if key not in failed and key in self.snapshot.store:
+                self.snapshot.delete(key)
+        return failed
+
+    def update(self, key, increments=None, values=None):
+        return self.write('update', key, increments, values)
+
+    def update_many(self, items):
+        try:
+            failed = self.call('update_many', items)
+        except StoreUnavailable:
+            return [key for key, (increments, values) in items.items()
+                    if not self.queue('update', key, increments, values)]
+        for key, (increments, values) in items.items():
+            if key not in failed:
+                self.snapshot.update(key, increments, values)
+        return failed
+
+    def all(self):
+        try:
+            items = self.call('all')
+        except StoreUnavailable:
+            return self.snapshot.all()
+        self.refresh(items)
+        return items
+
+    def iter_all(self):
+        # the snapshot is updated as the tasks stream by, its tasks
+        # missing from a complete scan are dropped at the end
+        known = set(self.snapshot.store)
+        seen = set()
+        try:
+            if self.pending:
+                self.replay()
+            # not through call, the primary is only known to be back
+            # once the scan is complete
+            for item in self.primary.iter_all():
+                if isinstance(item, dict) and item.get('name') is not None:
+                    self.snapshot.put(item['name'], item)
+                    seen.add(item['name'])
+                yield item
+        except StoreUnavailable as exc:
+            # the scan is completed from the snapshot
+            self.unavailable(exc)
+            for item in self.snapshot.iter_all():
+                if item.get('name') not in seen:
+                    yield item
+            return
+        self.recovered()
+        for key in known - seen:
+            if key in self.snapshot.store:
+                self.snapshot.delete(key)
+
+    def find(self, field, value):
+        try:
+            return self.call('find', field, value)
+        except StoreUnavailable:
+            return self.snapshot.find(field, value)
+
+    def scan_page(self, cursor=None, limit=100, field=None, value=None):
+        # the cursors of the primary are not valid in the snapshot,
+        # so pages are not served from it
+        return self.call('scan_page', cursor, limit, field, value)
+
+    def acquire_lease(self, name, owner, ttl):
+        # leases are never served from the snapshot
+        return self.call('acquire_lease', name, owner, ttl)
+
+    def release_lease(self, name, owner):
+        return self.call('release_lease', name, owner)
+
+    def leases(self):
+        return self.call('leases')
+
+    def change_token(self):
+        return self.primary.change_token()
+
+    def changed_since(self, token):
+        try:
+            return self.call('changed_since', token)
+        except StoreUnavailable:
+            # snapshot changes are not tracked against the primary tokens
+            return self.snapshot.all()
+
     def close(self):
-        """Close the connection."""
-        self.client.close()
-        self.client = None
+        if self.pending:
+            logger.warning('Closing the store with %s writes not replayed.',
+                           len(self.pending))
+        self.primary.close()
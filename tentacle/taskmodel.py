@@ -13,12 +13,35 @@ logger = get_logger('tentacle')
 # Possible values for a period
 PERIODS = ('days', 'hours', 'minutes', 'seconds', 'microseconds')
 
+# Crontab fields, in the celery crontab order
+CRONTAB_FIELDS = ('minute', 'hour', 'day_of_week',
+                  'day_of_month', 'month_of_year')
+
+# Compiled celery schedules, shared by all the tasks with the same fields
+SCHEDULE_CACHE_SIZE = 10000
+_schedule_cache = {}
+
+
+def intern_schedule(key, build):
+    """Return the compiled schedule for the key, building it on first use."""
+    schedule = _schedule_cache.get(key)
+    if schedule is None:
+        if len(_schedule_cache) >= SCHEDULE_CACHE_SIZE:
+            _schedule_cache.clear()
+        schedule = _schedule_cache[key] = build()
+    return schedule
+
 
 class Interval(object):
     """Object used to model a periodic interval."""
 
-    _every = None
-    _period = None
+    __slots__ = ('_every', '_period', '_schedule')
+
+    def __init__(self):
+        """Initialize an empty interval."""
+        self._every = None
+        self._period = None
+        self._schedule = None
 
     @property
     def every(self):
@@ -31,6 +54,7 @@ class Interval(object):
         val = 0
         if value is None:
             self._every = val
+            self._schedule = None
             return
 
         try:
@@ -42,6 +66,7 @@ class Interval(object):
             raise ValueError("Value must be a positive integer.")
 
         self._every = val
+        self._schedule = None
 
     @property
     def period(self):
@@ -58,13 +83,18 @@ class Interval(object):
                              'seconds', 'microseconds'")
         else:
             self._period = value
+            self._schedule = None
 
     @property
     def schedule(self):
         """Return the object in the Celery schedule format."""
-        return celery.schedules.schedule(
-            datetime.timedelta(**{self.period: self.every})
-        )
+        if self._schedule is None:
+            period, every = self.period, self.every
+            self._schedule = intern_schedule(
+                ('interval', period, every),
+                lambda: celery.schedules.schedule(
+                    datetime.timedelta(**{period: every})))
+        return self._schedule
 
     def to_dict(self):
         """Serialize this object to a dict."""
@@ -81,30 +111,51 @@ class Interval(object):
         result.period = data['period']
         return result
 
+    @classmethod
+    def from_record(cls, data):
+        """Deserialize from a trusted store record, without validation."""
+        if data is None:
+            return None
+
+        result = cls.__new__(cls)
+        result._every = data['every']
+        result._period = data['period']
+        result._schedule = None
+        return result
+
 
 class Crontab(object):
     """Object used to model a crontab."""
 
-    minute = '*'
-    hour = '*'
-    day_of_week = '*'
-    day_of_month = '*'
-    month_of_year = '*'
+    __slots__ = CRONTAB_FIELDS + ('_schedule',)
+
+    def __init__(self):
+        """Initialize a crontab running every minute."""
+        for key in CRONTAB_FIELDS:
+            object.__setattr__(self, key, '*')
+        object.__setattr__(self, '_schedule', None)
+
+    def __setattr__(self, name, value):
+        """Drop the compiled schedule when a field changes."""
+        if name in CRONTAB_FIELDS:
+            object.__setattr__(self, '_schedule', None)
+        object.__setattr__(self, name, value)
 
     @property
     def schedule(self):
         """Return the object in the Celery schedule format."""
-        return celery.schedules.crontab(minute=self.minute,
-                                        hour=self.hour,
-                                        day_of_week=self.day_of_week,
-                                        day_of_month=self.day_of_month,
-                                        month_of_year=self.month_of_year)
+        if self._schedule is None:
+            fields = dict((key, getattr(self, key)) for key in CRONTAB_FIELDS)
+            self._schedule = intern_schedule(
+                ('crontab',) + tuple(str(fields[key])
+                                     for key in CRONTAB_FIELDS),
+                lambda: celery.schedules.crontab(**fields))
+        return self._schedule
 
     def to_dict(self):
         """Serialize this object to a dict."""
         output = {}
-        for key in ['minute', 'hour', 'day_of_week',
-                    'day_of_month', 'month_of_year']:
+        for key in CRONTAB_FIELDS:
             output.update({key: getattr(self, key)})
 
         return output
@@ -116,11 +167,22 @@ class Crontab(object):
             return None
 
         result = cls()
-        for key in ['minute', 'hour', 'day_of_week',
-                    'day_of_month', 'month_of_year']:
+        for key in CRONTAB_FIELDS:
             setattr(result, key, data.get(key, '*'))
         return result
 
+    @classmethod
+    def from_record(cls, data):
+        """Deserialize from a trusted store record."""
+        if data is None:
+            return None
+
+        result = cls.__new__(cls)
+        for key in CRONTAB_FIELDS:
+            object.__setattr__(result, key, data.get(key, '*'))
+        object.__setattr__(result, '_schedule', None)
+        return result
+
 
 class TaskModel(object):
     """Task model.
@@ -147,21 +209,29 @@ class TaskModel(object):
         description     - optional description
     """
 
+    start_attrs = (
+        'name', 'task', 'interval', 'crontab', 'args', 'kwargs',
+        'exchange', 'routing_key', 'expires', 'enabled', 'worker_type',
+        'last_run_at', 'total_run_count', 'date_changed', 'description'
+    )
+    # store bin names are limited to 14 characters
+    record_keys = tuple(attr.replace('_', '') if len(attr) > 14 else attr
+                        for attr in start_attrs)
+
+    __slots__ = start_attrs + ('run_immediately',)
+
     def __init__(self, **kwargs):
         """Initialize this event."""
-        self.start_attrs = [
-            'name', 'task', 'interval', 'crontab', 'args', 'kwargs',
-            'exchange', 'routing_key', 'expires', 'enabled', 'worker_type',
-            'last_run_at', 'total_run_count', 'date_changed', 'description'
-        ]
-
-        for item in self.start_attrs:
+        for item, key in zip(self.start_attrs, self.record_keys):
             if item == 'interval':
-                value = Interval().from_dict(kwargs.get(item, None))
+                value = Interval.from_dict(kwargs.get(item, None))
             elif item == 'crontab':
-                value = Crontab().from_dict(kwargs.get(item, None))
+                value = Crontab.from_dict(kwargs.get(item, None))
             else:
                 value = kwargs.get(item, None)
+                if value is None and key != item:
+                    # records read back from the store use the cut name
+                    value = kwargs.get(key, None)
 
             setattr(self, item, value)
 
@@ -171,6 +241,27 @@ class TaskModel(object):
         self.run_immediately = False
         self.validate()
 
+    @classmethod
+    def from_record(cls, record):
+        """Build a task from a trusted record read back from the store.
+
+        Skips the validation done by __init__, the record was validated
+        when it was put in the store.
+        """
+        result = cls.__new__(cls)
+        for item, key in zip(cls.start_attrs, cls.record_keys):
+            value = record.get(key)
+            if item == 'interval':
+                value = Interval.from_record(value)
+            elif item == 'crontab':
+                value = Crontab.from_record(value)
+            setattr(result, item, value)
+
+        if result.name is None:
+            result.name = str(uuid.uuid4())
+        result.run_immediately = False
+        return result
+
     def validate(self):
         """Validation function.
 
@@ -206,7 +297,7 @@ class TaskModel(object):
     def to_dict(self):
         """Serialize this object to a dict."""
         data = {}
-        for attr in self.start_attrs:
+        for attr, cut_attr in zip(self.start_attrs, self.record_keys):
             if attr in ['interval', 'crontab']:
                 item = getattr(self, attr)
                 if item is not None:
@@ -217,11 +308,6 @@ class TaskModel(object):
                     data.update({attr: None})
                 continue
 
-            if len(attr) > 14:
-                cut_attr = attr.replace('_', '')
-            else:
-                cut_attr = attr
-
             data.update({cut_attr: getattr(self, attr)})
 
         return data
@@ -232,3 +318,48 @@ class TaskModel(object):
         result = cls(data)
 
         return result
+
+
+class LazyTaskModel(TaskModel):
+    """TaskModel over a store record, decoding its fields on first access.
+
+    The schedule is decoded and validated when interval or crontab is
+    first read, so callers only reading a few fields do not pay for it.
+    """
+
+    __slots__ = ('_record',)
+
+    # store bin name of each attribute
+    _keys = dict(zip(TaskModel.start_attrs, TaskModel.record_keys))
+
+    def __init__(self, record):
+        """Wrap a store record."""
+        self._record = record
+        self.run_immediately = False
+
+    @classmethod
+    def from_record(cls, record):
+        """Wrap a trusted record read back from the store."""
+        return cls(record)
+
+    def __getattr__(self, name):
+        """Decode an attribute from the record, on its first access."""
+        key = self._keys.get(name)
+        if key is None:
+            raise AttributeError(name)
+
+        if name in ('interval', 'crontab'):
+            self.interval = Interval.from_record(self._record.get('interval'))
+            self.crontab = Crontab.from_record(self._record.get('crontab'))
+            try:
+                self.validate()
+            except ValueError:
+                # keep failing on the next accesses
+                del self.interval, self.crontab
+                raise
+        else:
+            value = self._record.get(key)
+            if name == 'name' and value is None:
+                value = str(uuid.uuid4())
+            setattr(self, name, value)
+        return getattr(self, name)
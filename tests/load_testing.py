@@ -1 +1,168 @@
-"""Test the EventEngine with varying quantities of simulated workloads."""
\ No newline at end of file
+"""Test the EventEngine with varying quantities of simulated workloads."""
+import gc
+import random
+import sys
+import os
+import time
+tentacle_path = '/'.join(os.path.realpath(__file__).split('/')[:-2])
+sys.path.append(tentacle_path)
+
+from tentacle import Config
+
+# the benchmarks only need the in memory store
+Config.DEFAULT_BACKEND = 'dummy'
+
+from tentacle.schedulers import ScheduleQueue, TimingWheel
+from tentacle.storebackend import get_backend
+from tentacle.taskmodel import TaskModel
+
+SIZES = (10000, 100000, 1000000)
+
+# short interval periods, in seconds
+PERIODS = (1, 5, 10, 30, 60, 300)
+
+# loaded tasks for the memory benchmark
+MEMORY_SIZE = 100000
+
+# read tasks for the get benchmark, from the TENTACLE_BENCH_BACKEND store
+READ_SIZES = (100, 1000, 10000)
+
+
+def bench_run_times(queue_class, size, seconds=30):
+    """Simulate a schedule of short interval tasks on a run time queue.
+
+    Every simulated second the due entries are popped and pushed back
+    at their next run time, as EventScheduler.tick does.
+    Return the load time, the average tick time and the fired count.
+    """
+    random.seed(size)
+    periods = [random.choice(PERIODS) for _ in range(size)]
+
+    # not aligned on the wheel slots, like real run times
+    start = time.time()
+    load_start = time.time()
+    queue = queue_class()
+    for name, period in enumerate(periods):
+        queue.push(name, start + random.uniform(0, period))
+    load_time = time.time() - load_start
+
+    fired = 0
+    tick_start = time.time()
+    for second in range(1, seconds + 1):
+        now = start + second
+        for name in queue.pop_due(now):
+            queue.push(name, now + periods[name])
+            fired += 1
+        queue.next_time()
+    tick_time = (time.time() - tick_start) / seconds
+
+    return load_time, tick_time, fired
+
+
+def test_schedulers():
+    """Compare the EventScheduler heap with the WheelScheduler wheel."""
+    print "RUN TIME QUEUES" + "\n" + ">" * 20
+    print '{:>10} {:>14} {:>10} {:>10} {:>10}'.format(
+        'entries', 'queue', 'load (s)', 'tick (s)', 'fired')
+    for size in SIZES:
+        for queue_class in (ScheduleQueue, TimingWheel):
+            load_time, tick_time, fired = bench_run_times(queue_class, size)
+            print '{:>10} {:>14} {:>10.3f} {:>10.4f} {:>10}'.format(
+                size, queue_class.__name__, load_time, tick_time, fired)
+    print ">" * 20 + "\n"
+
+def make_record(index):
+    """Return a task record, as read back from the store."""
+    record = TaskModel(
+        name='task{}'.format(index), worker_type='nautilus',
+        task='nautilus.tasks.task', enabled=True,
+        kwargs={'id': index, 'jsonrpc': '2.0', 'params': {}},
+        interval={'every': random.choice(PERIODS), 'period': 'seconds'},
+    ).to_dict()
+    record['interval'] = dict(record['interval'])
+    return record
+
+
+def reachable(objects, seen):
+    """Add the ids of the objects reachable from the given ones to seen.
+
+    Return the total size of the newly seen objects.
+    """
+    size = 0
+    pending = list(objects)
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return size
+
+
+def bench_task_memory(size):
+    """Return the bytes used by each TaskModel hydrated from a record.
+
+    Only the memory owned by the tasks is counted, not the record
+    values they point to.
+    """
+    random.seed(size)
+    records = [make_record(index) for index in range(size)]
+    from_record = getattr(TaskModel, 'from_record', None) or \
+        (lambda record: TaskModel(**record))
+
+    seen = set()
+    reachable(records, seen)
+    load_start = time.time()
+    tasks = [from_record(record) for record in records]
+    load_time = time.time() - load_start
+    return float(reachable(tasks, seen)) / size, load_time / size
+
+
+def test_task_memory():
+    """Measure the memory and load time of the loaded tasks."""
+    print "TASK MEMORY" + "\n" + ">" * 20
+    task_size, load_time = bench_task_memory(MEMORY_SIZE)
+    print '{} tasks: {:.0f} bytes and {:.2f} us to load each task'.format(
+        MEMORY_SIZE, task_size, load_time * 10 ** 6)
+    print ">" * 20 + "\n"
+
+def bench_get_many(backend, size):
+    """Return the time to read size tasks with looped get and get_many."""
+    random.seed(size)
+    keys = []
+    for index in range(size):
+        record = make_record(index)
+        backend.put(record['name'], record)
+        keys.append(record['name'])
+
+    start = time.time()
+    for key in keys:
+        backend.get(key)
+    get_time = time.time() - start
+
+    start = time.time()
+    backend.get_many(keys)
+    get_many_time = time.time() - start
+
+    backend.delete_many(keys)
+    return get_time, get_many_time
+
+
+def test_get_many():
+    """Compare looped get calls with one get_many batch read."""
+    backend_name = os.environ.get('TENTACLE_BENCH_BACKEND', 'dummy')
+    backend = get_backend(backend_name)
+    print "BATCH READS ({})".format(backend_name) + "\n" + ">" * 20
+    print '{:>10} {:>10} {:>14}'.format('tasks', 'get (s)', 'get_many (s)')
+    for size in READ_SIZES:
+        get_time, get_many_time = bench_get_many(backend, size)
+        print '{:>10} {:>10.4f} {:>14.4f}'.format(size, get_time,
+                                                  get_many_time)
+    print ">" * 20 + "\n"
+
+if __name__ == '__main__':
+
+    test_schedulers()
+    test_task_memory()
+    test_get_many()
@@ -0,0 +1,79 @@
+"""Unit tests for the Crontab Engine."""
+
+import calendar
+import datetime
+import unittest
+
+from tentacle.crontabengine import CrontabEngine, numpy, to_timestamp
+from tentacle.taskmodel import Crontab
+
+
+def brute_next_run(crontab, after):
+    """Find the next run of a crontab by checking every matching day."""
+    schedule = crontab.schedule
+    start = datetime.datetime.utcfromtimestamp(after)
+    start = start.replace(second=0, microsecond=0)
+    start += datetime.timedelta(minutes=1)
+    day = start.replace(hour=0, minute=0)
+    for _ in range(5 * 366):
+        if day.day in schedule.day_of_month and \
+                day.month in schedule.month_of_year and \
+                day.isoweekday() % 7 in schedule.day_of_week:
+            for hour in sorted(schedule.hour):
+                for minute in sorted(schedule.minute):
+                    current = day.replace(hour=hour, minute=minute)
+                    if current >= start:
+                        return calendar.timegm(current.utctimetuple())
+        day += datetime.timedelta(days=1)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestCrontabEngine(unittest.TestCase):
+    """Tests for the CrontabEngine object."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        self.crontabs = [
+            Crontab.from_dict(data) for data in [
+                {},
+                {'minute': '0'},
+                {'minute': '*/15', 'hour': '9-17'},
+                {'minute': '30', 'hour': '2', 'day_of_week': 'sun'},
+                {'minute': '0', 'hour': '0', 'day_of_month': '1'},
+                {'minute': '5', 'hour': '23', 'day_of_month': '31'},
+                {'minute': '0', 'hour': '12', 'day_of_month': '29',
+                 'month_of_year': '2'},
+                {'minute': '59', 'hour': '*/6', 'day_of_week': '1,3,5',
+                 'day_of_month': '10-20'},
+            ]
+        ]
+        self.engine = CrontabEngine(
+            (str(index), crontab)
+            for index, crontab in enumerate(self.crontabs))
+
+    def test_next_runs(self):
+        """Next runs match a minute by minute search."""
+        for after in ['2016-12-31 23:59:30', '2017-02-28 12:00:00',
+                      '2017-06-15 17:45:10', '2016-02-29 02:29:59']:
+            start = to_timestamp(
+                datetime.datetime.strptime(after, '%Y-%m-%d %H:%M:%S'))
+            runs = self.engine.next_runs([start] * len(self.crontabs))
+            for crontab, run in zip(self.crontabs, runs):
+                self.assertEqual(run, brute_next_run(crontab, start),
+                                 '{} after {}'.format(crontab.to_dict(),
+                                                      after))
+
+    def test_due(self):
+        """Only the schedules with a run before now are due."""
+        start = to_timestamp(datetime.datetime(2017, 1, 1, 0, 0, 30))
+
+        due = self.engine.due(start + 60, [start] * len(self.crontabs))
+        self.assertEqual(due, ['0'])
+        due = self.engine.due(start + 3600, [start] * len(self.crontabs))
+        self.assertEqual(due, ['0', '1'])
+
+    def test_to_timestamp(self):
+        """Naive datetimes are taken as UTC."""
+        value = datetime.datetime(2017, 1, 1, 0, 0, 30)
+
+        self.assertEqual(to_timestamp(value), 1483228830.0)
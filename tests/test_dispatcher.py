@@ -1,8 +1,51 @@
 """Unit tests for the Event Dispatcher."""
+import json
+import time
 import unittest
 
-from tentacle.dispatcher import EventDispatcher
+from amqp.exceptions import NotConfirmed
+from tentacle import Config
+from tentacle.dispatcher import EventDispatcher, HashRing, PreparedMessage
 from kombu import Connection
+from kombu.exceptions import LimitExceeded
+
+
+class ConfirmChannel(object):
+    """Channel in confirm mode answering with an ack, a nack or nothing."""
+
+    def __init__(self, reply):
+        """Initialize the ack callbacks."""
+        self.reply = reply
+        self.events = {'basic_ack': set()}
+
+    def confirm_select(self):
+        pass
+
+    def wait(self, methods, timeout=None):
+        if self.reply == 'nack':
+            raise NotConfirmed('basic.nack')
+        if self.reply == 'ack':
+            for callback in self.events['basic_ack']:
+                callback(self.tentacle_sent, True)
+        else:
+            time.sleep(min(timeout, 0.01))
+
+
+class ConfirmProducer(object):
+    """Producer over a ConfirmChannel."""
+
+    def __init__(self, channel):
+        """Initialize the channel."""
+        self.channel = channel
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def publish(self, body, **kwargs):
+        pass
 
 
 class TestEventDispatcher(unittest.TestCase):
@@ -97,3 +140,137 @@ class TestEventDispatcher(unittest.TestCase):
         #     },
         # }
         # self.assertIsNone(self.evdisp.dispatch(payload))
+
+    def test_dispatch_many(self):
+        """Check that valid tasks are sent and invalid ones skipped."""
+        self.evdisp.nautilus_conn = Connection('memory://')
+        task = {
+            'name': 'smthing',
+            'worker_type': 'nautilus',
+            'exchange': None,
+            'routing_key': None,
+            'task': 'smthing',
+            'kwargs': {
+                'id': 'smthing',
+                'jsonrpc': '2.0',
+                'params': 'params'
+            },
+        }
+        bad_task = dict(task, worker_type='test')
+
+        sent = self.evdisp.dispatch_many([dict(task), bad_task, dict(task)])
+        self.assertEqual(sent, 2)
+
+    def test_dispatch_confirms(self):
+        """Check that nacked or unconfirmed groups are not sent."""
+        self.evdisp.nautilus_conn = Connection('memory://')
+        task = {
+            'name': 'smthing',
+            'worker_type': 'nautilus',
+            'exchange': None,
+            'routing_key': None,
+            'task': 'smthing',
+            'kwargs': {},
+        }
+        confirm, timeout = (Config.DISPATCH_CONFIRM,
+                            Config.DISPATCH_CONFIRM_TIMEOUT)
+        Config.DISPATCH_CONFIRM = True
+        Config.DISPATCH_CONFIRM_TIMEOUT = 0.05
+        try:
+            for reply, expected in (('ack', 2), ('nack', 0), ('none', 0)):
+                channel = ConfirmChannel(reply)
+                self.evdisp.acquire_producer = \
+                    lambda connection: ConfirmProducer(channel)
+                start = time.time()
+                self.assertEqual(
+                    self.evdisp.dispatch_many([dict(task), dict(task)]),
+                    expected)
+                self.assertLess(time.time() - start, 1)
+                self.assertEqual(channel.tentacle_sent, 2)
+        finally:
+            Config.DISPATCH_CONFIRM = confirm
+            Config.DISPATCH_CONFIRM_TIMEOUT = timeout
+
+    def test_get_exchange(self):
+        """Check that exchanges are built once per name."""
+        exchange = self.evdisp.get_exchange('smthing')
+        self.assertIs(self.evdisp.get_exchange('smthing'), exchange)
+        self.assertIsNot(self.evdisp.get_exchange('other'), exchange)
+
+    def test_acquire_producer(self):
+        """Check the dedicated producer pools and their limit."""
+        connection = Connection('memory://')
+        pooled, size, timeout = (Config.DISPATCH_POOLED,
+                                 Config.DISPATCH_POOL_SIZE,
+                                 Config.DISPATCH_ACQUIRE_TIMEOUT)
+        Config.DISPATCH_POOLED = True
+        Config.DISPATCH_POOL_SIZE = 1
+        Config.DISPATCH_ACQUIRE_TIMEOUT = 0.01
+        try:
+            producer = self.evdisp.acquire_producer(connection)
+            self.assertRaises(LimitExceeded,
+                              self.evdisp.acquire_producer, connection)
+            self.assertEqual(self.evdisp.stats['pool_waits'], 1)
+            self.assertEqual(self.evdisp.stats['pool_timeouts'], 1)
+
+            producer.release()
+            self.assertIs(self.evdisp.acquire_producer(connection), producer)
+        finally:
+            Config.DISPATCH_POOLED = pooled
+            Config.DISPATCH_POOL_SIZE = size
+            Config.DISPATCH_ACQUIRE_TIMEOUT = timeout
+
+    def test_hash_ring(self):
+        """Check that keys are spread over the nodes and keep their node."""
+        ring = HashRing(['a', 'b', 'c'])
+        keys = ['task{}'.format(index) for index in range(300)]
+        nodes = [ring.get(key) for key in keys]
+
+        self.assertEqual(set(nodes), set(['a', 'b', 'c']))
+        self.assertEqual([ring.get(key) for key in keys], nodes)
+        # a new node only takes over keys, the others keep their node
+        bigger = HashRing(['a', 'b', 'c', 'd'])
+        for key, node in zip(keys, nodes):
+            self.assertIn(bigger.get(key), (node, 'd'))
+        # named nodes also keep their keys when another node is removed
+        ring = HashRing(['a', 'b', 'c'], names=['a', 'b', 'c'])
+        nodes = [ring.get(key) for key in keys]
+        smaller = HashRing(['a', 'c'], names=['a', 'c'])
+        for key, node in zip(keys, nodes):
+            if node != 'b':
+                self.assertEqual(smaller.get(key), node)
+
+    def test_sharded_connections(self):
+        """Check the broker selection of worker types with several brokers."""
+        first, second = Connection('memory://'), Connection('memory://')
+        self.evdisp.brokers['nautilus'] = HashRing([first, second])
+
+        connections = set(self.evdisp.get_connection('nautilus', index)
+                          for index in range(50))
+        self.assertEqual(connections, set([first, second]))
+        self.assertIs(self.evdisp.get_connection('nautilus', 'smthing'),
+                      self.evdisp.get_connection('nautilus', u'smthing'))
+        self.assertIsNone(self.evdisp.get_connection('test', 'smthing'))
+
+    def test_prepare(self):
+        """Check that prepared messages hold the encoded payload."""
+        self.evdisp.nautilus_conn = Connection('memory://')
+        task = {
+            'name': 'smthing',
+            'worker_type': 'nautilus',
+            'exchange': None,
+            'routing_key': None,
+            'task': 'smthing',
+            'enabled': True,
+            'kwargs': {'id': 'smthing', 'params': 'params'},
+        }
+        message = self.evdisp.prepare(dict(task))
+
+        self.assertIsInstance(message, PreparedMessage)
+        self.assertEqual(message.destination,
+                         ('nautilus', self.evdisp.nautilus_conn,
+                          'nautilus', 'nautilus'))
+        self.assertEqual(message.content_type, 'application/json')
+        self.assertEqual(json.loads(message.body),
+                         {'task': 'smthing', 'kwargs': task['kwargs']})
+        self.assertEqual(self.evdisp.dispatch_many([message, message]), 2)
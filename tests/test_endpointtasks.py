@@ -5,7 +5,8 @@ import unittest
 from celery import current_app
 
 from tentacle.store import EventStore
-from tentacle.endpointtasks import get, put, update, delete, search
+from tentacle.endpointtasks import (get, put, update, delete, search, all,
+                                    bulk_put, bulk_update, bulk_delete)
 from tentacle.taskmodel import TaskModel
 
 app = current_app._get_current_object()
@@ -98,3 +99,83 @@ class TestEndpointTasks(unittest.TestCase):
         """Check search when there are no results."""
         response = search(dict(task_name='kraken'))
         self.assertEqual(response, [])
+
+    def test_bulk_put(self):
+        """Check the bulk put endpoint results."""
+        other = dict(self.task_payload.to_dict(), name='other')
+        response = bulk_put([self.task_payload.to_dict(), {}, other])
+
+        self.assertEqual(response, ['ok', 'nok', 'ok'])
+        self.assertEqual(self.dummy.get('other').name, 'other')
+        self.assertEqual(bulk_put({}), 'nok')
+
+    def test_bulk_update(self):
+        """Check the bulk update endpoint results."""
+        put(self.task_payload.to_dict())
+        self.task_payload.worker_type = 'newsomething'
+        missing = dict(self.task_payload.to_dict(), name='missing')
+        response = bulk_update([self.task_payload.to_dict(), missing])
+
+        self.assertEqual(response, ['ok', 'nok'])
+        self.assertEqual(get(dict(name='something')),
+                         self.task_payload.to_dict())
+        self.assertIsNone(self.dummy.get('missing'))
+
+    def test_bulk_delete(self):
+        """Check the bulk delete endpoint results."""
+        put(self.task_payload.to_dict())
+        response = bulk_delete([dict(name='something'), dict(name='missing'),
+                                {}])
+
+        self.assertEqual(response, ['ok', 'nok', 'nok'])
+        self.assertIsNone(self.dummy.get('something'))
+
+    def test_all_pages(self):
+        """Check that the all endpoint walks the pages with the cursor."""
+        bulk_put([dict(self.task_payload.to_dict(), name='task{}'.format(index))
+                  for index in range(5)])
+
+        names = []
+        page = all({'limit': 2})
+        while True:
+            self.assertLessEqual(len(page['items']), 2)
+            names.extend(item['name'] for item in page['items'])
+            if page['cursor'] is None:
+                break
+            page = all({'limit': 2, 'cursor': page['cursor']})
+        self.assertEqual(names, ['task{}'.format(index) for index in range(5)])
+        self.assertEqual(len(all({})), 5)
+
+    def test_bad_limit(self):
+        """Check that the list endpoints refuse invalid page sizes."""
+        put(self.task_payload.to_dict())
+        for limit in (0, -1, '10', 1.5, True):
+            self.assertEqual(all({'limit': limit}), u'nok')
+            self.assertEqual(search({'worker_type': 'nautilus',
+                                     'limit': limit}), u'nok')
+        self.assertEqual(len(all({'limit': 10})['items']), 1)
+
+    def test_search_pages(self):
+        """Check the search endpoint pages."""
+        put(self.task_payload.to_dict())
+        put(dict(self.task_payload.to_dict(), name='other'))
+        put(dict(self.task_payload.to_dict(), name='kraken',
+                 worker_type='kraken'))
+
+        names = []
+        page = search(dict(task_name='kraken', worker_type='nautilus',
+                           limit=1))
+        while True:
+            self.assertLessEqual(len(page['items']), 1)
+            names.extend(item['name'] for item in page['items'])
+            if page['cursor'] is None:
+                break
+            page = search(dict(task_name='kraken', worker_type='nautilus',
+                               limit=1, cursor=page['cursor']))
+        self.assertEqual(names, ['kraken', 'other', 'something'])
+
+        page = search(dict(task_name='other', worker_type='nautilus',
+                           limit=2))
+        self.assertEqual([item['name'] for item in page['items']],
+                         ['other', 'something'])
+        self.assertIsNone(page['cursor'])
@@ -0,0 +1,127 @@
+"""Unit tests for the Endpoint Worker."""
+
+import unittest
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from celery import current_app
+
+from tentacle import Config
+from tentacle.store import EventStore
+from tentacle.taskmodel import TaskModel
+
+# the endpoint worker app becomes the current one when imported
+default_app = current_app._get_current_object()
+try:
+    from tentacle import endpointworker
+except ImportError:
+    endpointworker = None
+default_app.set_current()
+
+
+class Message(object):
+    """Broker message recording its ack."""
+
+    def __init__(self, body=None):
+        """Initialize the message."""
+        self.body = body
+        self.acked = False
+
+    def ack(self):
+        self.acked = True
+
+
+class RecordingBackend(object):
+    """Result backend keeping the stored results."""
+
+    def __init__(self):
+        """Initialize the results."""
+        self.done = []
+        self.failed = []
+
+    def mark_as_done(self, task_id, result, request=None):
+        self.done.append((task_id, result, request.reply_to))
+
+    def mark_as_failure(self, task_id, exc, traceback=None, request=None):
+        self.failed.append((task_id, exc, request.reply_to))
+
+
+@unittest.skipIf(endpointworker is None, 'siren is not installed')
+class TestEndpointConsumer(unittest.TestCase):
+    """Tests for the inline execution of the EndpointConsumer."""
+
+    def setUp(self):
+        """Replace the result backend and the store of the worker app."""
+        self.app = endpointworker.app
+        self.backend = self.app.backend = RecordingBackend()
+        self.app.event_store = EventStore(backend='dummy')
+        self.consumer = endpointworker.EndpointConsumer(None)
+        self.consumer.acks = deque()
+
+    def tearDown(self):
+        """Restore the result backend of the worker app."""
+        del self.app.backend
+
+    def run_task(self, task):
+        """Run a task inline, checking the message is not acked yet."""
+        message = Message()
+
+        def endpoint(msg):
+            self.assertFalse(message.acked)
+            return task(msg)
+        endpoint.name = 'endpoint'
+
+        self.consumer.run_inline(message, endpoint, {'name': 'test'}, 'id')
+        self.assertFalse(message.acked)
+        self.consumer.flush_acks()
+        self.assertTrue(message.acked)
+
+    def test_run_inline(self):
+        """Check that results are stored and messages acked after."""
+        self.run_task(lambda msg: u'ok')
+        self.assertEqual(self.backend.done, [('id', u'ok', 'id')])
+        self.assertEqual(self.backend.failed, [])
+
+    def test_run_inline_failure(self):
+        """Check that failures are stored and their messages acked."""
+        def fail(msg):
+            raise ValueError('failed')
+        self.run_task(fail)
+        self.assertEqual(self.backend.done, [])
+        self.assertEqual([(task_id, type(exc), reply_to)
+                          for task_id, exc, reply_to in self.backend.failed],
+                         [('id', ValueError, 'id')])
+
+    def run_message(self):
+        """Run a get endpoint message in the pool, return the message."""
+        task = TaskModel(name='something', worker_type='nautilus',
+                         interval={'every': 7, 'period': 'days'})
+        self.app.event_store.put('something', task.to_dict())
+        if Config.CELERY_TASK_SERIALIZER.endswith('json'):
+            dumps = endpointworker.json_dumps
+        else:
+            dumps = endpointworker.msgpack_dumps
+        message = Message(dumps({'action': 'get', 'id': 'id',
+                                 'task': {'name': 'something'}}))
+
+        self.consumer.pool = ThreadPool(1, initializer=self.app.set_current)
+        self.consumer.on_message(message)
+        self.consumer.pool.close()
+        self.consumer.pool.join()
+        self.assertEqual(len(self.backend.done), 1)
+        self.assertEqual(self.backend.done[0][1]['name'], 'something')
+        return message
+
+    def test_on_message(self):
+        """Check that endpoints run in the pool, acked by the hub."""
+        self.consumer.hub = object()
+        message = self.run_message()
+        self.assertFalse(message.acked)
+        self.consumer.flush_acks()
+        self.assertTrue(message.acked)
+
+    def test_on_message_without_hub(self):
+        """Check that messages are acked once processed without a hub."""
+        message = self.run_message()
+        self.assertTrue(message.acked)
+        self.assertEqual(len(self.consumer.acks), 0)
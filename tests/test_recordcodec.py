@@ -0,0 +1,94 @@
+"""Unit tests for the Record Codec."""
+
+import datetime
+import unittest
+
+from pytz import utc
+
+from tentacle.recordcodec import (COMPACT_FORMAT, COMPRESSED, LEGACY_FORMAT,
+                                  PAYLOAD_BIN, RAW, VERSION_BIN, decode,
+                                  encode, msgpack)
+from tentacle.taskmodel import TaskModel
+
+
+@unittest.skipIf(msgpack is None, 'msgpack is not installed')
+class TestRecordCodec(unittest.TestCase):
+    """Tests for the record encoding functions."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        task = TaskModel(name='test', worker_type='nautilus',
+                         task='nautilus.tasks.task', enabled=True,
+                         kwargs={'params': {'id': 1}, 'text': u'caf\xe9'},
+                         interval={'every': 10, 'period': 'seconds'},
+                         expires=datetime.datetime(2017, 1, 1, 12, 30))
+        task.last_run_at = datetime.datetime(2017, 1, 1, 0, 0, 1, 5,
+                                             tzinfo=utc)
+        task.total_run_count = 3
+        self.record = task.to_dict()
+
+    def test_round_trip(self):
+        """Records are decoded as they were before encoding."""
+        bins = encode(self.record)
+
+        self.assertEqual(bins[VERSION_BIN], 1)
+        self.assertEqual(bins['enabled'], 1)
+        self.assertIsNone(bins['exchange'])
+        self.assertIsNone(bins['kwargs'])
+        self.assertEqual(bins[PAYLOAD_BIN][:1], RAW)
+
+        record = decode(bins)
+        self.assertEqual(record, self.record)
+        self.assertIs(record['enabled'], True)
+        self.assertIsNone(record['expires'].tzinfo)
+        self.assertEqual(record['last_run_at'].tzinfo, utc)
+
+    def test_compression(self):
+        """Payloads over the threshold are compressed."""
+        self.record['description'] = 'description ' * 100
+
+        bins = encode(self.record, threshold=100)
+        self.assertEqual(bins[PAYLOAD_BIN][:1], COMPRESSED)
+        self.assertLess(len(bins[PAYLOAD_BIN]), 500)
+        self.assertEqual(decode(bins), self.record)
+
+    def test_legacy(self):
+        """Legacy records are only stripped of the compact bins."""
+        self.assertEqual(encode(self.record, LEGACY_FORMAT),
+                         dict(self.record, v=None, payload=None))
+        self.assertIs(decode(self.record), self.record)
+        self.assertIsNone(decode(None))
+
+    def write(self, stored, bins):
+        """Merge written bins in a stored record, like Aerospike puts."""
+        stored = dict(stored, **bins)
+        return dict((name, value) for name, value in stored.items()
+                    if value is not None)
+
+    def test_clear_field(self):
+        """Fields set to None are cleared from the stored records."""
+        self.record['exchange'] = 'exchange'
+        stored = self.write({}, encode(self.record))
+        self.record['exchange'] = None
+        self.record['kwargs'] = None
+        stored = self.write(stored, encode(self.record))
+        self.assertNotIn('exchange', stored)
+        self.assertEqual(decode(stored), self.record)
+
+    def test_switch_format(self):
+        """Records are read back after the format changes either way."""
+        stored = self.write({}, encode(self.record, LEGACY_FORMAT))
+        self.record['routing_key'] = 'key'
+        self.record['kwargs'] = {'params': {'id': 2}}
+        stored = self.write(stored, encode(self.record, COMPACT_FORMAT))
+        self.assertNotIn('kwargs', stored)
+        self.assertEqual(decode(stored), self.record)
+
+        self.record['routing_key'] = None
+        self.record['description'] = 'legacy'
+        stored = self.write(stored, encode(self.record, LEGACY_FORMAT))
+        self.assertNotIn(VERSION_BIN, stored)
+        self.assertNotIn(PAYLOAD_BIN, stored)
+        self.assertEqual(decode(stored),
+                         dict((key, value) for key, value
+                              in self.record.items() if value is not None))
@@ -0,0 +1,542 @@
+"""Unit tests for the schedulers."""
+
+import datetime
+import time
+import unittest
+
+from celery import Celery, current_app
+from pytz import utc
+
+from tentacle import Config, schedulers
+from tentacle.crontabengine import numpy
+from tentacle.store import EventStore
+from tentacle.storebackend import DummyBackend, StoreUnavailable
+from tentacle.taskmodel import TaskModel
+
+
+class RecordingDispatcher(object):
+    """Dispatcher keeping the names of the sent tasks."""
+
+    def __init__(self):
+        """Initialize the sent list."""
+        self.sent = []
+
+    def prepare(self, task):
+        return task['name']
+
+    def dispatch(self, message):
+        self.sent.append(message)
+
+    def dispatch_many(self, messages):
+        self.sent.extend(messages)
+        return len(messages)
+
+
+class Clock(object):
+    """Clock of the schedulers, only moved forward by the tests."""
+
+    mktime = staticmethod(time.mktime)
+
+    def __init__(self, start):
+        """Initialize the current time."""
+        self.current = start
+
+    def time(self):
+        return self.current
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.current, utc)
+
+    def sleep(self, seconds):
+        self.current += seconds
+
+
+class SchedulerTestCase(unittest.TestCase):
+    """Base of the scheduler tests, over a DummyBackend store."""
+
+    def setUp(self):
+        """Replace the event store and the clock of the schedulers."""
+        self.app = Celery('tentacle', set_as_current=False)
+        self.app.config_from_object(Config)
+        self.store = EventStore(backend=DummyBackend())
+        self._event_store = schedulers.event_store
+        schedulers.event_store = self.store
+
+        # the entries and schedules use the current app
+        self.clock = Clock(1500000000.0)
+        self.apps = [self.app, current_app._get_current_object()]
+        for app in self.apps:
+            app.now = self.clock.now
+        schedulers.time = self.clock
+
+    def tearDown(self):
+        """Restore the event store and the clock of the schedulers."""
+        schedulers.event_store = self._event_store
+        schedulers.time = time
+        for app in self.apps:
+            del app.now
+
+    def add_task(self, name, **kwargs):
+        """Put an enabled interval task in the store."""
+        kwargs.setdefault('interval', {'every': 1, 'period': 'days'})
+        task = TaskModel(name=name, worker_type='nautilus', task='task',
+                         enabled=True, **kwargs)
+        self.store.put(name, task.to_dict())
+
+    def make_scheduler(self, scheduler_class=schedulers.EventScheduler):
+        """Return a scheduler sending the tasks to a RecordingDispatcher."""
+        scheduler = scheduler_class(self.app)
+        scheduler.dispatcher = RecordingDispatcher()
+        return scheduler
+
+    def run_ticks(self, scheduler, seconds):
+        """Run the scheduler loop for a while of the test clock."""
+        end = self.clock.time() + seconds
+        while self.clock.time() < end:
+            self.clock.sleep(max(scheduler.tick(), 0.001))
+
+
+class TestScheduleQueue(unittest.TestCase):
+    """Tests for the ScheduleQueue object."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        self.queue = schedulers.ScheduleQueue()
+
+    def test_push_pop(self):
+        """Entries are popped in run time order, once due."""
+        self.queue.push('second', 2)
+        self.queue.push('third', 3)
+        self.queue.push('first', 1)
+        self.assertEqual(len(self.queue), 3)
+        self.assertEqual(self.queue.next_time(), 1)
+
+        self.assertEqual(self.queue.pop_due(0.5), [])
+        self.assertEqual(self.queue.pop_due(2), ['first', 'second'])
+        self.assertNotIn('first', self.queue)
+        self.assertEqual(self.queue.next_time(), 3)
+        self.assertEqual(self.queue.pop_due(10), ['third'])
+        self.assertIsNone(self.queue.next_time())
+
+    def test_replace(self):
+        """Pushing a queued entry again replaces its run time."""
+        self.queue.push('task', 1)
+        self.queue.push('task', 5)
+        self.queue.push('other', 3)
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.pop_due(4), ['other'])
+        self.assertEqual(self.queue.next_time(), 5)
+        self.queue.push('task', 2)
+        self.assertEqual(self.queue.pop_due(10), ['task'])
+
+        for when in range(1000):
+            self.queue.push('task', when)
+        self.assertLess(len(self.queue._heap), 200)
+        self.assertEqual(self.queue.pop_due(1000), ['task'])
+
+    def test_remove(self):
+        """Removed entries are never popped."""
+        self.queue.push('task', 1)
+        self.queue.push('other', 2)
+        self.queue.remove('task')
+        self.queue.remove('missing')
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.next_time(), 2)
+        self.assertEqual(self.queue.pop_due(10), ['other'])
+
+
+class TestEventScheduler(SchedulerTestCase):
+    """Tests for the EventScheduler object."""
+
+    def test_tick(self):
+        """Due entries are sent and queued again at their next run."""
+        self.add_task('fast', interval={'every': 5, 'period': 'seconds'})
+        self.add_task('slow')
+        scheduler = self.make_scheduler()
+
+        self.assertEqual(scheduler.tick(), 5)
+        self.assertEqual(scheduler.dispatcher.sent, [])
+        self.assertEqual(len(scheduler._queue), 2)
+
+        self.clock.sleep(5.5)
+        self.assertEqual(scheduler.tick(), 5)
+        self.assertEqual(scheduler.dispatcher.sent, ['fast'])
+        self.assertEqual(scheduler._queue.next_time(),
+                         self.clock.time() + 5)
+        self.assertEqual(scheduler._dirty, {'fast': 1})
+
+    def test_merge_changes(self):
+        """Incremental updates only merge the tasks changed in the store."""
+        for name in ('updated', 'deleted', 'kept'):
+            self.add_task(name)
+        incremental = Config.INCREMENTAL_UPDATE
+        Config.INCREMENTAL_UPDATE = True
+        try:
+            scheduler = self.make_scheduler()
+            schedule = scheduler.schedule
+            kept = schedule['kept']
+            scheduler.reserve(schedule['updated'])
+            scheduler.sync()
+
+            self.add_task('updated', kwargs={'changed': True})
+            self.add_task('new')
+            self.store.delete('deleted')
+            scheduler._last_updated = None
+            schedule = scheduler.schedule
+
+            self.assertIs(schedule['kept'], kept)
+            self.assertEqual(schedule['updated']._task.kwargs,
+                             {'changed': True})
+            self.assertEqual(schedule['updated']._task.total_run_count, 1)
+            self.assertIn('new', schedule)
+            self.assertIn('new', scheduler._queue)
+            # deleted tasks are only dropped by full updates
+            self.assertIn('deleted', schedule)
+
+            scheduler._last_updated = scheduler._last_full_update = None
+            schedule = scheduler.schedule
+            self.assertEqual(sorted(schedule), ['kept', 'new', 'updated'])
+            self.assertNotIn('deleted', scheduler._queue)
+        finally:
+            Config.INCREMENTAL_UPDATE = incremental
+
+    def test_tick_empty(self):
+        """An empty schedule sleeps for the maximum interval."""
+        scheduler = self.make_scheduler()
+        self.assertEqual(scheduler.tick(), scheduler.max_interval)
+
+
+class TestTimingWheel(unittest.TestCase):
+    """Tests for the TimingWheel object."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        # 2.5 ticks before a level 0 cascade
+        self.start = 64 * 10 ** 6 - 2.5
+        self.wheel = schedulers.TimingWheel(resolution=1, start=self.start)
+
+    def test_push_pop(self):
+        """Entries are popped at their run time, not at their slot."""
+        self.wheel.push('late', self.start + 100.7)
+        self.wheel.push('first', self.start + 0.3)
+        self.wheel.push('second', self.start + 0.6)
+        self.wheel.push('past', self.start - 5)
+        self.assertEqual(len(self.wheel), 4)
+        self.assertEqual(self.wheel.next_time(), self.start - 5)
+
+        self.assertEqual(self.wheel.pop_due(self.start), ['past'])
+        self.assertEqual(self.wheel.next_time(), self.start + 0.3)
+        self.assertEqual(self.wheel.pop_due(self.start + 0.5), ['first'])
+        self.assertEqual(self.wheel.pop_due(self.start + 0.7), ['second'])
+        # past the first level slots, only a lower bound
+        self.assertLessEqual(self.wheel.next_time(), self.start + 100.7)
+        self.assertGreater(self.wheel.next_time(), self.start + 0.7)
+        self.assertEqual(self.wheel.pop_due(self.start + 100.6), [])
+        self.assertEqual(self.wheel.pop_due(self.start + 100.7), ['late'])
+        self.assertEqual(len(self.wheel), 0)
+        self.assertIsNone(self.wheel.next_time())
+
+    def test_replace(self):
+        """Pushing a queued entry again moves it."""
+        self.wheel.push('task', self.start + 0.2)
+        self.wheel.push('task', self.start + 3.4)
+        self.assertEqual(self.wheel.pop_due(self.start + 1), [])
+        self.assertLessEqual(self.wheel.next_time(), self.start + 3.4)
+        self.assertEqual(self.wheel.pop_due(self.start + 3.3), [])
+        self.assertEqual(self.wheel.next_time(), self.start + 3.4)
+        self.wheel.push('task', self.start + 1.5)
+        self.assertEqual(self.wheel.pop_due(self.start + 2), ['task'])
+        self.assertEqual(self.wheel.pop_due(self.start + 4), [])
+
+    def test_remove(self):
+        """Removed entries are never popped."""
+        self.wheel.push('task', self.start + 70.2)
+        self.wheel.push('other', self.start + 0.1)
+        self.wheel.remove('task')
+        self.wheel.remove('missing')
+        self.assertNotIn('task', self.wheel)
+        self.assertEqual(self.wheel.pop_due(self.start + 100), ['other'])
+
+
+class TestWheelScheduler(SchedulerTestCase):
+    """Tests for the WheelScheduler object."""
+
+    def test_run_rate(self):
+        """Tasks run as often as with the heap of the EventScheduler."""
+        self.add_task('fast', interval={'every': 2500000,
+                                        'period': 'microseconds'})
+        for scheduler_class in (schedulers.EventScheduler,
+                                schedulers.WheelScheduler):
+            scheduler = self.make_scheduler(scheduler_class)
+            self.run_ticks(scheduler, 101)
+            self.assertEqual(len(scheduler.dispatcher.sent), 40)
+
+
+class TestPartitionedScheduler(SchedulerTestCase):
+    """Tests for the PartitionedScheduler object."""
+
+    def setUp(self):
+        """Put tasks in the store."""
+        SchedulerTestCase.setUp(self)
+        self.names = ['task{}'.format(index) for index in range(50)]
+        for name in self.names:
+            self.add_task(name)
+
+    def make_member(self, member):
+        """Return a PartitionedScheduler named member."""
+        scheduler_member = Config.SCHEDULER_MEMBER
+        Config.SCHEDULER_MEMBER = member
+        try:
+            return self.make_scheduler(schedulers.PartitionedScheduler)
+        finally:
+            Config.SCHEDULER_MEMBER = scheduler_member
+
+    def load(self, scheduler):
+        """Return the names on the updated schedule of a scheduler."""
+        scheduler._last_updated = None
+        return set(scheduler.schedule)
+
+    def test_shards(self):
+        """A single scheduler runs every shard and task."""
+        scheduler = self.make_member('first')
+        self.assertEqual(self.load(scheduler), set(self.names))
+        self.assertEqual(len(scheduler._shards), Config.SCHEDULER_SHARDS)
+        self.assertTrue(all(scheduler.owns(name) for name in self.names))
+        self.assertIn(schedulers.shard_of('task0'),
+                      range(Config.SCHEDULER_SHARDS))
+        self.assertEqual(schedulers.shard_of('task0'),
+                         schedulers.shard_of('task0'))
+
+    def test_rebalance(self):
+        """Shards move to joining schedulers and back from leaving ones."""
+        first = self.make_member('first')
+        self.load(first)
+        second = self.make_member('second')
+        # the shards of second are still leased by first
+        self.assertEqual(self.load(second), set())
+
+        self.load(first)
+        second_names = self.load(second)
+        first_names = self.load(first)
+        self.assertTrue(first_names and second_names)
+        self.assertEqual(first_names | second_names, set(self.names))
+        self.assertFalse(first_names & second_names)
+        self.assertFalse(set(first._shards) & set(second._shards))
+        self.assertEqual(len(first._shards) + len(second._shards),
+                         Config.SCHEDULER_SHARDS)
+
+        second.close()
+        self.assertEqual(second._shards, {})
+        self.assertEqual(self.load(first), set(self.names))
+        self.assertEqual(len(first._shards), Config.SCHEDULER_SHARDS)
+
+    def test_store_unavailable(self):
+        """Tasks are not sent when their runs cannot be recorded."""
+        scheduler = self.make_member('first')
+        self.load(scheduler)
+        entry = scheduler.reserve(scheduler.schedule['task0'])
+
+        def update_many(items):
+            raise StoreUnavailable('down')
+        self.store.update_many = update_many
+        scheduler.dispatch_entries([entry])
+        self.assertEqual(scheduler.dispatcher.sent, [])
+        self.assertEqual(scheduler._dirty, {'task0': 1})
+
+        del self.store.update_many
+        scheduler.dispatch_entries([entry])
+        self.assertEqual(scheduler.dispatcher.sent, ['task0'])
+        self.assertEqual(scheduler._dirty, {})
+
+    def test_slow_sync(self):
+        """Tasks are not sent when their lease ends while syncing."""
+        scheduler = self.make_member('first')
+        self.load(scheduler)
+        entry = scheduler.reserve(scheduler.schedule['task0'])
+
+        update_many = self.store.update_many
+
+        def slow_update_many(items):
+            self.clock.sleep(Config.SCHEDULER_LEASE_TTL)
+            return update_many(items)
+        self.store.update_many = slow_update_many
+        scheduler.dispatch_entries([entry])
+        self.assertEqual(scheduler.dispatcher.sent, [])
+        self.assertEqual(self.store.get('task0').total_run_count, 1)
+
+    def test_maybe_due(self):
+        """Only the due tasks of the owned shards are sent."""
+        self.add_task('due', interval={'every': 5, 'period': 'seconds'})
+        scheduler = self.make_member('first')
+        schedule = scheduler.schedule
+        self.clock.sleep(6)
+
+        shard = scheduler._shards.pop(schedulers.shard_of('due'))
+        self.assertEqual(scheduler.maybe_due(schedule['due']), 5)
+        self.assertEqual(scheduler.dispatcher.sent, [])
+        self.assertEqual(scheduler._dirty, {})
+
+        scheduler._shards[schedulers.shard_of('due')] = shard
+        self.assertEqual(scheduler.maybe_due(schedule['due']), 5)
+        self.assertEqual(scheduler.dispatcher.sent, ['due'])
+        self.assertEqual(self.store.get('due').total_run_count, 1)
+        self.assertEqual(scheduler.maybe_due(schedule['task0']),
+                         schedule['task0'].is_due()[1])
+        self.assertEqual(scheduler.dispatcher.sent, ['due'])
+
+
+@unittest.skipIf(schedulers.numpy is None, 'numpy is not installed')
+class TestTableScheduler(SchedulerTestCase):
+    """Tests for the TableScheduler object."""
+
+    def make_scheduler(self, scheduler_class=schedulers.TableScheduler):
+        """Return a TableScheduler sending to a RecordingDispatcher."""
+        return SchedulerTestCase.make_scheduler(self, scheduler_class)
+
+    def row(self, scheduler, name):
+        """Return the table row of a task."""
+        return scheduler.schedule.rows[name]
+
+    def test_tick(self):
+        """Due rows are sent and advanced to their next run."""
+        self.add_task('fast', interval={'every': 5, 'period': 'seconds'})
+        self.add_task('slow')
+        scheduler = self.make_scheduler()
+
+        self.assertEqual(scheduler.tick(), 5)
+        self.assertEqual(scheduler.dispatcher.sent, [])
+        self.assertEqual(sorted(scheduler.schedule), ['fast', 'slow'])
+
+        self.clock.sleep(5.5)
+        self.assertEqual(scheduler.tick(), 5)
+        self.assertEqual(scheduler.dispatcher.sent, ['fast'])
+        table, row = scheduler.schedule, self.row(scheduler, 'fast')
+        self.assertEqual(table.next_run[row], self.clock.time() + 5)
+        self.assertEqual(table.last_run_at[row], self.clock.time())
+        self.assertEqual(table.run_count[row], 1)
+        self.assertEqual(table.dirty[row], 1)
+        self.assertEqual(table.dirty[self.row(scheduler, 'slow')], 0)
+
+    def test_tick_empty(self):
+        """An empty table sleeps for the maximum interval."""
+        scheduler = self.make_scheduler()
+        self.assertEqual(scheduler.tick(), scheduler.max_interval)
+
+        self.add_task('disabled')
+        self.store.update('disabled', {'enabled': False})
+        scheduler._last_updated = None
+        self.assertEqual(scheduler.tick(), scheduler.max_interval)
+
+    def test_crontab(self):
+        """Crontab rows get the same next run with or without the engine."""
+        # 2017-07-14 02:40 UTC, the next run is at 03:00
+        self.add_task('hourly', interval=None, crontab={'minute': '0'})
+        scheduler = self.make_scheduler()
+        table, row = scheduler.schedule, self.row(scheduler, 'hourly')
+        self.assertTrue(numpy.isnan(table.period[row]))
+        self.assertEqual(table.next_run[row], self.clock.time() + 1200)
+
+        scheduler.use_crontab_engine = lambda: False
+        table.next_run[row] = 0
+        scheduler.update_next_runs(numpy.array([row]))
+        self.assertEqual(table.next_run[row], self.clock.time() + 1200)
+
+    def test_merge_entries(self):
+        """Only changed records replace their rows, keeping the runs."""
+        for name in ('updated', 'deleted', 'kept'):
+            self.add_task(name)
+        scheduler = self.make_scheduler()
+        table = scheduler.schedule
+        table.messages[self.row(scheduler, 'kept')] = 'kept'
+        updated = self.row(scheduler, 'updated')
+        table.last_run_at[updated] = self.clock.time() + 10
+        table.run_count[updated] = 3
+
+        self.add_task('updated', kwargs={'changed': True})
+        self.store.delete('deleted')
+        records = list(self.store.iter_all_raw())
+        broken = dict(records[0], name='broken', interval=None, crontab=None)
+        self.assertEqual(scheduler.merge_entries(records + [broken]), 1)
+
+        updated = self.row(scheduler, 'updated')
+        self.assertEqual(table['updated']['kwargs'], {'changed': True})
+        self.assertEqual(table.run_count[updated], 3)
+        self.assertEqual(table.next_run[updated],
+                         self.clock.time() + 10 + 86400)
+        self.assertEqual(table.messages[self.row(scheduler, 'kept')], 'kept')
+        self.assertNotIn('broken', table)
+        # deleted tasks are only dropped when pruning
+        self.assertIn('deleted', table)
+
+        self.assertEqual(scheduler.merge_entries(records, prune=True), 0)
+        self.assertEqual(sorted(table), ['kept', 'updated'])
+        self.assertEqual(table.messages[self.row(scheduler, 'kept')], 'kept')
+
+    def test_sync(self):
+        """Runs are flushed to the store once, with aware run times."""
+        self.add_task('fast', interval={'every': 5, 'period': 'seconds'})
+        self.add_task('slow')
+        scheduler = self.make_scheduler()
+        self.run_ticks(scheduler, 11)
+        table = scheduler.schedule
+        last_run_at = table.last_run_at[self.row(scheduler, 'fast')]
+        scheduler.sync()
+
+        task = self.store.get('fast')
+        self.assertEqual(task.total_run_count, 2)
+        self.assertEqual(task.last_run_at,
+                         datetime.datetime.fromtimestamp(last_run_at, utc))
+        self.assertFalse(self.store.get('slow').total_run_count)
+        self.assertEqual(table.dirty[:len(table)].tolist(), [0, 0])
+        self.assertEqual(table['fast']['totalruncount'], 2)
+        self.assertEqual(table['fast']['last_run_at'].tzinfo, utc)
+
+        def update_many(items):
+            raise AssertionError('nothing to flush')
+        self.store.update_many = update_many
+        scheduler.sync()
+
+    def test_dispatch_failures(self):
+        """Tasks that cannot be prepared are skipped, send errors logged."""
+        for name in ('first', 'broken', 'last'):
+            self.add_task(name, interval={'every': 5, 'period': 'seconds'})
+        scheduler = self.make_scheduler()
+        prepare = scheduler.dispatcher.prepare
+
+        def failing_prepare(task):
+            if task['name'] == 'broken':
+                raise ValueError('broken')
+            return prepare(task)
+        scheduler.dispatcher.prepare = failing_prepare
+        self.run_ticks(scheduler, 6)
+        self.assertEqual(sorted(scheduler.dispatcher.sent), ['first', 'last'])
+        self.assertIsNone(
+            scheduler.schedule.messages[self.row(scheduler, 'broken')])
+
+        def dispatch_many(messages):
+            raise IOError('broker down')
+        scheduler.dispatcher.dispatch_many = dispatch_many
+        self.run_ticks(scheduler, 5)
+        self.assertEqual(len(scheduler.dispatcher.sent), 2)
+        self.assertEqual(scheduler.schedule.run_count[:3].tolist(), [2, 2, 2])
+
+    def test_epoch(self):
+        """Run times round trip through epoch seconds as aware UTC."""
+        scheduler = self.make_scheduler()
+        now = self.clock.now()
+        run_time = scheduler.from_epoch(self.clock.time() + 0.25)
+        self.assertEqual(run_time.tzinfo, utc)
+        self.assertEqual(run_time - now, datetime.timedelta(seconds=0.25))
+        self.assertEqual(scheduler.to_epoch(run_time),
+                         self.clock.time() + 0.25)
+        self.assertEqual(scheduler.to_epoch(now.replace(tzinfo=None)),
+                         self.clock.time())
+        self.assertIsNone(scheduler.to_epoch(None))
+
+        # aware run times do not depend on the app timezone
+        self.app.conf.CELERY_ENABLE_UTC = False
+        self.assertEqual(scheduler.to_epoch(run_time),
+                         self.clock.time() + 0.25)
+        self.assertEqual(scheduler.to_epoch(
+            datetime.datetime.fromtimestamp(self.clock.time())),
+            self.clock.time())
@@ -0,0 +1,53 @@
+"""Unit tests for the Schedule Table."""
+
+import unittest
+
+from tentacle.crontabengine import numpy
+from tentacle.scheduletable import ScheduleTable
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestScheduleTable(unittest.TestCase):
+    """Tests for the ScheduleTable object."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        self.table = ScheduleTable(capacity=2)
+        for index in range(5):
+            self.table.set('task{}'.format(index), {'index': index},
+                           next_run=100 + index, enabled=index != 1,
+                           worker_type='nautilus')
+
+    def test_set(self):
+        """Check that rows are added, grown and replaced."""
+        self.assertEqual(len(self.table), 5)
+        self.assertEqual(self.table['task3'], {'index': 3})
+        self.assertEqual(self.table.worker_types, ['nautilus'])
+
+        self.table.messages[0] = 'message'
+        row = self.table.set('task0', {'index': 10}, next_run=50,
+                             worker_type='kraken')
+        self.assertEqual(row, 0)
+        self.assertEqual(len(self.table), 5)
+        self.assertIsNone(self.table.messages[0])
+        self.assertEqual(self.table.worker_type[0], 1)
+        self.assertFalse(self.table.enabled[0])
+
+    def test_remove(self):
+        """Check that the last row takes the place of a removed one."""
+        self.table.remove('task1')
+        self.table.remove('test')
+
+        self.assertEqual(len(self.table), 4)
+        self.assertNotIn('task1', self.table)
+        self.assertEqual(self.table.rows['task4'], 1)
+        self.assertEqual(self.table.next_run[1], 104)
+        self.assertEqual(self.table.get('task4'), {'index': 4})
+
+    def test_due(self):
+        """Only the enabled rows with a past next run are due."""
+        self.assertEqual(list(self.table.due(102)), [0, 2])
+        self.assertEqual(self.table.next_time(), 100)
+
+        self.table.enabled[:] = False
+        self.assertIsNone(self.table.next_time())
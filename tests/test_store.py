@@ -6,6 +6,7 @@ from celery import current_app
 
 from tentacle.store import EventStore
 from tentacle.storebackend import DummyBackend
+from tentacle.taskmodel import TaskModel
 
 
 class TestEventStore(unittest.TestCase):
@@ -63,3 +64,157 @@ class TestEventStore(unittest.TestCase):
 
         self.evstore.delete('key')
         self.assertIsNone(self.evstore.get('key'))
+
+    def test_changed_since(self):
+        """Check that only the tasks changed after the token are returned."""
+        self.evstore.put('first', {'name': 'first',
+                                   'interval': {'every': 7,
+                                                'period': 'days'}})
+        token = self.evstore.change_token()
+        self.evstore.put('second', {'name': 'second',
+                                    'interval': {'every': 7,
+                                                 'period': 'days'}})
+
+        changed = self.evstore.changed_since(token)
+        self.assertEqual([item.name for item in changed], ['second'])
+        self.assertEqual(self.evstore.changed_since(
+            self.evstore.change_token()), [])
+
+    def test_put_many(self):
+        """Check the put_many method."""
+        self.evstore.put_many({'key': 'value', 'other': 'value2'})
+
+        self.assertEqual(self.dummy.get('key'), 'value')
+        self.assertEqual(self.dummy.get('other'), 'value2')
+
+    def test_delete_many(self):
+        """Check the delete_many method."""
+        self.evstore.put_many({'key': 'value', 'other': 'value2'})
+
+        self.assertEqual(self.evstore.delete_many(['key', 'missing']),
+                         ['missing'])
+        self.assertIsNone(self.dummy.get('key'))
+        self.assertEqual(self.dummy.get('other'), 'value2')
+
+    def test_find(self):
+        """Check that find follows the changes of the indexed fields."""
+        self.evstore.put_many({
+            'key': {'name': 'key', 'worker_type': 'nautilus'},
+            'other': {'name': 'other', 'worker_type': 'kraken'},
+        })
+        self.assertEqual(self.dummy.find('worker_type', 'nautilus'),
+                         [{'name': 'key', 'worker_type': 'nautilus'}])
+
+        self.evstore.put('other', {'name': 'other', 'worker_type': 'nautilus'})
+        self.evstore.delete('key')
+        self.assertEqual(self.dummy.find('worker_type', 'nautilus'),
+                         [{'name': 'other', 'worker_type': 'nautilus'}])
+        self.assertEqual(self.dummy.find('worker_type', 'kraken'), [])
+        self.assertEqual(self.dummy.find('name', 'other'),
+                         [{'name': 'other', 'worker_type': 'nautilus'}])
+
+    def test_iter_all(self):
+        """Check that iter_all yields the tasks one at a time."""
+        task = TaskModel(name='key', worker_type='nautilus',
+                         interval={'every': 1, 'period': 'days'})
+        self.evstore.put('key', task.to_dict())
+
+        tasks = self.evstore.iter_all()
+        self.assertFalse(isinstance(tasks, list))
+        self.assertEqual([item.to_dict() for item in tasks],
+                         [task.to_dict()])
+
+    def test_get_many(self):
+        """Check that get_many returns the existing tasks by name."""
+        task = TaskModel(name='key', worker_type='nautilus',
+                         interval={'every': 1, 'period': 'days'})
+        self.evstore.put('key', task.to_dict())
+
+        tasks = self.evstore.get_many(['key', 'missing'])
+        self.assertEqual(tasks.keys(), ['key'])
+        self.assertEqual(tasks['key'].to_dict(), task.to_dict())
+
+    def test_update(self):
+        """Check that updates only change the given fields of existing tasks."""
+        task = TaskModel(name='key', worker_type='nautilus',
+                         interval={'every': 1, 'period': 'days'})
+        self.evstore.put('key', task.to_dict())
+
+        self.assertTrue(self.evstore.update('key', {'totalruncount': 2},
+                                            {'last_run_at': 'now'}))
+        failed = self.evstore.update_many({
+            'key': ({'totalruncount': 1}, {'enabled': True}),
+            'missing': ({'totalruncount': 1}, None),
+        })
+        self.assertEqual(failed, ['missing'])
+        self.assertIsNone(self.dummy.get('missing'))
+
+        task = self.evstore.get('key')
+        self.assertEqual(task.total_run_count, 3)
+        self.assertEqual(task.last_run_at, 'now')
+        self.assertTrue(task.enabled)
+        self.assertEqual(task.worker_type, 'nautilus')
+
+    def test_cache(self):
+        """Check the cache hits, invalidation and size bound."""
+        evstore = EventStore(backend=self.dummy, cache_size=2, cache_ttl=60)
+        for key in ('first', 'second', 'third'):
+            evstore.put(key, {'name': key,
+                              'interval': {'every': 1, 'period': 'days'}})
+
+        evstore.get('first')
+        self.dummy.put('first', dict(self.dummy.get('first'),
+                                     worker_type='nautilus'))
+        self.assertIsNone(evstore.get('first').worker_type)
+        self.assertEqual((evstore.cache.hits, evstore.cache.misses), (1, 1))
+
+        evstore.put('first', self.dummy.get('first'))
+        self.assertEqual(evstore.get('first').worker_type, 'nautilus')
+
+        evstore.get_many(['first', 'second', 'third'])
+        self.assertEqual(len(evstore.cache), 2)
+        self.assertEqual((evstore.cache.hits, evstore.cache.misses), (2, 4))
+
+    def test_cache_concurrent_writes(self):
+        """Check that reads racing a write do not cache the old record."""
+        evstore = EventStore(backend=self.dummy, cache_size=10, cache_ttl=60)
+        old = {'name': 'key', 'interval': {'every': 1, 'period': 'days'}}
+        new = dict(old, worker_type='nautilus')
+        evstore.put('key', old)
+        get = self.dummy.get
+
+        # a read while the backend writes
+        def reading_put(key, value):
+            evstore.get('key')
+            DummyBackend.put(self.dummy, key, value)
+        self.dummy.put = reading_put
+        evstore.put('key', new)
+        self.assertEqual(evstore.get('key').worker_type, 'nautilus')
+
+        # a write while the backend reads
+        def writing_get(key):
+            record = get(key)
+            evstore.put(key, old)
+            return record
+        del self.dummy.put
+        self.dummy.get = writing_get
+        evstore.cache.invalidate('key')
+        self.assertEqual(evstore.get('key').worker_type, 'nautilus')
+        del self.dummy.get
+        self.assertIsNone(evstore.get('key').worker_type)
+
+    def test_raw_variants(self):
+        """Check that the raw variants return the stored records."""
+        record = {'name': 'key', 'worker_type': 'nautilus',
+                  'interval': {'every': 1, 'period': 'days'}}
+        self.evstore.put('key', record)
+
+        self.assertIs(self.evstore.get_raw('key'), record)
+        self.assertEqual(self.evstore.all_raw(), [record])
+        self.assertEqual(list(self.evstore.iter_all_raw()), [record])
+        self.assertEqual(self.evstore.find_raw('worker_type', 'nautilus'),
+                         [record])
+        self.assertEqual(self.evstore.get_many_raw(['key']), {'key': record})
+        self.assertEqual(self.evstore.scan_page_raw(), ([record], None))
+        self.assertEqual(self.evstore.changed_since_raw(0), [record])
+        self.assertIsInstance(self.evstore.get('key'), TaskModel)
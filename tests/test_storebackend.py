@@ -0,0 +1,422 @@
+"""Unit tests for the store backends."""
+
+import threading
+import unittest
+
+import aerospike
+
+from tentacle import Config, storebackend
+from tentacle.storebackend import (AerospikeBackend, BaseBackend,
+                                   CircuitBreaker, DummyBackend,
+                                   FailoverBackend, StoreUnavailable)
+
+
+class FlakyBackend(DummyBackend):
+    """DummyBackend that can be made unavailable."""
+
+    down = False
+
+    def __getattribute__(self, name):
+        """Fail the backend methods while down."""
+        if name in ('get', 'put', 'delete', 'update', 'all', 'iter_all',
+                    'get_many', 'put_many', 'update_many', 'find',
+                    'scan_page') and \
+                object.__getattribute__(self, 'down'):
+            raise StoreUnavailable('down')
+        return object.__getattribute__(self, name)
+
+
+class FakeQuery(object):
+    """Aerospike scan or query returning the records of a FakeClient."""
+
+    def __init__(self, client, kind):
+        """Initialize the query."""
+        self.client = client
+        self.kind = kind
+        self.predicates = None
+
+    def select(self, *bins):
+        pass
+
+    def predexp(self, predicates):
+        self.predicates = predicates
+
+    def foreach(self, callback, policy=None, options=None):
+        for bins in self.client.records:
+            self.client.call('foreach')
+            if callback((('test', 'tasks', bins['name']), {}, bins)) is False:
+                self.client.aborted = True
+                return
+
+    def results(self, policy=None):
+        self.client.queries.append((self.kind, self.predicates))
+        return [(('test', 'tasks', bins['name']), {}, bins)
+                for bins in self.client.records]
+
+
+class FakeClient(object):
+    """Aerospike client recording the queries and scans it runs."""
+
+    def __init__(self, records=()):
+        """Initialize the records and the calls."""
+        self.records = list(records)
+        self.queries = []
+        self.calls = []
+        self.connected = True
+        self.connects = 0
+        self.down = False
+        self.aborted = False
+
+    def connect(self, username=None, password=None):
+        self.connected = True
+        self.connects += 1
+        return self
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+    def call(self, name):
+        """Record a call, failing while the cluster is down."""
+        self.calls.append(name)
+        if self.down:
+            raise aerospike.exception.TimeoutError('timed out')
+
+    def info_all(self, command, policy=None):
+        self.call('info_all')
+        return {}
+
+    def put(self, key, bins, meta=None, policy=None):
+        self.call('put')
+        self.records.append(dict((name, value) for name, value in bins.items()
+                                 if not isinstance(value, aerospike.null)))
+
+    def get(self, key, policy=None):
+        self.call('get')
+        for bins in self.records:
+            if bins['name'] == key[2]:
+                return key, {}, bins
+        raise aerospike.exception.RecordNotFound('not found')
+
+    def scan(self, namespace, setname):
+        return FakeQuery(self, 'scan')
+
+    def query(self, namespace, setname):
+        return FakeQuery(self, 'query')
+
+
+class TestAerospikeBackend(unittest.TestCase):
+    """Tests for the AerospikeBackend object, over a FakeClient."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        self.client = FakeClient([{'name': 'first'}, {'name': 'second'}])
+        self.backend = AerospikeBackend()
+        self.backend._client = self.client
+        # new connections get the same client
+        self._aerospike_client = aerospike.client
+        aerospike.client = lambda config: self.client
+
+    def tearDown(self):
+        """Restore the Aerospike client factory."""
+        aerospike.client = self._aerospike_client
+
+    @unittest.skipIf(storebackend.predexp is None,
+                     'the client has no predicate expressions')
+    def test_changed_since(self):
+        """Check that only the changed records are asked to the cluster."""
+        expressions = storebackend.expressions
+        storebackend.expressions = None
+        try:
+            self.assertEqual(len(self.backend.changed_since(10 ** 18)), 2)
+        finally:
+            storebackend.expressions = expressions
+        self.assertEqual([kind for kind, _ in self.client.queries],
+                         ['query'])
+        self.assertEqual(len(self.client.queries[0][1]), 3)
+
+        self.client.queries = []
+        self.backend.changed_since(None)
+        self.assertEqual([kind for kind, _ in self.client.queries],
+                         ['scan'])
+
+    def test_encode(self):
+        """Check that cleared bins are written as explicit nils."""
+        bins = self.backend.encode({'name': 'first', 'exchange': None})
+        self.assertEqual(bins['name'], 'first')
+        self.assertIsInstance(bins['exchange'], aerospike.null)
+        self.assertIsInstance(bins['v'], aerospike.null)
+
+    def test_single_writes(self):
+        """Check that bulk writes fall back to one put per task."""
+        self.assertFalse(self.backend.can_batch_write())
+        self.assertEqual(self.backend.put_many({'third': {'name': 'third'},
+                                                'fourth': {'name': 'fourth'}}),
+                         [])
+        self.assertEqual(self.client.calls, ['put', 'put'])
+        self.assertTrue(self.backend._single_writes_logged)
+        self.assertEqual(self.backend.get('third')['name'], 'third')
+
+    def test_iter_all(self):
+        """Check that the scan thread streams the records."""
+        self.assertEqual([item['name'] for item in self.backend.iter_all()],
+                         ['first', 'second'])
+        self.assertFalse(self.client.aborted)
+
+    def test_iter_all_error(self):
+        """Check that the errors of the scan thread reach the consumer."""
+        self.client.down = True
+        items = self.backend.iter_all()
+        self.assertRaises(StoreUnavailable, next, items)
+        self.assertEqual(self.backend.breaker.failures, 1)
+
+    def test_iter_all_stop(self):
+        """Check that abandoning the iteration stops the scan thread."""
+        self.client.records = [{'name': 'task{}'.format(index)}
+                               for index in range(100)]
+        queue_size = Config.AEROSPIKE_SCAN_QUEUE_SIZE
+        Config.AEROSPIKE_SCAN_QUEUE_SIZE = 1
+        try:
+            items = self.backend.iter_all()
+            self.assertEqual(next(items)['name'], 'task0')
+            items.close()
+        finally:
+            Config.AEROSPIKE_SCAN_QUEUE_SIZE = queue_size
+        self.assertTrue(self.client.aborted)
+        self.assertLess(len(self.client.calls), 100)
+        self.assertFalse([thread for thread in threading.enumerate()
+                          if thread.name == 'aerospike-scan'])
+
+    def test_guarded(self):
+        """Check that cluster errors open the breaker and reconnect."""
+        self.assertEqual(self.backend.get('first'), {'name': 'first'})
+        self.assertIsNone(self.backend.get('missing'))
+
+        self.client.down = True
+        for _ in range(Config.AEROSPIKE_BREAKER_THRESHOLD):
+            self.assertRaises(StoreUnavailable, self.backend.get, 'first')
+            self.assertFalse(self.client.connected)
+        self.assertEqual(self.client.connects,
+                         Config.AEROSPIKE_BREAKER_THRESHOLD - 1)
+        self.assertEqual(self.backend.breaker.state, 'open')
+
+        calls = len(self.client.calls)
+        self.assertRaises(StoreUnavailable, self.backend.get, 'first')
+        self.assertEqual(len(self.client.calls), calls)
+
+    def test_half_open(self):
+        """Check that the half-open breaker pings the cluster first."""
+        self.client.down = True
+        for _ in range(Config.AEROSPIKE_BREAKER_THRESHOLD):
+            self.assertRaises(StoreUnavailable, self.backend.get, 'first')
+        self.client.calls = []
+
+        self.backend.breaker.opened_at -= Config.AEROSPIKE_BREAKER_RESET
+        self.assertRaises(StoreUnavailable, self.backend.get, 'first')
+        self.assertEqual(self.client.calls, ['info_all'])
+        self.assertEqual(self.backend.breaker.state, 'open')
+
+        self.client.down = False
+        self.backend.breaker.opened_at -= Config.AEROSPIKE_BREAKER_RESET
+        self.assertEqual(self.backend.get('first'), {'name': 'first'})
+        self.assertEqual(self.client.calls, ['info_all', 'info_all', 'get'])
+        self.assertEqual(self.backend.breaker.state, 'closed')
+        self.assertTrue(self.backend.is_healthy())
+
+    def test_max_age(self):
+        """Check that old or lost connections are replaced."""
+        max_age = Config.AEROSPIKE_CONN_MAX_AGE
+        Config.AEROSPIKE_CONN_MAX_AGE = 60
+        try:
+            self.backend.close()
+            self.assertIs(self.backend.client, self.client)
+        finally:
+            Config.AEROSPIKE_CONN_MAX_AGE = max_age
+        self.assertEqual(self.client.connects, 1)
+        self.backend.client
+        self.assertEqual(self.client.connects, 1)
+
+        self.backend.close_at -= 60
+        self.backend.client
+        self.assertEqual(self.client.connects, 2)
+        self.assertIsNone(self.backend.close_at)
+
+        self.client.connected = False
+        self.backend.client
+        self.assertEqual(self.client.connects, 3)
+
+
+class StreamBackend(BaseBackend):
+    """Backend only streaming its tasks."""
+
+    def __init__(self, items):
+        """Initialize the tasks."""
+        self.items = items
+
+    def get(self, key):
+        pass
+
+    def put(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def all(self):
+        raise AssertionError('all tasks loaded')
+
+    def iter_all(self):
+        return iter(self.items)
+
+
+class TestBaseBackend(unittest.TestCase):
+    """Tests for the default methods of the backends."""
+
+    def test_scan_page(self):
+        """Check that pages are streamed in name order."""
+        backend = StreamBackend([{'name': 'task{}'.format(index),
+                                  'enabled': index % 2 == 0}
+                                 for index in (4, 1, 3, 0, 2)])
+        pages = []
+        cursor = None
+        while True:
+            items, cursor = backend.scan_page(cursor, 2)
+            pages.append([item['name'] for item in items])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [['task0', 'task1'], ['task2', 'task3'],
+                                 ['task4']])
+
+        items, cursor = backend.scan_page(None, 2, 'enabled', True)
+        self.assertEqual([item['name'] for item in items],
+                         ['task0', 'task2'])
+        self.assertEqual(backend.scan_page(cursor, 2, 'enabled', True),
+                         ([{'name': 'task4', 'enabled': True}], None))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Tests for the CircuitBreaker object."""
+
+    def test_states(self):
+        """Check that the breaker opens over the threshold and recovers."""
+        breaker = CircuitBreaker(2, 60)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        breaker.opened_at -= 60
+        self.assertEqual(breaker.state, 'half-open')
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+        breaker.opened_at -= 60
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.failures, 0)
+
+
+class TestFailoverBackend(unittest.TestCase):
+    """Tests for the FailoverBackend object."""
+
+    def setUp(self):
+        """Initialize common objects."""
+        self.primary = FlakyBackend()
+        self.backend = FailoverBackend(self.primary)
+        for name in ('first', 'second'):
+            self.backend.put(name, {'name': name, 'totalruncount': 0})
+
+    def test_reads(self):
+        """Check that reads are served from the snapshot while down."""
+        self.primary.put('third', {'name': 'third'})
+        self.assertEqual(len(list(self.backend.iter_all())), 3)
+
+        self.primary.down = True
+        self.assertEqual(self.backend.get('first'),
+                         {'name': 'first', 'totalruncount': 0})
+        self.assertEqual(len(self.backend.all()), 3)
+        self.assertEqual(len(list(self.backend.iter_all())), 3)
+        self.assertRaises(StoreUnavailable, self.backend.scan_page)
+
+    def test_scan_outage(self):
+        """Check that a scan failing midway is completed from the snapshot."""
+        self.primary.put('third', {'name': 'third'})
+        list(self.backend.iter_all())
+        self.primary.put('first', {'name': 'first', 'totalruncount': 5})
+
+        def failing_scan():
+            yield self.primary.get('first')
+            raise StoreUnavailable('down')
+        self.primary.iter_all = failing_scan
+        items = list(self.backend.iter_all())
+        self.assertEqual(sorted(item['name'] for item in items),
+                         ['first', 'second', 'third'])
+        self.assertFalse(self.backend.available)
+        self.assertEqual(self.backend.snapshot.get('first')['totalruncount'],
+                         5)
+        self.assertEqual(len(self.backend.snapshot.store), 3)
+
+        del self.primary.iter_all
+        self.primary.delete('second')
+        self.assertEqual(len(list(self.backend.iter_all())), 2)
+        self.assertTrue(self.backend.available)
+        self.assertEqual(sorted(self.backend.snapshot.store),
+                         ['first', 'third'])
+
+    def test_writes(self):
+        """Check that writes are queued while down and replayed after."""
+        self.primary.down = True
+        self.backend.put('third', {'name': 'third'})
+        self.backend.delete('first')
+        self.assertEqual(
+            self.backend.update_many({'second': ({'totalruncount': 2}, {}),
+                                      'missing': ({'totalruncount': 1}, {})}),
+            ['missing'])
+        self.assertEqual(len(self.backend.pending), 4)
+        self.assertEqual(self.backend.get('second')['totalruncount'], 2)
+        self.assertIsNone(self.backend.get('first'))
+
+        self.primary.down = False
+        self.assertIsNone(self.backend.get('first'))
+        self.assertEqual(len(self.backend.pending), 0)
+        self.assertEqual(sorted(self.primary.store), ['second', 'third'])
+        self.assertEqual(self.primary.get('second')['totalruncount'], 2)
+
+    def test_poisoned_write(self):
+        """Check that a queued write failing for good is dropped."""
+        self.primary.down = True
+        self.backend.put('third', {'name': 'third'})
+        self.backend.put('fourth', {'name': 'fourth'})
+
+        def failing_put(key, value):
+            if key == 'third':
+                raise ValueError('bad record')
+            DummyBackend.put(self.primary, key, value)
+        self.primary.put = failing_put
+        self.primary.down = False
+        self.assertEqual(self.backend.get('fourth'), {'name': 'fourth'})
+        self.assertEqual(len(self.backend.pending), 0)
+        self.assertNotIn('third', self.primary.store)
+
+
+class TestDummyBackend(unittest.TestCase):
+    """Tests for the DummyBackend object."""
+
+    def test_leases(self):
+        """Check that leases are held by one owner until they expire."""
+        backend = DummyBackend()
+        self.assertTrue(backend.acquire_lease('shard:0', 'first', 60))
+        self.assertTrue(backend.acquire_lease('shard:0', 'first', 60))
+        self.assertFalse(backend.acquire_lease('shard:0', 'second', 60))
+        self.assertEqual(backend.leases(), {'shard:0': 'first'})
+        self.assertEqual(backend.all(), [])
+
+        backend.release_lease('shard:0', 'second')
+        self.assertFalse(backend.acquire_lease('shard:0', 'second', 60))
+        backend.release_lease('shard:0', 'first')
+        self.assertTrue(backend.acquire_lease('shard:0', 'second', 0))
+        self.assertEqual(backend.leases(), {})
+        self.assertTrue(backend.acquire_lease('shard:0', 'first', 60))
@@ -4,7 +4,7 @@ import unittest
 
 import celery.schedules
 
-from tentacle.taskmodel import (Interval, Crontab, TaskModel)
+from tentacle.taskmodel import (Interval, Crontab, TaskModel, LazyTaskModel)
 
 
 class TestHelperObjects(unittest.TestCase):
@@ -90,6 +90,28 @@ class TestHelperObjects(unittest.TestCase):
 
         self.assertIsInstance(i.schedule, celery.schedules.schedule)
 
+    def test_interval_schedule_cached(self):
+        """Interval schedule is compiled once and dropped on change."""
+        i = Interval.from_dict({'every': 7, 'period': 'days'})
+        schedule = i.schedule
+
+        self.assertIs(i.schedule, schedule)
+        i.every = 8
+        self.assertIsNot(i.schedule, schedule)
+        self.assertEqual(i.schedule.run_every.days, 8)
+
+    def test_crontab_schedule_shared(self):
+        """Identical crontabs share one compiled schedule."""
+        crtab = {'minute': '0', 'hour': '*/2'}
+        sch = Crontab.from_dict(crtab)
+        sch2 = Crontab.from_dict(crtab)
+
+        self.assertIsInstance(sch.schedule, celery.schedules.crontab)
+        self.assertIs(sch.schedule, sch2.schedule)
+        sch2.hour = '*/3'
+        self.assertIsNot(sch.schedule, sch2.schedule)
+        self.assertEqual(sch2.schedule.hour, set(range(0, 24, 3)))
+
     def test_crontab_serializing(self):
         """Correct serialization."""
         crtab = {
@@ -174,3 +196,47 @@ class TestTaskModel(unittest.TestCase):
         tsk = TaskModel(**self.task)
 
         self.assertIsInstance(tsk.schedule, celery.schedules.schedule)
+
+    def test_run_count_round_trip(self):
+        """Run count survives serialization with the cut bin name."""
+        tsk = TaskModel(**self.task)
+        tsk.total_run_count = 3
+
+        tsk2 = TaskModel(**tsk.to_dict())
+        self.assertEqual(tsk2.total_run_count, 3)
+
+    def test_from_record(self):
+        """Tasks built from store records match the validated ones."""
+        tsk = TaskModel(**self.task)
+        tsk.total_run_count = 3
+
+        tsk2 = TaskModel.from_record(tsk.to_dict())
+        self.assertEqual(tsk2.to_dict(), tsk.to_dict())
+        self.assertFalse(tsk2.run_immediately)
+        self.assertEqual(tsk2.schedule, tsk.schedule)
+
+    def test_lazy(self):
+        """Lazy tasks decode and validate their fields on first access."""
+        tsk = TaskModel(**self.task)
+        tsk.total_run_count = 3
+        lazy = LazyTaskModel(tsk.to_dict())
+
+        self.assertIsInstance(lazy, TaskModel)
+        self.assertEqual(lazy.total_run_count, 3)
+        self.assertEqual(lazy.to_dict(), tsk.to_dict())
+
+        record = dict(tsk.to_dict(), crontab={'minute': '0'})
+        lazy = LazyTaskModel(record)
+        self.assertEqual(lazy.name, tsk.name)
+        for _ in range(2):
+            self.assertRaisesRegexp(ValueError,
+                                    'Cannot define both interval and crontab',
+                                    getattr, lazy, 'schedule')
+
+    def test_compact(self):
+        """Tasks and their schedules do not carry a __dict__."""
+        tsk = TaskModel(**self.task)
+
+        self.assertFalse(hasattr(tsk, '__dict__'))
+        self.assertFalse(hasattr(Crontab(), '__dict__'))
+        self.assertFalse(hasattr(Interval(), '__dict__'))